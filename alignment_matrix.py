@@ -0,0 +1,147 @@
+import multiprocessing
+import re
+
+import numpy
+
+from constants import ALIGNMENT_GAP_HANDLING, ALIGNMENT_AMBIGUITY_HANDLING, NUMBER_OF_PROCESSES
+from fasta_io import open_fasta_buffer, iter_fasta_headers, format_fasta_record
+
+GAP_CHARACTERS = b"-."
+AMBIGUITY_CHARACTERS = b"NRYKMSWBDHVnrykmswbdhv?"
+CHARACTER_HANDLING_OPTIONS = ("state", "ignore")
+ALIGNMENT_NUMBER_PATTERN = re.compile("(\d+)")
+
+
+class AlignmentMatrix:
+    """
+    A multiple sequence alignment as a rows x columns uint8 character matrix, with the fasta title of every row
+    """
+    def __init__(self, titles, matrix):
+        self.titles = list(titles)
+        self.matrix = matrix
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def get_alignment_length(self):
+        return self.matrix.shape[1]
+
+    def variable_columns(self, gaps=ALIGNMENT_GAP_HANDLING, ambiguity=ALIGNMENT_AMBIGUITY_HANDLING):
+        """
+        Mask of the columns which are not invariant. Gaps & ambiguity codes are either compared as any other
+        character ("state"), or ignored ("ignore") so that they never make a column variable
+        """
+        for handling in (gaps, ambiguity):
+            if handling not in CHARACTER_HANDLING_OPTIONS:
+                raise ValueError("Unknown character handling %s, expected one of %s" % (handling, CHARACTER_HANDLING_OPTIONS))
+        ignored_characters = (GAP_CHARACTERS if gaps == "ignore" else b"") + \
+                             (AMBIGUITY_CHARACTERS if ambiguity == "ignore" else b"")
+        if not len(self) or not ignored_characters:
+            return (self.matrix != self.matrix[:1]).any(axis=0)
+        informative = ~numpy.isin(self.matrix, numpy.frombuffer(ignored_characters, dtype=numpy.uint8))
+        reference = self.matrix[informative.argmax(axis=0), numpy.arange(self.get_alignment_length())]
+        return ((self.matrix != reference) & informative).any(axis=0)
+
+    def select_columns(self, columns_mask):
+        return AlignmentMatrix(self.titles, self.matrix[:, columns_mask])
+
+    def scatter_rows(self, row_indices, rows_count, padding_title="[%d] padding"):
+        """
+        Place the rows at the given row indices of a rows_count rows alignment, in which all other rows are gap-only
+        padding rows titled by padding_title % their row index
+        """
+        row_indices = numpy.asarray(row_indices, dtype=numpy.int64)
+        if len(numpy.unique(row_indices)) != len(row_indices) or (row_indices >= rows_count).any():
+            raise ValueError("Row indices must be unique and less than %d" % rows_count)
+        matrix = numpy.full((rows_count, self.get_alignment_length()), ord('-'), dtype=numpy.uint8)
+        matrix[row_indices] = self.matrix
+        titles = [padding_title % i for i in range(rows_count)]
+        for row_index, title in zip(row_indices.tolist(), self.titles):
+            titles[row_index] = title
+        return AlignmentMatrix(titles, matrix)
+
+    def seq(self, row):
+        return self.matrix[row].tobytes().decode()
+
+    def write_fasta(self, file_path):
+        with open(file_path, 'w') as f:
+            for row, title in enumerate(self.titles):
+                f.write(format_fasta_record(title, self.seq(row)))
+
+
+def read_fasta_alignment(file_path):
+    """Read an aligned fasta file (such as MAFFT or Gblocks output) into an AlignmentMatrix"""
+    titles = []
+    seqs = []
+    with open_fasta_buffer(file_path) as buffer:
+        records = list(iter_fasta_headers(buffer))
+        for i, (offset, header) in enumerate(records):
+            seq_start = buffer.find(b"\n", offset) + 1 or len(buffer)
+            seq_end = records[i + 1][0] if i + 1 < len(records) else len(buffer)
+            titles.append(header.rstrip().decode())
+            seqs.append(bytes(buffer[seq_start:seq_end]).translate(None, b" \t\r\n"))
+    if len(set(len(seq) for seq in seqs)) > 1:
+        raise ValueError("Sequences in alignment %s have different lengths" % file_path)
+    alignment_length = len(seqs[0]) if seqs else 0
+    matrix = numpy.frombuffer(b"".join(seqs), dtype=numpy.uint8).reshape(len(seqs), alignment_length)
+    return AlignmentMatrix(titles, matrix)
+
+
+def fasta_alignment_shape(file_path):
+    """Get the (rows, columns) of an aligned fasta file from its headers & first sequence, without loading it"""
+    with open_fasta_buffer(file_path) as buffer:
+        records = [offset for offset, _ in iter_fasta_headers(buffer)]
+        if not records:
+            return 0, 0
+        seq_start = buffer.find(b"\n", records[0]) + 1 or len(buffer)
+        seq_end = records[1] if len(records) > 1 else len(buffer)
+        return len(records), len(bytes(buffer[seq_start:seq_end]).translate(None, b" \t\r\n"))
+
+
+def alignment_sort_key(file_name):
+    """Order alignment files by the cluster number in their name, so concatenation order is deterministic"""
+    number_match = ALIGNMENT_NUMBER_PATTERN.search(file_name)
+    return (int(number_match.group(1)) if number_match else -1, file_name)
+
+
+def build_supermatrix(alignment_paths, rows_count, matrix_path, processes=NUMBER_OF_PROCESSES):
+    """
+    Concatenate alignments of rows_count rows each into a memory-mapped rows_count x total length uint8 matrix
+    saved as an .npy file at matrix_path. Every alignment is sized first, then worker processes fill the column
+    ranges of the preallocated matrix in parallel. Returns the (alignment path, start, end) column range of each
+    alignment in concatenation order
+    """
+    partitions = []
+    total_length = 0
+    for alignment_path in alignment_paths:
+        alignment_rows, alignment_length = fasta_alignment_shape(alignment_path)
+        if alignment_rows != rows_count:
+            raise ValueError("Alignment %s has %d rows, expected %d" % (alignment_path, alignment_rows, rows_count))
+        partitions.append((alignment_path, total_length, total_length + alignment_length))
+        total_length += alignment_length
+    supermatrix = numpy.lib.format.open_memmap(matrix_path, mode='w+', dtype=numpy.uint8,
+                                               shape=(rows_count, total_length))
+    del supermatrix
+    with multiprocessing.Pool(processes) as pool:
+        for _ in pool.imap_unordered(fill_supermatrix_columns, [(matrix_path,) + partition for partition in partitions]):
+            pass
+    return partitions
+
+
+def fill_supermatrix_columns(job):
+    matrix_path, alignment_path, start, end = job
+    alignment = read_fasta_alignment(alignment_path)
+    if alignment.get_alignment_length() != end - start:
+        raise ValueError("Alignment %s changed while building the supermatrix" % alignment_path)
+    supermatrix = numpy.load(matrix_path, mmap_mode='r+')
+    supermatrix[:, start:end] = alignment.matrix
+    supermatrix.flush()
+    return alignment_path
+
+
+def write_partitions_file(partitions, file_path, data_type="DNA"):
+    """Write a RAxML / IQ-TREE partition file of the (name, start, end) column ranges, skipping empty ranges"""
+    with open(file_path, 'w') as f:
+        for name, start, end in partitions:
+            if end > start:
+                f.write("%s, %s = %d-%d\n" % (data_type, name, start + 1, end))
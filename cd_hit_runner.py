@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import resource
+import subprocess
+import time
+
+from constants import NUMBER_OF_PROCESSES, CD_HIT_MEMORY_FRACTION, CD_HIT_MEMORY_BUDGET, CD_HIT_BASE_MEMORY, \
+    CD_HIT_THREAD_MEMORY, CD_HIT_INPUT_MEMORY_FACTOR, CD_HIT_MIN_INPUT_PER_THREAD, CD_HIT_SAMPLE_INTERVAL, \
+    CD_HIT_METRICS_PATH
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Largest word size CD-HIT accepts for a minimal identity threshold, per tool
+PROTEIN_WORD_SIZES = ((0.7, 5), (0.6, 4), (0.5, 3), (0.4, 2))
+NUCLEOTIDE_WORD_SIZES = ((0.95, 10), (0.9, 8), (0.88, 7), (0.85, 6), (0.8, 5), (0.75, 4))
+
+
+def cd_hit_options(tool, identity, word_size=None, description_length=None):
+    """
+    CD-HIT clustering options affecting the clusters - identity threshold, word size (the largest one valid for the
+    identity threshold when not given), accurate mode & alignment coverage output
+    """
+    if word_size is None:
+        word_sizes = NUCLEOTIDE_WORD_SIZES if tool == "cd-hit-est" else PROTEIN_WORD_SIZES
+        word_size = next((size for min_identity, size in word_sizes if identity >= min_identity), None)
+        if word_size is None:
+            raise ValueError("Identity threshold %s is too low for %s" % (identity, tool))
+    options = ["-c", str(identity), "-n", str(word_size), "-g", "1", "-p", "1"]
+    if description_length is not None:
+        options += ["-d", str(description_length)]
+    return options
+
+
+class CdHitResources:
+    """Threads (-T) & memory limit in MB (-M) for a CD-HIT run, with the memory it is estimated to need"""
+    def __init__(self, threads, memory, estimated_memory):
+        self.threads = threads
+        self.memory = memory
+        self.estimated_memory = estimated_memory
+
+
+def plan_cd_hit_resources(input_paths, cores=NUMBER_OF_PROCESSES, memory_budget=CD_HIT_MEMORY_BUDGET):
+    """
+    Size CD-HIT's threads by the cores and input size, so small inputs do not pay for idle threads, and its memory
+    limit by the memory budget - CD_HIT_MEMORY_FRACTION of the available memory unless given in MB. Warns when the
+    rough memory estimate exceeds the budget, the limit itself is enforced by run_cd_hit on the sampled RSS
+    """
+    input_size = sum(os.path.getsize(path) for path in input_paths)
+    threads = max(1, min(cores, input_size // CD_HIT_MIN_INPUT_PER_THREAD))
+    if memory_budget is None:
+        available_memory = get_available_memory()
+        if available_memory is None:
+            raise RuntimeError("Cannot determine available memory, set a CD-HIT memory budget")
+        memory_budget = int(available_memory * CD_HIT_MEMORY_FRACTION)
+    estimated_memory = int(CD_HIT_BASE_MEMORY + CD_HIT_THREAD_MEMORY * threads +
+                           CD_HIT_INPUT_MEMORY_FACTOR * input_size / MB)
+    if estimated_memory > memory_budget:
+        logger.warning("CD-HIT on %d MB of input with %d threads may need about %d MB (rough estimate), over the %d MB "
+                       "memory budget" % (input_size // MB, threads, estimated_memory, memory_budget))
+    return CdHitResources(threads, memory_budget, estimated_memory)
+
+
+def run_cd_hit(tool, io_args, options, input_paths, memory_budget=CD_HIT_MEMORY_BUDGET):
+    """
+    Run a CD-HIT tool (cd-hit, cd-hit-est, cd-hit-2d) without a shell, with io_args (-i, -o etc.), clustering options
+    and -T & -M sized for input_paths. The child's CPU usage & RSS are sampled from /proc while it runs, and it is
+    killed with a RuntimeError if its RSS exceeds the memory limit. A metrics record of the run is appended to
+    CD_HIT_METRICS_PATH. Returns the tool's return code
+    """
+    resources = plan_cd_hit_resources(input_paths, memory_budget=memory_budget)
+    args = [tool] + io_args + options + ["-T", str(resources.threads), "-M", str(resources.memory)]
+    logger.info("Running %s with %d threads and %d MB memory limit (estimated %d MB)" %
+                (tool, resources.threads, resources.memory, resources.estimated_memory))
+    metrics = ProcessMetrics()
+    start_time = time.monotonic()
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    process = subprocess.Popen(args)
+    try:
+        while True:
+            metrics.sample(process.pid)
+            if metrics.peak_rss > resources.memory * MB:
+                raise RuntimeError("%s was killed at %d MB RSS, over its %d MB memory limit" %
+                                   (tool, metrics.peak_rss // MB, resources.memory))
+            try:
+                process.wait(timeout=CD_HIT_SAMPLE_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        elapsed = time.monotonic() - start_time
+        finished_children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time = finished_children_usage.ru_utime + finished_children_usage.ru_stime - \
+            children_usage.ru_utime - children_usage.ru_stime
+        record = {'tool': tool, 'args': args, 'return_code': process.returncode, 'threads': resources.threads,
+                  'memory_limit_mb': resources.memory, 'estimated_memory_mb': resources.estimated_memory,
+                  'elapsed': round(elapsed, 3), 'cpu_time': round(cpu_time, 3),
+                  'mean_cpu_percent': round(100 * cpu_time / elapsed, 1) if elapsed > 0 else 0.0}
+        record.update(metrics.summary())
+        save_metrics_record(record)
+    logger.info("Finished %s with return code %d in %.1f seconds, %.0f%% mean CPU, %d MB peak RSS" %
+                (tool, process.returncode, record['elapsed'], record['mean_cpu_percent'], record['peak_rss_mb']))
+    return process.returncode
+
+
+class ProcessMetrics:
+    """CPU% & RSS of a process sampled from /proc/<pid>/stat & /proc/<pid>/status"""
+    def __init__(self):
+        self.peak_rss = 0
+        self.cpu_percents = []
+        self._clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self._last_sample = None
+
+    def sample(self, pid):
+        try:
+            with open("/proc/%d/stat" % pid) as f:
+                stat_fields = f.read().rsplit(")", 1)[1].split()
+            with open("/proc/%d/status" % pid) as f:
+                rss_lines = [line for line in f if line.startswith("VmRSS:")]
+        except OSError:
+            return
+        cpu_time = (int(stat_fields[11]) + int(stat_fields[12])) / self._clock_ticks
+        sample_time = time.monotonic()
+        if self._last_sample is not None and sample_time > self._last_sample[0]:
+            self.cpu_percents.append(100 * (cpu_time - self._last_sample[1]) / (sample_time - self._last_sample[0]))
+        self._last_sample = (sample_time, cpu_time)
+        if rss_lines:
+            self.peak_rss = max(self.peak_rss, int(rss_lines[0].split()[1]) * 1024)
+
+    def summary(self):
+        return {'max_cpu_percent': round(max(self.cpu_percents), 1) if self.cpu_percents else 0.0,
+                'peak_rss_mb': self.peak_rss // MB,
+                'samples': len(self.cpu_percents)}
+
+
+def get_available_memory():
+    """Available memory in MB from /proc/meminfo, or None where it cannot be read"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def save_metrics_record(record, metrics_path=CD_HIT_METRICS_PATH):
+    metrics_dir = os.path.dirname(metrics_path)
+    if not os.path.exists(metrics_dir):
+        os.makedirs(metrics_dir)
+    with open(metrics_path, 'a') as f:
+        f.write(json.dumps(record) + "\n")
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+
+import numpy
+import scipy.sparse
+
+from constants import CLUSTER_STORES_DIR, CLUSTER_MEMBER_PATTERN, CLUSTER_MEMBER_IDENTITY_PATTERN
+from fs_utils import building_dir, read_json_file
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_STORE_VERSION = 1
+CLUSTER_STORE_META_FILE = "meta.json"
+CLUSTER_STORE_COLUMNS = {
+    'cluster_id': numpy.int32,
+    'strain_index': numpy.int32,
+    'seq_index': numpy.int32,
+    'length': numpy.int32,
+    'is_pseudogene': numpy.bool_,
+    'is_representative': numpy.bool_,
+    'identity': numpy.float32,
+}
+
+
+class ClusterStore:
+    """
+    Columnar view of a CD-HIT .clstr file - one row per cluster member, sorted by cluster id in file order.
+    Columns are memory-mapped numpy arrays named as in CLUSTER_STORE_COLUMNS
+    """
+    def __init__(self, store_dir):
+        for column in CLUSTER_STORE_COLUMNS:
+            setattr(self, column, numpy.load(os.path.join(store_dir, column + ".npy"), mmap_mode='r'))
+        self.clusters_count = int(self.cluster_id[-1]) + 1 if len(self.cluster_id) else 0
+        self.strains = numpy.unique(self.strain_index)
+        self.strains_count = len(self.strains)
+        self._cluster_offsets = numpy.searchsorted(self.cluster_id, numpy.arange(self.clusters_count + 1))
+        self._seq_keys = self._seq_keys_order = None
+
+    def __len__(self):
+        return len(self.cluster_id)
+
+    def cluster_members(self, cluster_index):
+        """Get the row slice of a single cluster's members"""
+        return slice(self._cluster_offsets[cluster_index], self._cluster_offsets[cluster_index + 1])
+
+    def cluster_sizes(self):
+        """Number of member sequences per cluster"""
+        return numpy.bincount(self.cluster_id, minlength=self.clusters_count)
+
+    def strain_cluster_pairs(self, rows_mask=None):
+        """
+        Distinct (strain index, cluster id) pairs, i.e. every cluster each strain has at least one member in,
+        optionally counting only the members selected by rows_mask
+        """
+        strain_index, cluster_id = self.strain_index, self.cluster_id
+        if rows_mask is not None:
+            strain_index, cluster_id = strain_index[rows_mask], cluster_id[rows_mask]
+        pairs = numpy.unique(strain_index.astype(numpy.int64) * self.clusters_count + cluster_id)
+        return pairs // self.clusters_count, pairs % self.clusters_count
+
+    def strains_rows(self):
+        """Number of rows needed to index per-strain arrays by strain index"""
+        return int(self.strains[-1]) + 1 if self.strains_count else 0
+
+    def strain_cluster_incidence(self):
+        """Sparse strains x clusters CSR matrix with 1 wherever a strain has at least one member in a cluster"""
+        strains, clusters = self.strain_cluster_pairs()
+        return scipy.sparse.csr_matrix((numpy.ones(len(strains), dtype=numpy.int32), (strains, clusters)),
+                                       shape=(self.strains_rows(), self.clusters_count))
+
+    def cluster_strains_num(self, rows_mask=None):
+        """Number of distinct member strains per cluster, optionally counting only the members selected by rows_mask"""
+        _, clusters = self.strain_cluster_pairs(rows_mask)
+        return numpy.bincount(clusters, minlength=self.clusters_count)
+
+    def core_clusters_mask(self, core_threshold=0.9):
+        """Mask of clusters containing at least core_threshold of all strains"""
+        return self.cluster_strains_num() / self.strains_count >= core_threshold
+
+    def seq_clusters(self, strain_indices, seq_indices):
+        """Vectorised lookup of the cluster ids of (strain index, seq index) pairs, -1 for pairs not in any cluster"""
+        if self._seq_keys is None:
+            keys = (self.strain_index.astype(numpy.int64) << 32) | self.seq_index
+            self._seq_keys_order = numpy.argsort(keys, kind='stable')
+            self._seq_keys = keys[self._seq_keys_order]
+        query = (numpy.asarray(strain_indices, dtype=numpy.int64) << 32) | numpy.asarray(seq_indices, dtype=numpy.int64)
+        positions = numpy.minimum(numpy.searchsorted(self._seq_keys, query), max(len(self._seq_keys) - 1, 0))
+        found = self._seq_keys[positions] == query if len(self._seq_keys) else numpy.zeros(len(query), dtype=bool)
+        return numpy.where(found, self.cluster_id[self._seq_keys_order[positions]], -1)
+
+
+def load_cluster_store(clusters_file):
+    """
+    Load the columnar store of a CD-HIT .clstr file, (re)building it first if it is missing or the .clstr file
+    changed since it was built
+    """
+    store_dir = os.path.join(CLUSTER_STORES_DIR, os.path.basename(clusters_file))
+    source_stat = os.stat(clusters_file)
+    source_signature = {'version': CLUSTER_STORE_VERSION, 'size': source_stat.st_size,
+                        'mtime_ns': source_stat.st_mtime_ns}
+    if read_store_meta(store_dir) == source_signature:
+        return ClusterStore(store_dir)
+    logger.info("Building cluster store for %s" % clusters_file)
+    build_cluster_store(clusters_file, store_dir, source_signature)
+    return ClusterStore(store_dir)
+
+
+def build_cluster_store(clusters_file, store_dir, source_signature):
+    """
+    Parse a CD-HIT .clstr file once into typed column arrays persisted as .npy files. Stages running concurrently may
+    build the same store, so each builds in its own tmp dir and keeps a store another one published meanwhile
+    """
+    columns = {column: [] for column in CLUSTER_STORE_COLUMNS}
+    cluster_index = -1
+    with open(clusters_file, 'r') as clusters_db:
+        for line in clusters_db:
+            if line.startswith(">Cluster"):
+                cluster_index = int(line.split()[-1])
+                continue
+            member_match = CLUSTER_MEMBER_PATTERN.match(line)
+            if not member_match:
+                raise ValueError("line in clusters file %s does not match cluster member pattern %s" % (line, CLUSTER_MEMBER_PATTERN.pattern))
+            is_representative = line.rstrip().endswith('*')
+            identity_match = None if is_representative else CLUSTER_MEMBER_IDENTITY_PATTERN.search(line)
+            columns['cluster_id'].append(cluster_index)
+            columns['length'].append(int(member_match.group(1)))
+            columns['strain_index'].append(int(member_match.group(2)))
+            columns['seq_index'].append(int(member_match.group(3)))
+            columns['is_pseudogene'].append(member_match.group(4) is not None)
+            columns['is_representative'].append(is_representative)
+            columns['identity'].append(float(identity_match.group(1)) if identity_match else 100.0)
+    with building_dir(store_dir, lambda d: read_store_meta(d) == source_signature) as tmp_store_dir:
+        for column, dtype in CLUSTER_STORE_COLUMNS.items():
+            numpy.save(os.path.join(tmp_store_dir, column + ".npy"), numpy.array(columns[column], dtype=dtype))
+        with open(os.path.join(tmp_store_dir, CLUSTER_STORE_META_FILE), 'w') as f:
+            json.dump(source_signature, f)
+
+
+def read_store_meta(store_dir):
+    return read_json_file(os.path.join(store_dir, CLUSTER_STORE_META_FILE))
+
+
+def iter_clusters_file(clusters_file):
+    """Iterate over the (cluster id, member lines without member numbers) of each cluster in a CD-HIT .clstr file"""
+    cluster_id = None
+    members = []
+    with open(clusters_file) as f:
+        for line in f:
+            if line.startswith(">Cluster"):
+                if cluster_id is not None:
+                    yield cluster_id, members
+                cluster_id = int(line.split()[-1])
+                members = []
+            elif line.strip():
+                members.append(line.split("\t", 1)[1])
+    if cluster_id is not None:
+        yield cluster_id, members
+
+
+def write_cluster(output, cluster_id, members):
+    output.write(">Cluster %d\n" % cluster_id)
+    for i, member in enumerate(members):
+        output.write("%d\t%s" % (i, member))
@@ -7,6 +7,7 @@ DATA_DIR = os.getcwd() + os.sep + "data"
 STRAINS_DIR = DATA_DIR + os.sep + "strains"
 PICKLES_DIR = DATA_DIR + os.sep + "pickles"
 CLUSTERS_DIR = DATA_DIR + os.sep + "clusters"
+SEQUENCE_STORES_DIR = DATA_DIR + os.sep + "sequence_stores"
 CLUSTERS_NT_SEQS_DIR = DATA_DIR + os.sep + "clusters_for_alignment"
 ALIGNMENTS_FOR_TREE_DIR = DATA_DIR + os.sep + "alignments_for_tree"
 CLUSTERS_ALIGNMENTS_DIR = DATA_DIR + os.sep + "cluster_alignments"
@@ -16,29 +17,67 @@ SECOND_STAGE_GRAPHS_DIR = os.getcwd() + os.sep + "2nd_stage_graphs"
 
 NUMBER_OF_PROCESSES = os.cpu_count()
 
+DOWNLOAD_CONCURRENCY = 16
+DOWNLOAD_HOST_RATE = 10
+DOWNLOAD_MAX_ATTEMPTS = 5
+DOWNLOAD_BACKOFF_BASE = 2
+DOWNLOAD_BACKOFF_MAX = 60
+DOWNLOAD_TIMEOUT = 60
+
 FASTA_FILE_TYPE = "fasta"
+FASTA_LINE_WIDTH = 60
+FASTA_WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+FASTA_MAX_OPEN_FILES = 256
 PROTEIN_FILE_PATTERN = "protein.faa"
 CDS_FROM_GENOMIC_PATTERN = "cds_from_genomic.fna"
 GENOMIC_PATTERN = "genomic.fna"
 STRAIN_INDEX_FILE = "strain_index"
 FEATURE_TABLE_PATTERN = "feature_table.txt"
+MD5_CHECKSUMS_FILE = "md5checksums.txt"
 CLUSTER_STRAIN_PATTERN = re.compile("[0-9a-z,> \t]+\[(\d+)\]\[(\d+)\]")
 CLUSTER_PSEUDOGENE_PATTERN = re.compile(CLUSTER_STRAIN_PATTERN.pattern + "\[p")
-CLUSTER_1ST_STAGE_REPRESENTATIVE_PATTERN = re.compile(CLUSTER_STRAIN_PATTERN.pattern + "\[cluster_(\d+)\]")
-CLUSTER_2ND_STAGE_SEQ_LEN_PATTERN = re.compile("(\d+)nt,")
+CLUSTER_MEMBER_PATTERN = re.compile("\d+\t(\d+)(?:aa|nt), >[^\[]*\[(\d+)\]\[(\d+)\](\[p)?")
+CLUSTER_MEMBER_IDENTITY_PATTERN = re.compile("at (?:[+-]/)?([\d.]+)%")
+ALIGNMENT_GAP_HANDLING = "state"
+ALIGNMENT_AMBIGUITY_HANDLING = "state"
+# MAFFT threads per cluster seqs count x max seq length, up to ALIGNMENT_MAX_THREADS threads per cluster
+ALIGNMENT_COST_PER_THREAD = 1000000
+ALIGNMENT_MAX_THREADS = 8
+SUPERMATRIX_MISSING_CHARACTERS = b"-.?Nn"
 ALIGNMENT_STRAIN_PATTERN = re.compile("\[(\d+)\]\[(\d+)\]")
+CDS_ID_PROTEIN_ID_PATTERN = re.compile("_cds_(.+)_\d+$")
 
 COMBINED_STRAIN_PROTEINS_PREFIX = "combined_strain_proteins"
 WORKER_PROTEIN_FILE_PREFIX = COMBINED_STRAIN_PROTEINS_PREFIX + "_worker_"
 COMBINED_PROTEINS_FILE_PATH = os.path.join(DATA_DIR, COMBINED_STRAIN_PROTEINS_PREFIX + "_all.fasta")
+COMBINED_UNIQUE_PROTEINS_FILE_PATH = os.path.join(DATA_DIR, COMBINED_STRAIN_PROTEINS_PREFIX + "_unique.fasta")
 COMBINED_STRAIN_CDS_PREFIX = "combined_strain_reps_pseudogenes_cds"
 WORKER_CDS_FILE_PREFIX = COMBINED_STRAIN_CDS_PREFIX + "_worker_"
 COMBINED_CDS_FILE_PATH = os.path.join(DATA_DIR, COMBINED_STRAIN_CDS_PREFIX + "_all.fasta")
+COMBINED_UNIQUE_CDS_FILE_PATH = os.path.join(DATA_DIR, COMBINED_STRAIN_CDS_PREFIX + "_unique.fasta")
+PROTEIN_CLUSTERING_IDENTITY = 0.7
+CDS_CLUSTERING_IDENTITY = 0.8
+# CD-HIT memory budget in MB, or None for CD_HIT_MEMORY_FRACTION of the available memory
+CD_HIT_MEMORY_BUDGET = None
+CD_HIT_MEMORY_FRACTION = 0.8
+# Rough CD-HIT memory estimate in MB - base + per thread + input size multiple, not measured, only used for warnings
+# (compare with peak_rss_mb in CD_HIT_METRICS_PATH). The memory limit itself is enforced on the sampled RSS
+CD_HIT_BASE_MEMORY = 200
+CD_HIT_THREAD_MEMORY = 100
+CD_HIT_INPUT_MEMORY_FACTOR = 3
+CD_HIT_MIN_INPUT_PER_THREAD = 4 * 1024 * 1024
+CD_HIT_SAMPLE_INTERVAL = 1
+# Collapsed duplicates of a unique seqs file are listed in the file named by its path + DUPLICATES_FILE_SUFFIX
+DUPLICATES_FILE_SUFFIX = ".duplicates"
+DUPLICATE_TITLE_MAX_LENGTH = 64
 COMBINED_STRAIN_REPS_CDS_PATH = os.path.join(DATA_DIR, "combined_strain_reps_cds.fasta")
 COMBINED_STRAIN_PSEUDOGENES_PATH = os.path.join(DATA_DIR, "combined_strain_pseudogenes.fasta")
 
 CD_HIT_CLUSTER_REPS_OUTPUT_FILE = os.path.join(CLUSTERS_DIR, 'protein_clusters.txt')
 CD_HIT_CLUSTERS_OUTPUT_FILE = CD_HIT_CLUSTER_REPS_OUTPUT_FILE + ".clstr"
+CD_HIT_METRICS_PATH = os.path.join(CLUSTERS_DIR, "cd_hit_metrics.jsonl")
+CLUSTERED_STRAINS_PATH = CD_HIT_CLUSTER_REPS_OUTPUT_FILE + ".strains.json"
+INCREMENTAL_CLUSTERING_DIR = os.path.join(CLUSTERS_DIR, "incremental")
 CD_HIT_EST_CLUSTER_REPS_OUTPUT_FILE = os.path.join(CLUSTERS_DIR, 'cds_clusters.txt')
 CD_HIT_EST_CLUSTERS_OUTPUT_FILE = CD_HIT_EST_CLUSTER_REPS_OUTPUT_FILE + ".clstr"
 CD_HIT_EST_MULTIPLE_PROTEIN_CLUSTERS_OUTPUT_FILE = os.path.join(CLUSTERS_DIR, 'cds_clusters_multiple_proteins.txt.clstr')
@@ -54,7 +93,21 @@ FIRST_STAGE_STATS_PKL = os.path.join(PICKLES_DIR, "1st_stage_stats.pkl")
 SECOND_STAGE_STRAIN_STATS_PKL = os.path.join(PICKLES_DIR, "2nd_stage_strain_stats.pkl")
 SECOND_STAGE_CLUSTER_STATS_PKL = os.path.join(PICKLES_DIR, "2nd_stage_cluster_stats.pkl")
 SECOND_STAGE_AGGREGATED_CLUSTER_STATS_PKL = os.path.join(PICKLES_DIR, "2nd_stage_aggregated_cluster_stats.pkl")
-PROTEIN_CORE_CLUSTERS_PKL = os.path.join(PICKLES_DIR, "protein_core_clusters.pkl")
+CLUSTER_REPRESENTATIVES_NPY = os.path.join(PICKLES_DIR, "cluster_representatives.npy")
+CLUSTER_STORES_DIR = os.path.join(PICKLES_DIR, "cluster_stores")
+STRAIN_METRICS_CACHE_PKL = os.path.join(PICKLES_DIR, "strain_metrics_cache.pkl")
+
+CONCATENATED_ALIGNMENT_PATH = os.path.join(DATA_DIR, "all_alignments")
+ALIGNMENT_LOGS_DIR = os.path.join(DATA_DIR, "alignment_logs")
+ALIGNMENT_JOBS_SUMMARY_PATH = os.path.join(ALIGNMENT_LOGS_DIR, "jobs_summary.json")
+TOOL_CACHE_DIR = os.path.join(DATA_DIR, "tool_cache")
+TOOL_CACHE_MAX_SIZE = 20 * 1024 ** 3
+SUPERMATRIX_DIR = CONCATENATED_ALIGNMENT_PATH + ".supermatrix"
+CONCATENATED_ALIGNMENT_PARTITIONS_PATH = CONCATENATED_ALIGNMENT_PATH + ".partitions"
+FILTERED_TREE_ALIGNMENT_PATH = os.path.join(DATA_DIR, "filtered_tree_alignment")
+PIPELINE_MANIFEST_PATH = os.path.join(DATA_DIR, "pipeline_manifest.json")
+STRAIN_MANIFEST_PATH = os.path.join(DATA_DIR, "strain_manifest.json")
+LEGACY_DOWNLOAD_MANIFEST_PATH = os.path.join(DATA_DIR, "download_manifest.json")
 
 FIRST_STAGE_STATS_CSV = os.path.join(DATA_DIR, "1st_stage_stats.csv")
 SECOND_STAGE_STATS_CSV = os.path.join(DATA_DIR, "2nd_stage_stats.csv")
@@ -1,18 +1,25 @@
-import gzip
 import logging
+import multiprocessing
 import sys
 from collections import defaultdict
 import os
+import pickle
+import numpy
 import pandas
 from Bio import SeqIO
 
-from constants import STRAINS_DIR, CDS_FROM_GENOMIC_PATTERN, GENOMIC_PATTERN, STRAIN_INDEX_FILE, CLUSTER_STRAIN_PATTERN, \
+from constants import CDS_FROM_GENOMIC_PATTERN, GENOMIC_PATTERN, \
     CD_HIT_CLUSTERS_OUTPUT_FILE, CD_HIT_EST_CLUSTERS_OUTPUT_FILE, CLUSTER_PSEUDOGENE_PATTERN, \
-    CLUSTER_2ND_STAGE_SEQ_LEN_PATTERN, CD_HIT_EST_MULTIPLE_PROTEIN_CLUSTERS_OUTPUT_FILE, COMBINED_CDS_FILE_PATH, \
+    CD_HIT_EST_MULTIPLE_PROTEIN_CLUSTERS_OUTPUT_FILE, COMBINED_CDS_FILE_PATH, \
     FASTA_FILE_TYPE, COMBINED_STRAIN_REPS_CDS_PATH, COMBINED_STRAIN_PSEUDOGENES_PATH, BLAST_RESULTS_FILE, \
     BLAST_PSEUDOGENE_PATTERN, COMBINED_PSEUDOGENES_WITHOUT_BLAST_HIT_PATH, CLUSTERS_NT_SEQS_DIR, \
-    PROTEIN_CORE_CLUSTERS_PKL, MLST_GENES, STRAINS_COUNT, DATA_DIR
-from nucleotide_preprocessor import get_strain_index
+    MLST_GENES, STRAINS_COUNT, DATA_DIR, NUMBER_OF_PROCESSES, PICKLES_DIR, \
+    STRAIN_METRICS_CACHE_PKL
+from cluster_store import load_cluster_store
+from fasta_io import open_fasta_buffer, iter_fasta_headers, fasta_title, FastaFileSet
+from fs_utils import building_dir
+from sequence_store import load_sequence_store, iterate_strains_sequence_stores
+from strain_manifest import load_strain_manifest, strain_file_path
 
 logger = logging.getLogger(__name__)
 
@@ -38,284 +45,195 @@ class Cluster:
         return sum(self.member_strains.values())
 
 
-class NucleotideCluster(Cluster):
-    def __init__(self, index):
-        super().__init__(index)
-        self.member_pseudogenes = {}
-        self.member_protein_seqs = {}
-        self.total_protein_len = 0
-        self.total_pseudogene_len = 0
-        self.representative = ""
-
-    def add_nucleotide(self, strain_index, seq_index, seq_len, is_pseudogene, is_cluster_rep):
-        if is_pseudogene:
-            strain_pseudogenes = self.member_pseudogenes[
-                strain_index] if strain_index in self.member_pseudogenes.keys() else []
-            strain_pseudogenes.append(seq_index)
-            self.member_pseudogenes[strain_index] = strain_pseudogenes
-            self.total_pseudogene_len += seq_len
-        else:
-            strain_1st_stage_reps = self.member_protein_seqs[
-                strain_index] if strain_index in self.member_protein_seqs.keys() else []
-            strain_1st_stage_reps.append(seq_index)
-            self.member_protein_seqs[strain_index] = strain_1st_stage_reps
-            self.total_protein_len += seq_len
-        if is_cluster_rep:
-            self.representative = "Strain idx: %s, Seq idx: %s, Pseudogene: %r" % (str(strain_index), str(seq_index), bool(is_pseudogene))
-
-    def has_reps(self):
-        return len(self.member_protein_seqs) == 0
-
-    def get_avg_protein_seq_len(self):
-        return int(round(self.total_protein_len / len(self.member_protein_seqs))) if len(self.member_protein_seqs) > 0 else 0
-
-    def get_avg_pseudogene_seq_len(self):
-        return int(round(self.total_pseudogene_len / len(self.member_pseudogenes))) if len(self.member_pseudogenes) > 0 else 0
-
-
-class Strain:
-    def __init__(self, index):
-        self.index = index
-        self.containing_clusters = {}
-        self.seq_clusters = {}
-
-    def add_cluster(self, cluster):
-        self.containing_clusters[cluster.index] = cluster
-
-    def add_seq_cluster(self, seq_index, cluster_index):
-        self.seq_clusters[seq_index] = cluster_index
-
-    def get_strain_core_clusters(self, total_strains_count):
-        return [c for c in self.containing_clusters.values() if ((c.get_cluster_strains_num() / total_strains_count) >= 0.9)]
-
-    def get_strain_singleton_clusters(self):
-        return [c for c in self.containing_clusters.values() if c.get_cluster_strains_num() is 1]
-
-    def get_strain_pseudogenes_in_clusters_without_rep(self):
-        clusters_without_rep = [c for c in self.containing_clusters.values() if not c.member_1st_stage_reps]
-        strain_pseudogenes = []
-        for c in clusters_without_rep:
-            if c.member_pseudogenes.get(self.index):
-                strain_pseudogenes.extend(c.member_pseudogenes.get(self.index))
-        return strain_pseudogenes
-
-
-def create_strains_clusters_map(clusters_file):
-    strains_map = {}
-    clusters_map = {}
-    with open(clusters_file, 'r') as clusters_db:
-        cur_cluster = None
-        for line in clusters_db:
-            if line.startswith(">Cluster"):
-                cluster_index = int(line.split()[-1])
-                cur_cluster = Cluster(cluster_index)
-                clusters_map[cluster_index] = cur_cluster
-            else:
-                match = CLUSTER_STRAIN_PATTERN.match(line)
-                strain_index = int(match.group(1))
-                cur_cluster.add_strain(strain_index)
-                cur_strain = strains_map[strain_index] if strain_index in strains_map.keys() else Strain(strain_index)
-                cur_strain.add_cluster(cur_cluster)
-                strains_map[strain_index] = cur_strain
-    total_strains_count = len(strains_map)
-    total_core_clusters = len([c for c in clusters_map.values() if c.get_cluster_strains_num() / total_strains_count >= 0.9])
-    return strains_map, clusters_map, total_strains_count, total_core_clusters
-
-
-def create_1st_stage_sequences_clusters_map(clusters_file):
-    strains_map = {}
-    clusters_map = {}
-    with open(clusters_file, 'r') as clusters_db:
-        cur_cluster = None
-        for line in clusters_db:
-            if line.startswith(">Cluster"):
-                cluster_index = int(line.split()[-1])
-                cur_cluster = Cluster(cluster_index)
-                clusters_map[cluster_index] = cur_cluster
-            else:
-                match = CLUSTER_STRAIN_PATTERN.match(line)
-                strain_index = int(match.group(1))
-                seq_index = int(match.group(2))
-                cur_cluster.add_strain(strain_index)
-                cur_cluster.add_strain_seq(strain_index, seq_index)
-                cur_strain = strains_map[strain_index] if strain_index in strains_map.keys() else Strain(strain_index)
-                cur_strain.add_seq_cluster(seq_index, cluster_index)
-                strains_map[strain_index] = cur_strain
-    return strains_map, clusters_map
-
-
-def create_nucleotide_clusters_map(clusters_file):
-    strains_map = {}
-    clusters_map = {}
-    with open(clusters_file, 'r') as clusters_db:
-        cur_cluster = None
-        for line in clusters_db:
-            if line.startswith(">Cluster"):
-                cluster_index = int(line.split()[-1])
-                cur_cluster = NucleotideCluster(cluster_index)
-                clusters_map[cluster_index] = cur_cluster
-            else:
-                is_pseudogene = CLUSTER_PSEUDOGENE_PATTERN.search(line)
-                is_representative = '*' in line
-                index_match = CLUSTER_STRAIN_PATTERN.match(line)
-                len_match = CLUSTER_2ND_STAGE_SEQ_LEN_PATTERN.search(line)
-                if not index_match:
-                    raise ValueError("line in clusters file %s does not match strain index pattern %s" % (line, CLUSTER_STRAIN_PATTERN.pattern))
-                if not len_match:
-                    raise ValueError("line in clusters file %s does not match seq len pattern %s" % (line, CLUSTER_2ND_STAGE_SEQ_LEN_PATTERN.pattern))
-                strain_index = int(index_match.group(1))
-                seq_index = int(index_match.group(2))
-                seq_len = int(len_match.group(1))
-                cur_cluster.add_strain(strain_index)
-                cur_cluster.add_nucleotide(strain_index, seq_index, seq_len, is_pseudogene, is_representative)
-                cur_strain = strains_map[strain_index] if strain_index in strains_map.keys() else Strain(strain_index)
-                cur_strain.add_cluster(cur_cluster)
-                strains_map[strain_index] = cur_strain
-    return strains_map, clusters_map
-
-
-def get_strain_contigs(strain_genomic_file):
+def get_strain_contigs(strain_genomic_buffer):
     contigs = 0
-    for line in strain_genomic_file:
-        if line.startswith(">") and "plasmid" not in line:
+    for _, header in iter_fasta_headers(strain_genomic_buffer):
+        if b"plasmid" not in header:
             contigs += 1
     return contigs
 
 
-def get_strain_pseudogenes(strain_cds_file):
-    genes = 0
-    pseudogenes = 0
-    for line in strain_cds_file:
-        if line.startswith('>'):
-            if "pseudo=true" in line:
-                pseudogenes += 1
-            else:
-                genes += 1
-    return genes, pseudogenes
+def get_strain_pseudogenes(strain_sequence_store):
+    pseudogenes = int(numpy.count_nonzero(strain_sequence_store.pseudo))
+    return len(strain_sequence_store) - pseudogenes, pseudogenes
 
 
 def get_1st_stage_stats_per_strain():
-    strains_map, _, total_strains_count, total_core_clusters = create_strains_clusters_map(CD_HIT_CLUSTERS_OUTPUT_FILE)
-    df = pandas.DataFrame(index=range(total_strains_count), columns=('strain_name', 'total_clusters', 'core_clusters', 'missing_core', 'singletons', 'contigs', 'pseudogenes', 'genes'))
-    for strain in strains_map.values():
-        total_clusters = len(strain.containing_clusters)
-        core_clusters = len(strain.get_strain_core_clusters(total_strains_count))
-        missing_core = 100 - (core_clusters / total_core_clusters * 100)
-        singletons = len(strain.get_strain_singleton_clusters())
-        df.loc[strain.index] = ['', total_clusters, core_clusters, missing_core, singletons, 0, 0, 0]
-    for strain_dir in os.listdir(STRAINS_DIR):
-        strain_dir_files = os.listdir(os.path.join(STRAINS_DIR, strain_dir))
-        cds_file_name = [f for f in strain_dir_files if CDS_FROM_GENOMIC_PATTERN in f][0]
-        genomic_file_name = [f for f in strain_dir_files if GENOMIC_PATTERN in f and CDS_FROM_GENOMIC_PATTERN not in f][0]
-        cds_file = strain_index_file = genomic_file = None
-        try:
-            strain_index_file = open(os.path.join(STRAINS_DIR, strain_dir, STRAIN_INDEX_FILE))
-            strain_index = int(strain_index_file.readline())
-            df.loc[strain_index]['strain_name'] = strain_dir
-            if genomic_file_name.endswith('gz'):
-                genomic_file = gzip.open(os.path.join(STRAINS_DIR, strain_dir, genomic_file_name), 'rt')
-            else:
-                genomic_file = open(os.path.join(STRAINS_DIR, strain_dir, genomic_file_name))
-            if cds_file_name.endswith('gz'):
-                cds_file = gzip.open(os.path.join(STRAINS_DIR, strain_dir, cds_file_name), 'rt')
-            else:
-                cds_file = open(os.path.join(STRAINS_DIR, strain_dir, cds_file_name))
-            strain_contigs = get_strain_contigs(genomic_file)
-            strain_genes, strain_pseudogenes = get_strain_pseudogenes(cds_file)
-            df.loc[strain_index]['contigs'] = strain_contigs
-            df.loc[strain_index]['genes'] = strain_genes
-            df.loc[strain_index]['pseudogenes'] = strain_pseudogenes
-        finally:
-            if genomic_file is not None:
-                genomic_file.close()
-            if cds_file is not None:
-                cds_file.close()
-            if strain_index_file is not None:
-                strain_index_file.close()
-    return df
+    store = load_cluster_store(CD_HIT_CLUSTERS_OUTPUT_FILE)
+    incidence = store.strain_cluster_incidence()
+    strains_rows = incidence.shape[0]
+    cluster_strains_num = numpy.asarray(incidence.sum(axis=0)).ravel()
+    core_clusters_mask = cluster_strains_num / store.strains_count >= 0.9
+    core_clusters = incidence @ core_clusters_mask.astype(numpy.int32)
+    singletons = incidence @ (cluster_strains_num == 1).astype(numpy.int32)
+    strain_names = numpy.full(strains_rows, '', dtype=object)
+    contigs = numpy.zeros(strains_rows, dtype=numpy.int64)
+    genes = numpy.zeros(strains_rows, dtype=numpy.int64)
+    pseudogenes = numpy.zeros(strains_rows, dtype=numpy.int64)
+    strain_manifest = load_strain_manifest()
+    for strain_dir, strain_metrics in get_strains_genomic_metrics().items():
+        strain_index = strain_manifest.get(strain_dir)['index']
+        if strain_index >= strains_rows:
+            logger.warning("Strain %s index %d has no clusters, skipping" % (strain_dir, strain_index))
+            continue
+        strain_names[strain_index] = strain_dir
+        contigs[strain_index], genes[strain_index], pseudogenes[strain_index] = strain_metrics
+    return pandas.DataFrame({'strain_name': strain_names,
+                             'total_clusters': incidence.getnnz(axis=1),
+                             'core_clusters': core_clusters,
+                             'missing_core': 100 - (core_clusters / core_clusters_mask.sum() * 100),
+                             'singletons': singletons,
+                             'contigs': contigs,
+                             'pseudogenes': pseudogenes,
+                             'genes': genes})
+
+
+def get_strains_genomic_metrics():
+    """
+    Get the (contigs, genes, pseudogenes) counts of every downloaded strain, scanning in parallel only strains whose
+    genomic or cds files changed (by their size & mtime) since they were cached in STRAIN_METRICS_CACHE_PKL. Strains
+    without a genomic or cds file are skipped
+    """
+    metrics_cache = {}
+    if os.path.exists(STRAIN_METRICS_CACHE_PKL):
+        with open(STRAIN_METRICS_CACHE_PKL, "rb") as f:
+            metrics_cache = pickle.load(f)
+    strains_metrics = {}
+    jobs = []
+    for strain in load_strain_manifest():
+        strain_dir = strain['dir']
+        strain_files = [strain_file_path(strain, GENOMIC_PATTERN), strain_file_path(strain, CDS_FROM_GENOMIC_PATTERN)]
+        if None in strain_files or not all(os.path.exists(f) for f in strain_files):
+            logger.warning("Strain %s has no genomic or cds file, skipping its genomic metrics" % strain_dir)
+            continue
+        files_signature = tuple((os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in strain_files)
+        cached = metrics_cache.get(strain_dir)
+        if cached is not None and cached[0] == files_signature:
+            strains_metrics[strain_dir] = cached[1]
+        else:
+            jobs.append((strain, files_signature, strain_files[0]))
+    logger.info("Scanning genomic & cds files of %d strains, %d strains metrics cached" % (len(jobs), len(strains_metrics)))
+    if jobs:
+        with multiprocessing.Pool(NUMBER_OF_PROCESSES) as pool:
+            for strain_dir, files_signature, strain_metrics in pool.imap_unordered(scan_strain_genomic_metrics, jobs):
+                strains_metrics[strain_dir] = strain_metrics
+                metrics_cache[strain_dir] = (files_signature, strain_metrics)
+    metrics_cache = {strain_dir: metrics_cache[strain_dir] for strain_dir in strains_metrics}
+    if not os.path.exists(PICKLES_DIR):
+        os.makedirs(PICKLES_DIR)
+    with open(STRAIN_METRICS_CACHE_PKL + ".tmp", "wb") as f:
+        pickle.dump(metrics_cache, f)
+    os.replace(STRAIN_METRICS_CACHE_PKL + ".tmp", STRAIN_METRICS_CACHE_PKL)
+    return strains_metrics
+
+
+def scan_strain_genomic_metrics(job):
+    strain, files_signature, genomic_file_path = job
+    with open_fasta_buffer(genomic_file_path) as genomic_buffer:
+        strain_contigs = get_strain_contigs(genomic_buffer)
+    strain_genes, strain_pseudogenes = get_strain_pseudogenes(load_sequence_store(strain))
+    return strain['dir'], files_signature, (strain_contigs, strain_genes, strain_pseudogenes)
 
 
 def get_2nd_stage_stats_per_strain(first_stage_data):
-    logger.info("Creating 1st stage clusters map from CD-HIT output")
-    first_stage_strain_seq_cluster_map, first_stage_clusters_map = create_1st_stage_sequences_clusters_map(CD_HIT_CLUSTERS_OUTPUT_FILE)
-    logger.info("Creating 2nd stage strains & clusters maps from CD-HIT-EST output")
-    second_stage_strains_map, second_stage_clusters_map = create_nucleotide_clusters_map(CD_HIT_EST_CLUSTERS_OUTPUT_FILE)
-    total_strains_count = len(second_stage_strains_map.keys())
-    total_clusters_count = len(second_stage_clusters_map.keys())
-
-    strains_df = pandas.DataFrame(index=range(total_strains_count), columns=('total_pseudogenes', 'pseudogenes_in_clusters_without_reps'))
-    for strain in second_stage_strains_map.values():
-        strains_df.loc[strain.index]['total_pseudogenes'] = first_stage_data.loc[strain.index]['pseudogenes']
-        strains_df.loc[strain.index]['pseudogenes_in_clusters_without_reps'] = 0
-        for cluster in second_stage_clusters_map.values():
-            if not cluster.has_reps() and strain.index in cluster.member_pseudogenes.keys():
-                strains_df.loc[strain.index]['pseudogenes_in_clusters_without_reps'] += len(cluster.member_pseudogenes[strain.index])
-
-    clusters_df = pandas.DataFrame(index=range(total_clusters_count), columns=('total_strains', '1st_stage_reps', 'strains_in_rep_1st_stage_cluster'))
-    for cluster in second_stage_clusters_map.values():
-        clusters_df.loc[cluster.index]['total_strains'] = cluster.get_cluster_strains_num()
-        clusters_df.loc[cluster.index]['1st_stage_reps'] = len(cluster.member_protein_seqs)
-        if len(cluster.member_protein_seqs) == 1:
-            [(representative_strain_index, representative_seq_index)] = cluster.member_protein_seqs.items()
-            representative_cluster_id = first_stage_strain_seq_cluster_map[representative_strain_index].seq_clusters[representative_seq_index[0]]
-            representative_cluster = first_stage_clusters_map[representative_cluster_id]
-            clusters_df.loc[cluster.index]['strains_in_rep_1st_stage_cluster'] = representative_cluster.get_cluster_strains_num()
+    logger.info("Loading 1st stage clusters store from CD-HIT output")
+    first_stage_store = load_cluster_store(CD_HIT_CLUSTERS_OUTPUT_FILE)
+    logger.info("Loading 2nd stage clusters store from CD-HIT-EST output")
+    second_stage_store = load_cluster_store(CD_HIT_EST_CLUSTERS_OUTPUT_FILE)
+    strains_rows = second_stage_store.strains_rows()
+    protein_rows = ~second_stage_store.is_pseudogene
+    cluster_protein_strains = second_stage_store.cluster_strains_num(protein_rows)
+
+    repless_pseudogene_rows = second_stage_store.is_pseudogene & (cluster_protein_strains == 0)[second_stage_store.cluster_id]
+    strains_df = pandas.DataFrame({
+        'total_pseudogenes': first_stage_data['pseudogenes'].reindex(range(strains_rows)).to_numpy(),
+        'pseudogenes_in_clusters_without_reps': numpy.bincount(second_stage_store.strain_index[repless_pseudogene_rows],
+                                                               minlength=strains_rows)})
+
+    clusters_df = pandas.DataFrame({
+        'total_strains': second_stage_store.cluster_strains_num(),
+        '1st_stage_reps': cluster_protein_strains,
+        'strains_in_rep_1st_stage_cluster': get_rep_1st_stage_clusters_stats(first_stage_store, second_stage_store,
+                                                                              cluster_protein_strains == 1)[0]})
     return strains_df, clusters_df
 
 
+def get_rep_1st_stage_clusters_stats(first_stage_store, second_stage_store, clusters_mask):
+    """
+    Join the first protein sequence of each 2nd stage cluster selected by clusters_mask with its 1st stage cluster,
+    returning the 1st stage cluster's strains & proteins count per 2nd stage cluster (NaN for unselected clusters)
+    """
+    protein_rows = numpy.flatnonzero(~second_stage_store.is_pseudogene)
+    rep_clusters, first_protein_positions = numpy.unique(second_stage_store.cluster_id[protein_rows], return_index=True)
+    first_protein_rows = protein_rows[first_protein_positions]
+    selected = clusters_mask[rep_clusters]
+    rep_clusters, first_protein_rows = rep_clusters[selected], first_protein_rows[selected]
+    first_stage_clusters = first_stage_store.seq_clusters(second_stage_store.strain_index[first_protein_rows],
+                                                          second_stage_store.seq_index[first_protein_rows])
+    if (first_stage_clusters == -1).any():
+        raise ValueError("%d 2nd stage protein sequences are missing from the 1st stage clusters"
+                         % (first_stage_clusters == -1).sum())
+    strains_in_rep_cluster = numpy.full(second_stage_store.clusters_count, numpy.nan)
+    proteins_in_rep_cluster = numpy.full(second_stage_store.clusters_count, numpy.nan)
+    strains_in_rep_cluster[rep_clusters] = first_stage_store.cluster_strains_num()[first_stage_clusters]
+    proteins_in_rep_cluster[rep_clusters] = first_stage_store.cluster_sizes()[first_stage_clusters]
+    return strains_in_rep_cluster, proteins_in_rep_cluster
+
+
 def get_1st_stage_strains_per_clusters_stats():
-    logger.info("Creating 1st stage clusters map from CD-HIT output")
-    _, first_stage_clusters_map, total_strains_count, _ = create_strains_clusters_map(CD_HIT_CLUSTERS_OUTPUT_FILE)
-    strains_percentage_per_cluster = []
-    for cluster in first_stage_clusters_map.values():
-        strains_percentage_per_cluster.append((cluster.get_cluster_strains_num() / total_strains_count) * 100)
-    return strains_percentage_per_cluster
+    logger.info("Loading 1st stage clusters store from CD-HIT output")
+    store = load_cluster_store(CD_HIT_CLUSTERS_OUTPUT_FILE)
+    return ((store.cluster_strains_num() / store.strains_count) * 100).tolist()
 
 
 def get_2nd_stage_stats_per_cluster():
-    logger.info("Creating 2nd stage strains & clusters maps from CD-HIT-EST output")
-    type1 = type2 = type3 = type4 = 0
-    first_stage_strain_seq_cluster_map, first_stage_clusters_map = create_1st_stage_sequences_clusters_map(CD_HIT_CLUSTERS_OUTPUT_FILE)
-    second_stage_strains_map, second_stage_clusters_map = create_nucleotide_clusters_map(CD_HIT_EST_CLUSTERS_OUTPUT_FILE)
-    total_clusters_count = len(second_stage_clusters_map.keys())
-    clusters_df = pandas.DataFrame(index=range(total_clusters_count), columns=('protein_seqs', 'strains_of_protein_seqs',
-                                                                               'pseudogenes', 'strains_of_pseudogenes',
-                                                                               'avg_protein_len', 'avg_pseudogene_len',
-                                                                               'cluster_type', 'representative',
-                                                                               'strains_in_rep_1st_stage_cluster',
-                                                                               'proteins_in_rep_1st_stage_cluster'))
-    for cluster in second_stage_clusters_map.values():
-        clusters_df.loc[cluster.index]['protein_seqs'] = len([seq for strain_proteins in cluster.member_protein_seqs.values() for seq in strain_proteins])
-        clusters_df.loc[cluster.index]['strains_of_protein_seqs'] = len(cluster.member_protein_seqs.keys())
-        clusters_df.loc[cluster.index]['pseudogenes'] = len([seq for strain_pseudos in cluster.member_pseudogenes.values() for seq in strain_pseudos])
-        clusters_df.loc[cluster.index]['strains_of_pseudogenes'] = len(cluster.member_pseudogenes.keys())
-        clusters_df.loc[cluster.index]['avg_protein_len'] = cluster.get_avg_protein_seq_len()
-        clusters_df.loc[cluster.index]['avg_pseudogene_len'] = cluster.get_avg_pseudogene_seq_len()
-        if clusters_df.loc[cluster.index]['protein_seqs'] == 1:
-            if clusters_df.loc[cluster.index]['pseudogenes'] > 0:
-                cluster_type = 1
-                type1 += 1
-            else:
-                cluster_type = 3
-                type3 += 1
-            [(representative_strain_index, representative_seq_index)] = cluster.member_protein_seqs.items()
-            representative_cluster_id = first_stage_strain_seq_cluster_map[representative_strain_index].seq_clusters[representative_seq_index[0]]
-            representative_cluster = first_stage_clusters_map[representative_cluster_id]
-            clusters_df.loc[cluster.index]['strains_in_rep_1st_stage_cluster'] = representative_cluster.get_cluster_strains_num()
-            clusters_df.loc[cluster.index]['proteins_in_rep_1st_stage_cluster'] = representative_cluster.get_cluster_proteins_num()
-        elif clusters_df.loc[cluster.index]['protein_seqs'] > 1:
-            cluster_type = 4
-            type4 += 1
-        else:
-            cluster_type = 2
-            type2 += 1
-        clusters_df.loc[cluster.index]['cluster_type'] = cluster_type
-        clusters_df.loc[cluster.index]['representative'] = cluster.representative
+    logger.info("Loading 1st & 2nd stage clusters stores from CD-HIT & CD-HIT-EST output")
+    first_stage_store = load_cluster_store(CD_HIT_CLUSTERS_OUTPUT_FILE)
+    second_stage_store = load_cluster_store(CD_HIT_EST_CLUSTERS_OUTPUT_FILE)
+    clusters_count = second_stage_store.clusters_count
+    cluster_id = second_stage_store.cluster_id
+    pseudogene_rows = numpy.asarray(second_stage_store.is_pseudogene)
+    protein_rows = ~pseudogene_rows
+    seq_len = second_stage_store.length.astype(numpy.int64)
+
+    protein_seqs = numpy.bincount(cluster_id[protein_rows], minlength=clusters_count)
+    strains_of_protein_seqs = second_stage_store.cluster_strains_num(protein_rows)
+    pseudogenes = numpy.bincount(cluster_id[pseudogene_rows], minlength=clusters_count)
+    strains_of_pseudogenes = second_stage_store.cluster_strains_num(pseudogene_rows)
+    total_protein_len = numpy.bincount(cluster_id[protein_rows], weights=seq_len[protein_rows], minlength=clusters_count)
+    total_pseudogene_len = numpy.bincount(cluster_id[pseudogene_rows], weights=seq_len[pseudogene_rows], minlength=clusters_count)
+
+    cluster_type = numpy.select([(protein_seqs == 1) & (pseudogenes > 0), protein_seqs == 0, protein_seqs == 1],
+                                [1, 2, 3], default=4)
+    strains_in_rep_cluster, proteins_in_rep_cluster = get_rep_1st_stage_clusters_stats(first_stage_store,
+                                                                                       second_stage_store,
+                                                                                       protein_seqs == 1)
+    representative_rows = numpy.flatnonzero(second_stage_store.is_representative)
+    representative = pandas.Series('', index=range(clusters_count), dtype=object)
+    representative[cluster_id[representative_rows]] = \
+        ("Strain idx: " + pandas.Series(second_stage_store.strain_index[representative_rows]).astype(str)
+         + ", Seq idx: " + pandas.Series(second_stage_store.seq_index[representative_rows]).astype(str)
+         + ", Pseudogene: " + pandas.Series(pseudogene_rows[representative_rows]).astype(str)).to_numpy()
+
+    clusters_df = pandas.DataFrame({
+        'protein_seqs': protein_seqs,
+        'strains_of_protein_seqs': strains_of_protein_seqs,
+        'pseudogenes': pseudogenes,
+        'strains_of_pseudogenes': strains_of_pseudogenes,
+        'avg_protein_len': numpy.round(numpy.divide(total_protein_len, strains_of_protein_seqs,
+                                                    out=numpy.zeros(clusters_count), where=strains_of_protein_seqs > 0)).astype(numpy.int64),
+        'avg_pseudogene_len': numpy.round(numpy.divide(total_pseudogene_len, strains_of_pseudogenes,
+                                                       out=numpy.zeros(clusters_count), where=strains_of_pseudogenes > 0)).astype(numpy.int64),
+        'cluster_type': cluster_type,
+        'representative': representative,
+        'strains_in_rep_1st_stage_cluster': strains_in_rep_cluster,
+        'proteins_in_rep_1st_stage_cluster': proteins_in_rep_cluster})
+    type_counts = numpy.bincount(cluster_type, minlength=5)
     logger.info("Cluster type amounts:")
-    logger.info("Type 1 (1 protein + pseudogenes): %d" % type1)
-    logger.info("Type 2 (0 proteins + pseudogenes): %d" % type2)
-    logger.info("Type 3 (1 protein + 0 pseudogenes): %d" % type3)
-    logger.info("Type 4 (multiple proteins +- pseudogenes): %d" % type4)
+    logger.info("Type 1 (1 protein + pseudogenes): %d" % type_counts[1])
+    logger.info("Type 2 (0 proteins + pseudogenes): %d" % type_counts[2])
+    logger.info("Type 3 (1 protein + 0 pseudogenes): %d" % type_counts[3])
+    logger.info("Type 4 (multiple proteins +- pseudogenes): %d" % type_counts[4])
 
     return clusters_df
 
@@ -385,62 +303,66 @@ def get_pseudogenes_without_blast_hits_fasta():
 
 
 def get_core_clusters():
-    first_stage_strain_seq_cluster_map, first_stage_clusters_map = create_1st_stage_sequences_clusters_map(
-        CD_HIT_CLUSTERS_OUTPUT_FILE)
-    total_strains_count = len(first_stage_strain_seq_cluster_map)
+    store = load_cluster_store(CD_HIT_CLUSTERS_OUTPUT_FILE)
+    total_strains_count = store.strains_count
+    core_clusters = {}
     core_clusters_multiple_strain_seqs = {}
-    clusters_to_remove = []
-    core_clusters = {ind: cluster for (ind, cluster) in first_stage_clusters_map.items() if cluster.get_cluster_strains_num() / total_strains_count >= 0.9}
-    for cluster in core_clusters.values():
-        if not all(i == 1 for i in cluster.member_strains.values()):
-            core_clusters_multiple_strain_seqs[cluster.index] = core_clusters[cluster.index]
-    for index in core_clusters_multiple_strain_seqs.keys():
-        core_clusters.pop(index)
-    for cluster in core_clusters_multiple_strain_seqs.values():
-        strains_to_remove = [s for s in cluster.member_strains.keys() if cluster.member_strains[s] > 1]
-        for strain in strains_to_remove:
-            cluster.member_strains.pop(strain)
-        if cluster.get_cluster_strains_num() / total_strains_count < 0.9:
-            clusters_to_remove.append(cluster.index)
-    for cluster_index in clusters_to_remove:
-        core_clusters_multiple_strain_seqs.pop(cluster_index)
+    for cluster_index in numpy.flatnonzero(store.core_clusters_mask()).tolist():
+        members = store.cluster_members(cluster_index)
+        cluster = Cluster(cluster_index)
+        for strain_index, seq_index in zip(store.strain_index[members].tolist(), store.seq_index[members].tolist()):
+            cluster.add_strain(strain_index)
+            cluster.add_strain_seq(strain_index, seq_index)
+        if all(i == 1 for i in cluster.member_strains.values()):
+            core_clusters[cluster_index] = cluster
+        else:
+            strains_to_remove = [s for s in cluster.member_strains.keys() if cluster.member_strains[s] > 1]
+            for strain in strains_to_remove:
+                cluster.member_strains.pop(strain)
+            if cluster.get_cluster_strains_num() / total_strains_count >= 0.9:
+                core_clusters_multiple_strain_seqs[cluster_index] = cluster
     return core_clusters, core_clusters_multiple_strain_seqs
 
 
 def export_protein_clusters_to_nucleotide_fasta_files():
-    import pickle
-    if os.path.exists(PROTEIN_CORE_CLUSTERS_PKL):
-        logger.info("Loading protein core clusters from pickle")
-        with open(PROTEIN_CORE_CLUSTERS_PKL, "rb") as f:
-            core_clusters = pickle.load(f)
-    else:
-        logger.info("Generating protein core clusters")
-        core_clusters, _ = get_core_clusters()
-        with open(PROTEIN_CORE_CLUSTERS_PKL, "wb") as f:
-            pickle.dump(core_clusters, f)
-    if not os.path.exists(CLUSTERS_NT_SEQS_DIR):
-        os.makedirs(CLUSTERS_NT_SEQS_DIR)
-
-    for strain_index, strain_dir, cds_file in iterate_strains_cds():
-        strain_cds = list(SeqIO.parse(cds_file, FASTA_FILE_TYPE))
-        logger.info("Parsing strain %s index %d" % (str(strain_dir), strain_index))
-        for cluster in core_clusters.values():
-            if strain_index in cluster.member_strains_seqs.keys():
-                strain_protein_seq_index = cluster.member_strains_seqs[strain_index][0]
-                strain_protein_seq = strain_cds[strain_protein_seq_index - 1]
-                strain_protein_seq.description = "[" + str(strain_index) + "][" + str(strain_protein_seq_index) + "]" + strain_protein_seq.description
-                cluster.member_strains_seqs[strain_index] = strain_protein_seq
-
-        if cds_file is not None:
-            cds_file.close()
-
-    for cluster in core_clusters.values():
-        logger.info("Saving cluster %d to file" % cluster.index)
-        cluster_protein_nts_file_path = os.path.join(CLUSTERS_NT_SEQS_DIR, "cluster_" + str(cluster.index))
-        cluster_protein_nts_file = open(cluster_protein_nts_file_path, "a+")
-        cluster_seqs = [seq for idx, seq in sorted(cluster.member_strains_seqs.items())]
-        SeqIO.write(cluster_seqs, cluster_protein_nts_file, FASTA_FILE_TYPE)
-        cluster_protein_nts_file.close()
+    """
+    Export the cds of every single copy protein core cluster to a fasta file per cluster, streaming each strain's
+    sequence store once and appending its sequences to their clusters' files. Files are written to a temp dir which
+    then replaces CLUSTERS_NT_SEQS_DIR
+    """
+    logger.info("Generating protein core clusters")
+    store = load_cluster_store(CD_HIT_CLUSTERS_OUTPUT_FILE)
+    strains_core_seqs = get_strains_core_clusters_seqs(store)
+    with building_dir(CLUSTERS_NT_SEQS_DIR) as tmp_clusters_dir, FastaFileSet(tmp_clusters_dir) as clusters_files:
+        for strain, strain_sequence_store in iterate_strains_sequence_stores():
+            strain_index = strain['index']
+            if strain_index not in strains_core_seqs:
+                continue
+            logger.info("Parsing strain %s index %d" % (str(strain['dir']), strain_index))
+            for cluster_index, seq_index in zip(*strains_core_seqs.pop(strain_index)):
+                header = strain_sequence_store.header(strain_sequence_store.row(seq_index))
+                description = "[" + str(strain_index) + "][" + str(seq_index) + "]" + header
+                clusters_files.write("cluster_" + str(cluster_index), fasta_title(header.split(None, 1)[0], description),
+                                     strain_sequence_store.seq(strain_sequence_store.row(seq_index)))
+        logger.info("Saved %d sequences of %d core clusters" % (clusters_files.records_written,
+                                                                len(clusters_files.file_names())))
+    if strains_core_seqs:
+        logger.warning("Strains %s of the core clusters are missing from the strain manifest" % sorted(strains_core_seqs))
+
+
+def get_strains_core_clusters_seqs(store):
+    """
+    Inverted index of the core clusters containing exactly one sequence of each member strain, from strain index to
+    the (cluster ids, seq indices) of its sequences in these clusters, ordered by cluster id
+    """
+    single_copy_core_clusters = store.core_clusters_mask() & (store.cluster_sizes() == store.cluster_strains_num())
+    rows = numpy.flatnonzero(single_copy_core_clusters[store.cluster_id])
+    rows = rows[numpy.lexsort((store.cluster_id[rows], store.strain_index[rows]))]
+    strain_index, cluster_id, seq_index = store.strain_index[rows], store.cluster_id[rows], store.seq_index[rows]
+    strains, starts = numpy.unique(strain_index, return_index=True)
+    ends = numpy.append(starts[1:], len(rows))
+    return {strain: (cluster_id[start:end].tolist(), seq_index[start:end].tolist())
+            for strain, start, end in zip(strains.tolist(), starts.tolist(), ends.tolist())}
 
 
 def shorten_seq_names_in_clusters():
@@ -458,28 +380,7 @@ def shorten_seq_names_in_clusters():
 
 
 def build_strain_names_map():
-    strain_names_map = {}
-    downloaded_strains = os.listdir(STRAINS_DIR)
-    for strain_dir in downloaded_strains:
-        strain_index = get_strain_index(strain_dir)
-        strain_names_map[strain_index] = strain_dir
-    return strain_names_map
-
-
-def iterate_strains_cds():
-    """Iterate over the CDS file for each downloaded strain and return the strain index and cds file handle"""
-    downloaded_strains = os.listdir(STRAINS_DIR)
-    for strain_dir in downloaded_strains:
-        strain_index = get_strain_index(strain_dir)
-        strain_dir_files = os.listdir(os.path.join(STRAINS_DIR, strain_dir))
-        cds_file_name = [f for f in strain_dir_files if CDS_FROM_GENOMIC_PATTERN in f][0]
-        if cds_file_name is None:
-            raise RuntimeError("Failed to find a cds file for strain %s" % str(strain_dir))
-        if cds_file_name.endswith('gz'):
-            cds_file = gzip.open(os.path.join(STRAINS_DIR, strain_dir, cds_file_name), 'rt')
-        else:
-            cds_file = open(os.path.join(STRAINS_DIR, strain_dir, cds_file_name))
-        yield strain_index, strain_dir, cds_file
+    return load_strain_manifest().names_map()
 
 
 def get_strains_mlst_genes():
@@ -487,26 +388,26 @@ def get_strains_mlst_genes():
     for gene in MLST_GENES:
         mlst_variants_records[gene] = list(SeqIO.parse(open(gene + ".fas"), FASTA_FILE_TYPE))
     strains_mlst_vectors = pandas.DataFrame(index=range(STRAINS_COUNT), columns=MLST_GENES)
-    for strain_index, strain_dir, cds_file in iterate_strains_cds():
-        strain_cds = SeqIO.parse(cds_file, FASTA_FILE_TYPE)
+    for strain, strain_sequence_store in iterate_strains_sequence_stores():
+        strain_index = strain['index']
         genes_found = 0
-        for strain_gene in strain_cds:
+        for row, header, strain_gene_seq in strain_sequence_store.records():
             if genes_found == len(MLST_GENES):
                 break
+            strain_gene_id = header.split(None, 1)[0]
             for mlst_gene in MLST_GENES:
-                if mlst_gene in strain_gene.description:
-                    logger.info("found mlst gene " + mlst_gene + " in strain " + strain_gene.id + ", idx " + strain_index)
+                if mlst_gene in header:
+                    logger.info("found mlst gene %s in strain %s, idx %d" % (mlst_gene, strain_gene_id, strain_index))
                     genes_found += 1
                     gene_variants = mlst_variants_records[mlst_gene]
                     for variant in gene_variants:
-                        if str(variant.seq) in str(strain_gene.seq):
-                            logger.info("found match: gene " + mlst_gene + ", variant " + variant.id + ", seq: " + variant.seq + ""
-                                         "contained in strain gene" + strain_gene.id + ", seq: " + strain_gene.seq)
+                        if str(variant.seq) in strain_gene_seq:
+                            logger.info("found match: gene %s, variant %s, seq: %s contained in strain gene %s, seq: %s"
+                                        % (mlst_gene, variant.id, variant.seq, strain_gene_id, strain_gene_seq))
                             variant_id = variant.id[5:]
-                            strains_mlst_vectors.loc[strain_index][mlst_gene] = variant_id
+                            strains_mlst_vectors.loc[strain_index, mlst_gene] = variant_id
                             break
                     break
-        cds_file.close()
     return strains_mlst_vectors
 
 #TODO compare each strain vector to allelic profiles table - pandas.read_table(MLST_ALLELIC_PROFILE_PATH)
@@ -16,7 +16,6 @@ width = 0.35
 def create_1st_stage_charts(stats_df):
     if not os.path.exists(FIRST_STAGE_GRAPHS_DIR):
         os.mkdir(FIRST_STAGE_GRAPHS_DIR)
-    os.chdir(FIRST_STAGE_GRAPHS_DIR)
 
     logger.info("Plotting clusters per strain")
     set_labels_font_size()
@@ -25,7 +24,7 @@ def create_1st_stage_charts(stats_df):
     plt.xlabel("Strains #")
     plt.ylabel("Clusters #")
     plt.title("Clusters per strain")
-    plt.savefig('clusters_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'clusters_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting core clusters per strain")
@@ -35,7 +34,7 @@ def create_1st_stage_charts(stats_df):
     plt.xlabel("Strains #")
     plt.ylabel("Core Clusters #")
     plt.title("Core Clusters per strain")
-    plt.savefig('core_clusters_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'core_clusters_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting missing core clusters per strain")
@@ -45,7 +44,7 @@ def create_1st_stage_charts(stats_df):
     plt.xlabel("Strains #")
     plt.ylabel("Missing Core %")
     plt.title("Missing Core % per strain")
-    plt.savefig('missing_core_clusters_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'missing_core_clusters_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting singleton clusters per strain")
@@ -55,7 +54,7 @@ def create_1st_stage_charts(stats_df):
     plt.xlabel("Strains #")
     plt.ylabel("Singletons #")
     plt.title("Singletons per strain")
-    plt.savefig('singleton_clusters_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'singleton_clusters_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting pseudogenes per strain")
@@ -65,7 +64,7 @@ def create_1st_stage_charts(stats_df):
     plt.xlabel("Strains #")
     plt.ylabel("Pseudogenes #")
     plt.title("Pseudogenes per strain")
-    plt.savefig('pseudogenes_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'pseudogenes_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting contigs per strain")
@@ -75,7 +74,7 @@ def create_1st_stage_charts(stats_df):
     plt.xlabel("Strains #")
     plt.ylabel("Contigs #")
     plt.title("Contigs per strain")
-    plt.savefig('contigs_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'contigs_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting contigs VS singletons per strain")
@@ -87,7 +86,7 @@ def create_1st_stage_charts(stats_df):
     plt.ylabel("Contigs # / Singletons #")
     plt.title("Contigs VS Singletons per strain")
     plt.legend((chart1[0], chart2[0]), ("Contigs #", "Singletons #"))
-    plt.savefig('contigs_vs_singletons_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'contigs_vs_singletons_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting contigs VS missing core % per strain")
@@ -99,7 +98,7 @@ def create_1st_stage_charts(stats_df):
     plt.ylabel("Contigs # / Missing Core %")
     plt.title("Contigs VS Missing Core % per strain")
     plt.legend((chart1[0], chart2[0]), ("Contigs #", "Missing Core %"))
-    plt.savefig('contigs_vs_missing_core_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'contigs_vs_missing_core_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting contigs VS pseudogenes per strain")
@@ -111,7 +110,7 @@ def create_1st_stage_charts(stats_df):
     plt.ylabel("Contigs # / Pseudogenes #")
     plt.title("Contigs VS Pseudogenes per strain")
     plt.legend((chart1[0], chart2[0]), ("Pseudogenes #", "Contigs #"))
-    plt.savefig('contigs_vs_pseudogenes_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'contigs_vs_pseudogenes_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting singletons VS missing core % per strain")
@@ -123,7 +122,7 @@ def create_1st_stage_charts(stats_df):
     plt.ylabel("Singletons # / Missing Core %")
     plt.title("Singletons VS Missing core % per strain")
     plt.legend((chart1[0], chart2[0]), ("Singletons #", "Missing Core %"))
-    plt.savefig('singletons_vs_missing_core_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'singletons_vs_missing_core_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting pseudogenes VS missing core % per strain")
@@ -135,7 +134,7 @@ def create_1st_stage_charts(stats_df):
     plt.ylabel("Pseudogenes # / Missing Core %")
     plt.title("strains to pseudogenes VS missing core bar chart")
     plt.legend((chart1[0], chart2[0]), ("Pseudogenes #", "Missing Core %"))
-    plt.savefig('pseudogenes_vs_missing_core_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'pseudogenes_vs_missing_core_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting pseudogenes VS singletons per strain")
@@ -147,7 +146,7 @@ def create_1st_stage_charts(stats_df):
     plt.ylabel("Pseudogenes / Singletons")
     plt.title("strains to pseudogenes VS singletons bar chart")
     plt.legend((chart1[0], chart2[0]), ("Pseudogenes", "Singletons"))
-    plt.savefig('pseudogenes_vs_singletons_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'pseudogenes_vs_singletons_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting % of total strains per number of clusters")
@@ -157,14 +156,13 @@ def create_1st_stage_charts(stats_df):
     plt.xlabel("% of total strains")
     plt.ylabel("Clusters #")
     plt.title("% of total strains per clusters histogram")
-    plt.savefig('percentage_of_total_strains_per_clusters_hist.pdf', format="pdf")
+    plt.savefig(os.path.join(FIRST_STAGE_GRAPHS_DIR, 'percentage_of_total_strains_per_clusters_hist.pdf'), format="pdf")
     plt.close()
 
 
 def create_2nd_stage_charts(strains_df, clusters_df):
     if not os.path.exists(SECOND_STAGE_GRAPHS_DIR):
         os.mkdir(SECOND_STAGE_GRAPHS_DIR)
-    os.chdir(SECOND_STAGE_GRAPHS_DIR)
 
     logger.info("Plotting pseudogenes VS pseudogenes in clusters without reps per strain")
     set_labels_font_size()
@@ -175,7 +173,7 @@ def create_2nd_stage_charts(strains_df, clusters_df):
     plt.ylabel("Total Pseudogenes /\nPseudogenes in clusters without protein representatives")
     plt.title("Total strain pseudogenes VS Strain pseudogenes in clusters\nwithout protein representatives per strain")
     plt.legend((chart1[0], chart2[0]), ("Total Strain Pseudogenes", "Strain Pseudogenes in clusters\nwithout protein representatives"))
-    plt.savefig('pseudogenes_vs_pseudogenes_in_repless_clusters_per_strain.pdf', format="pdf")
+    plt.savefig(os.path.join(SECOND_STAGE_GRAPHS_DIR, 'pseudogenes_vs_pseudogenes_in_repless_clusters_per_strain.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting strains per 2nd stage cluster")
@@ -185,7 +183,7 @@ def create_2nd_stage_charts(strains_df, clusters_df):
     plt.xlabel("Clusters")
     plt.ylabel("Strains")
     plt.title("Total strains per 2nd stage cluster")
-    plt.savefig('strains_per_2nd_stage_cluster.pdf', format="pdf")
+    plt.savefig(os.path.join(SECOND_STAGE_GRAPHS_DIR, 'strains_per_2nd_stage_cluster.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting strains per 2nd stage clusters without protein sequences")
@@ -196,7 +194,7 @@ def create_2nd_stage_charts(strains_df, clusters_df):
     plt.xlabel("Clusters")
     plt.ylabel("Strains")
     plt.title("Total strains per 2nd stage cluster without protein sequences")
-    plt.savefig('strains_per_2nd_stage_cluster_without_protein_sequences.pdf', format="pdf")
+    plt.savefig(os.path.join(SECOND_STAGE_GRAPHS_DIR, 'strains_per_2nd_stage_cluster_without_protein_sequences.pdf'), format="pdf")
     plt.close()
 
     logger.info("Plotting strains in protein sequence's 1st stage cluster VS pseudogenes in 2nd stage cluster")
@@ -209,7 +207,7 @@ def create_2nd_stage_charts(strains_df, clusters_df):
     plt.ylabel("Strains in protein rep 1st stage cluster /\nPseudogenes")
     plt.title("Strains in protein rep 1st stage cluster VS\nPseudogenes per 2nd stage cluster")
     plt.legend((chart1[0], chart2[0]), ("Strains in protein rep\n1st stage cluster", "Pseudogenes in 2nd\nstage cluster"))
-    plt.savefig('protein_rep_1st_cluster_strains_vs_pseudogenes_per_2nd_stage_cluster.pdf', format="pdf")
+    plt.savefig(os.path.join(SECOND_STAGE_GRAPHS_DIR, 'protein_rep_1st_cluster_strains_vs_pseudogenes_per_2nd_stage_cluster.pdf'), format="pdf")
     plt.close()
 
 
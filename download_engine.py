@@ -0,0 +1,295 @@
+import asyncio
+import ftplib
+import hashlib
+import http.client
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from constants import DOWNLOAD_CONCURRENCY, DOWNLOAD_HOST_RATE, DOWNLOAD_MAX_ATTEMPTS, DOWNLOAD_BACKOFF_BASE, \
+    DOWNLOAD_BACKOFF_MAX, DOWNLOAD_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+RETRYABLE_ERRORS = (OSError, EOFError, ftplib.error_temp, ftplib.error_reply, http.client.HTTPException)
+
+
+class TransferError(Exception):
+    """A transfer failure which may succeed when retried"""
+    pass
+
+
+class ChecksumMismatchError(TransferError):
+    pass
+
+
+class FTPConnection:
+    def __init__(self, host, port, timeout):
+        self._ftp = ftplib.FTP()
+        self._ftp.connect(host, port or ftplib.FTP_PORT, timeout=timeout)
+        self._ftp.login()
+
+    def retrieve(self, path, offset, write_block, restart):
+        """
+        Stream a remote file from offset into write_block, calling restart() and streaming from the start instead
+        when the server refuses to resume
+        """
+        try:
+            if offset:
+                try:
+                    self._ftp.retrbinary("RETR " + path, write_block, DOWNLOAD_BLOCK_SIZE, rest=offset)
+                    return
+                except ftplib.error_perm:
+                    restart()
+            self._ftp.retrbinary("RETR " + path, write_block, DOWNLOAD_BLOCK_SIZE)
+        except ftplib.error_perm as e:
+            raise FileNotFoundError("%s: %s" % (path, e))
+
+    def close(self):
+        try:
+            self._ftp.quit()
+        except RETRYABLE_ERRORS:
+            self._ftp.close()
+
+
+class HTTPConnection:
+    def __init__(self, scheme, host, port, timeout):
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        self._http = connection_class(host, port, timeout=timeout)
+
+    def retrieve(self, path, offset, write_block, restart):
+        """Stream a remote file from offset into write_block using a Range request, restarting if it is ignored"""
+        headers = {'Range': "bytes=%d-" % offset} if offset else {}
+        self._http.request("GET", path, headers=headers)
+        response = self._http.getresponse()
+        if response.status == 416:
+            response.read()
+            restart()
+            return self.retrieve(path, 0, write_block, restart)
+        if response.status == 404:
+            response.read()
+            raise FileNotFoundError("%s: HTTP 404" % path)
+        if response.status not in (200, 206):
+            response.read()
+            raise TransferError("%s: HTTP %d %s" % (path, response.status, response.reason))
+        if offset and response.status == 200:
+            restart()
+        for block in iter(lambda: response.read(DOWNLOAD_BLOCK_SIZE), b""):
+            write_block(block)
+        if response.length:
+            # http.client ends the body at a dropped connection, keep the partial file to resume from
+            raise TransferError("%s: connection closed with %d bytes left" % (path, response.length))
+
+    def close(self):
+        self._http.close()
+
+
+def open_connection(scheme, host, port, timeout):
+    if scheme == "ftp":
+        return FTPConnection(host, port, timeout)
+    if scheme in ("http", "https"):
+        return HTTPConnection(scheme, host, port, timeout)
+    raise ValueError("Unsupported download url scheme %s" % scheme)
+
+
+class ConnectionPool:
+    """Reusable connections to a single host, at most size of them in use at a time"""
+    def __init__(self, scheme, host, port, size, timeout):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle = []
+        self._slots = asyncio.Semaphore(size)
+
+    async def acquire(self, executor):
+        await self._slots.acquire()
+        if self._idle:
+            return self._idle.pop()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, open_connection, self.scheme, self.host,
+                                                                    self.port, self.timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, connection, reusable=True):
+        if reusable:
+            self._idle.append(connection)
+        else:
+            connection.close()
+        self._slots.release()
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+class RateLimiter:
+    """Spaces out the requests made to a host so that at most rate requests start per second"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next_request = 0.0
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        delay = self._next_request - now
+        self._next_request = max(now, self._next_request) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class TransferMetrics:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.retries = 0
+        self.failures = 0
+        self.start_time = time.monotonic()
+
+    def throughput(self):
+        """Average throughput in MB/s since the metrics were created"""
+        elapsed = time.monotonic() - self.start_time
+        return self.bytes / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return "%d files, %.1f MB in %.1f seconds (%.2f MB/s), %d retries, %d failures" % \
+               (self.files, self.bytes / (1024 * 1024), time.monotonic() - self.start_time, self.throughput(),
+                self.retries, self.failures)
+
+
+class TransferEngine:
+    """
+    Asyncio download engine over ftp://, http:// & https:// urls. Blocking transfers run in a thread pool on pooled
+    per-host connections, with at most concurrency transfers in flight regardless of the number of CPUs, requests
+    to each host rate limited, and failed transfers retried with exponential backoff
+    """
+    def __init__(self, concurrency=DOWNLOAD_CONCURRENCY, host_rate=DOWNLOAD_HOST_RATE,
+                 max_attempts=DOWNLOAD_MAX_ATTEMPTS, backoff_base=DOWNLOAD_BACKOFF_BASE,
+                 backoff_max=DOWNLOAD_BACKOFF_MAX, timeout=DOWNLOAD_TIMEOUT):
+        self.concurrency = concurrency
+        self.host_rate = host_rate
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.metrics = TransferMetrics()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._transfers = asyncio.Semaphore(concurrency)
+        self._pools = {}
+        self._rate_limiters = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.close_connections)
+        self._executor.shutdown()
+
+    def close_connections(self):
+        for pool in self._pools.values():
+            pool.close()
+
+    def _get_pool(self, url_parts):
+        key = (url_parts.scheme, url_parts.hostname, url_parts.port)
+        if key not in self._pools:
+            self._pools[key] = ConnectionPool(url_parts.scheme, url_parts.hostname, url_parts.port, self.concurrency,
+                                              self.timeout)
+            self._rate_limiters[key] = RateLimiter(self.host_rate)
+        return self._pools[key], self._rate_limiters[key]
+
+    async def fetch_text(self, url):
+        """Download a small remote text file into memory"""
+        blocks = []
+
+        def restart():
+            blocks.clear()
+
+        def download(connection, path):
+            blocks.clear()
+            connection.retrieve(path, 0, blocks.append, restart)
+            return b"".join(blocks)
+
+        data = await self._transfer(url, download)
+        self.metrics.files += 1
+        self.metrics.bytes += len(data)
+        return data.decode()
+
+    async def fetch_file(self, url, local_file_path, expected_md5=None):
+        """
+        Download a remote file to local_file_path, resuming a partial local file and hashing the data as it streams.
+        Returns the size & md5 of the complete file, retrying the download when the md5 does not match expected_md5
+        """
+        def download(connection, path):
+            return download_to_file(connection, path, local_file_path, expected_md5)
+
+        file_info = await self._transfer(url, download)
+        self.metrics.files += 1
+        self.metrics.bytes += file_info.pop('transferred')
+        return file_info
+
+    async def _transfer(self, url, download):
+        url_parts = urlsplit(url)
+        pool, rate_limiter = self._get_pool(url_parts)
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_attempts):
+            async with self._transfers:
+                await rate_limiter.wait()
+                connection = None
+                try:
+                    connection = await pool.acquire(self._executor)
+                    result = await loop.run_in_executor(self._executor, download, connection, url_parts.path)
+                    pool.release(connection)
+                    return result
+                except FileNotFoundError:
+                    if connection is not None:
+                        pool.release(connection)
+                    self.metrics.failures += 1
+                    raise
+                except (TransferError,) + RETRYABLE_ERRORS as e:
+                    if connection is not None:
+                        await loop.run_in_executor(self._executor, pool.release, connection, False)
+                    if attempt + 1 == self.max_attempts:
+                        self.metrics.failures += 1
+                        raise TransferError("Failed downloading %s after %d attempts (%s)" % (url, attempt + 1, e))
+                    self.metrics.retries += 1
+                    delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * (0.5 + random.random() / 2)
+                    logger.warning("Failed downloading %s (%s), retrying in %.1f seconds" % (url, e, delay))
+            await asyncio.sleep(delay)
+
+
+def download_to_file(connection, path, local_file_path, expected_md5=None):
+    file_hash = hashlib.md5()
+    offset = 0
+    if os.path.exists(local_file_path):
+        with open(local_file_path, 'rb') as local_file:
+            for block in iter(lambda: local_file.read(DOWNLOAD_BLOCK_SIZE), b""):
+                file_hash.update(block)
+                offset += len(block)
+        if expected_md5 and file_hash.hexdigest() == expected_md5:
+            return {'size': offset, 'md5': expected_md5, 'transferred': 0}
+
+    transferred = 0
+    with open(local_file_path, 'ab') as local_file:
+        def write_block(block):
+            nonlocal transferred
+            local_file.write(block)
+            file_hash.update(block)
+            transferred += len(block)
+
+        def restart():
+            nonlocal file_hash
+            local_file.seek(0)
+            local_file.truncate()
+            file_hash = hashlib.md5()
+
+        connection.retrieve(path, offset, write_block, restart)
+        size = local_file.tell()
+    if expected_md5 and file_hash.hexdigest() != expected_md5:
+        os.remove(local_file_path)
+        raise ChecksumMismatchError("md5 of %s does not match the expected checksum" % path)
+    return {'size': size, 'md5': file_hash.hexdigest(), 'transferred': transferred}
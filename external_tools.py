@@ -1,146 +1,236 @@
+import json
 import logging
 import multiprocessing
 import os
-from subprocess import run
+from math import ceil
 
-from Bio import SeqIO, AlignIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
-
-from constants import CD_HIT_CLUSTER_REPS_OUTPUT_FILE, CLUSTERS_NT_SEQS_DIR, CLUSTERS_ALIGNMENTS_DIR, \
-    NUMBER_OF_PROCESSES, FASTA_FILE_TYPE, ALIGNMENTS_FOR_TREE_DIR, DATA_DIR, ALIGNMENT_STRAIN_PATTERN, STRAINS_COUNT
+from constants import CD_HIT_CLUSTER_REPS_OUTPUT_FILE, CD_HIT_CLUSTERS_OUTPUT_FILE, CLUSTERS_NT_SEQS_DIR, \
+    CLUSTERS_ALIGNMENTS_DIR, NUMBER_OF_PROCESSES, ALIGNMENTS_FOR_TREE_DIR, ALIGNMENT_STRAIN_PATTERN, \
+    CONCATENATED_ALIGNMENT_PATH, CONCATENATED_ALIGNMENT_PARTITIONS_PATH, SUPERMATRIX_DIR, FILTERED_TREE_ALIGNMENT_PATH, \
+    ALIGNMENT_LOGS_DIR, ALIGNMENT_JOBS_SUMMARY_PATH, ALIGNMENT_MAX_THREADS, ALIGNMENT_COST_PER_THREAD, \
+    INCREMENTAL_CLUSTERING_DIR, DUPLICATES_FILE_SUFFIX, PROTEIN_CLUSTERING_IDENTITY, CDS_CLUSTERING_IDENTITY, \
+    CD_HIT_MEMORY_BUDGET
+from alignment_matrix import read_fasta_alignment, alignment_sort_key
+from cd_hit_runner import cd_hit_options, run_cd_hit
 from data_analysis import build_strain_names_map
+from fasta_io import open_fasta_buffer, iter_fasta_headers
+from fs_utils import building_dir
+from incremental_clustering import get_new_strain_indices, cluster_proteins_incrementally, save_clustered_strains
 from logging_config import worker_configurer
+from sequence_dedup import expand_duplicate_members
+from strain_manifest import load_strain_manifest
+from supermatrix import concatenate_alignments, load_supermatrix
+from tool_cache import ToolCache
+from tool_scheduler import ToolScheduler, ToolJob, ToolCommand
+
+MAFFT_OPTIONS = ["--auto"]
+GBLOCKS_OPTIONS = ["-t=d", "-b5=a", "-p=n"]
 
 
-def perform_clustering_on_proteins(aggregated_proteins_file_path):
-    """Run the CD-HIT program to perform clustering on the strains"""
+def perform_clustering_on_proteins(aggregated_proteins_file_path, incremental=True,
+                                   identity=PROTEIN_CLUSTERING_IDENTITY, word_size=None,
+                                   memory_budget=CD_HIT_MEMORY_BUDGET):
+    """
+    Run the CD-HIT program to perform clustering on the strains. When only new strains were added since the last
+    clustering, only their proteins are clustered into the existing clusters, unless incremental is False. Proteins
+    collapsed as duplicates of the clustered proteins are then added back to their clusters
+    """
     logger = logging.getLogger()
-    logger.info("Running CD-HIT on combined proteins file to create clustering")
-    cd_hit_args = " ".join(["cd-hit", "-i", aggregated_proteins_file_path, "-o", CD_HIT_CLUSTER_REPS_OUTPUT_FILE, "-c 0.70",
-                   "-n 5", "-M 16000", "-g 1", "-p 1"])
-    cd_hit_return_code = run(cd_hit_args, shell=True).returncode
-    logger.info("Finished running CD-HIT with return code %d" % cd_hit_return_code)
-    return cd_hit_return_code
+    options = cd_hit_options("cd-hit", identity, word_size)
+    new_strain_indices = get_new_strain_indices(options) if incremental else None
+    if new_strain_indices is not None:
+        logger.info("Running incremental CD-HIT clustering of %d new strains" % len(new_strain_indices))
+        return_code = cluster_proteins_incrementally(aggregated_proteins_file_path, new_strain_indices, options,
+                                                     INCREMENTAL_CLUSTERING_DIR, memory_budget)
+    else:
+        logger.info("Running CD-HIT on combined proteins file to create clustering")
+        return_code = run_cached_clustering("cd-hit", aggregated_proteins_file_path, CD_HIT_CLUSTER_REPS_OUTPUT_FILE,
+                                            options, memory_budget)
+    if return_code == 0:
+        expand_duplicate_members(CD_HIT_CLUSTERS_OUTPUT_FILE, aggregated_proteins_file_path + DUPLICATES_FILE_SUFFIX)
+        save_clustered_strains(options)
+    return return_code
 
 
-def perform_clustering_on_cds(input_file, output_file):
-    """Run the CD-HIT-EST program to perform clustering on the strains representatives and pseudogenes"""
+def perform_clustering_on_cds(input_file, output_file, identity=CDS_CLUSTERING_IDENTITY, word_size=None,
+                              memory_budget=CD_HIT_MEMORY_BUDGET):
+    """
+    Run the CD-HIT-EST program to perform clustering on the strains representatives and pseudogenes, then add cds
+    collapsed as duplicates of the clustered cds back to their clusters
+    """
     logger = logging.getLogger()
     logger.info("Running CD-HIT-EST on combined representative and pseudogene cds file to create clustering")
-    cd_hit_est_args = " ".join(["cd-hit-est", "-i", input_file, "-o", output_file, "-c 0.8",
-                   "-n 5", "-M 16000", "-g 1", "-p 1", "-d 30"])
-    cd_hit_est_return_code = run(cd_hit_est_args, shell=True).returncode
-    logger.info("Finished running CD-HIT with return code %d" % cd_hit_est_return_code)
-    return cd_hit_est_return_code
+    return_code = run_cached_clustering("cd-hit-est", input_file, output_file,
+                                        cd_hit_options("cd-hit-est", identity, word_size, description_length=30),
+                                        memory_budget)
+    if return_code == 0:
+        expand_duplicate_members(output_file + ".clstr", input_file + DUPLICATES_FILE_SUFFIX)
+    return return_code
+
+
+def run_cached_clustering(tool, input_file, output_file, options, memory_budget=CD_HIT_MEMORY_BUDGET):
+    """
+    Run CD-HIT or CD-HIT-EST on input_file, writing the representatives to output_file and the clusters to
+    output_file.clstr, unless the tool cache has the outputs of the same run on the same input
+    """
+    logger = logging.getLogger()
+    cache = ToolCache()
+    cache_key = cache.key([tool], options, [input_file])
+    output_files = [output_file, output_file + ".clstr"]
+    if cache.fetch(cache_key, output_files):
+        logger.info("Reusing cached %s outputs for %s (%s)" % (tool, input_file, cache.summary()))
+        return 0
+    cd_hit_return_code = run_cd_hit(tool, ["-i", input_file, "-o", output_file], options, [input_file], memory_budget)
+    if cd_hit_return_code == 0 and all(os.path.exists(f) for f in output_files):
+        cache.store(cache_key, output_files)
+    logger.info("Finished running %s with return code %d (%s)" % (tool, cd_hit_return_code, cache.summary()))
+    return cd_hit_return_code
 
 
-def perform_alignment_on_core_clusters(log_queue):
-    """Run MAFFT & Gblocks tools on fasta files of protein nucleotide seqs for each core cluster"""
+def perform_alignment_on_core_clusters():
+    """
+    Run MAFFT & Gblocks tools on fasta files of protein nucleotide seqs for each core cluster, scheduling the
+    clusters by estimated cost so that large clusters start first with multiple MAFFT threads. Clusters whose
+    alignments are in the tool cache are not realigned, and the previous alignments of clusters whose alignment
+    failed are removed, so they are not concatenated
+    """
     logger = logging.getLogger(__name__)
     logger.info("Running MAFFT & Gblocks on core clusters for alignment")
     if not os.path.exists(CLUSTERS_NT_SEQS_DIR):
         logger.error("No clusters dir found, exiting")
         exit(1)
-    if not os.path.exists(CLUSTERS_ALIGNMENTS_DIR):
-        os.makedirs(CLUSTERS_ALIGNMENTS_DIR)
+    for required_dir in (CLUSTERS_ALIGNMENTS_DIR, ALIGNMENT_LOGS_DIR):
+        if not os.path.exists(required_dir):
+            os.makedirs(required_dir)
 
-    job_queue = multiprocessing.Queue()
-    prepare_alignment_jobs(job_queue)
-    workers = [
-        multiprocessing.Process(target=perform_alignment_and_pruning, args=(i, job_queue, worker_configurer, log_queue))
-        for i in range(NUMBER_OF_PROCESSES)]
-    for w in workers:
-        w.start()
-    job_queue.put(None)
-    for w in workers:
-        w.join()
-    logger.info("Finished running MAFFT for all clusters")
-
-
-def prepare_alignment_jobs(job_queue):
-    """Put all downloaded strain dirs in job queue for workers"""
-    core_clusters = os.listdir(CLUSTERS_NT_SEQS_DIR)
-    for cluster_file in core_clusters:
-        job_queue.put(cluster_file)
+    cache = ToolCache()
+    jobs, cache_keys = prepare_alignment_jobs(cache)
+    ToolScheduler(NUMBER_OF_PROCESSES).run(jobs)
+    for job in jobs:
+        if job.succeeded():
+            cache.store(cache_keys[job.name], alignment_output_paths(job.name))
+        else:
+            for output_path in alignment_output_paths(job.name):
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+    with open(ALIGNMENT_JOBS_SUMMARY_PATH, 'w') as f:
+        json.dump({job.name: {'threads': job.threads, 'cost': job.cost, 'seconds': round(job.elapsed, 3),
+                              'exit_codes': job.exit_codes} for job in jobs}, f, indent=1, sort_keys=True)
+    failed_clusters = sorted(job.name for job in jobs if not job.succeeded())
+    if failed_clusters:
+        logger.error("MAFFT or Gblocks failed for %d clusters: %s, see logs in %s" %
+                     (len(failed_clusters), ", ".join(failed_clusters), ALIGNMENT_LOGS_DIR))
+    logger.info("Finished running MAFFT for all clusters (%s)" % cache.summary())
 
 
-def perform_alignment_and_pruning(worker_id, job_queue, configurer, log_queue):
+def prepare_alignment_jobs(cache):
     """
-    Perform MAFFT alignment and Gblocks pruning for a core cluster fasta file
+    Build the MAFFT & Gblocks job of each core cluster fasta file whose outputs are not in the tool cache, with its
+    MAFFT threads allocated by the cluster's seqs count x max seq length. Returns the jobs and their cache keys
     """
-    configurer(log_queue)
-    logger = logging.getLogger(__name__ + "_worker_" + str(worker_id))
-    while True:
-        cluster_file = job_queue.get()
-        if cluster_file is None:
-            job_queue.put(None)
-            break
-        logger.info("Running MAFFT for %s" % cluster_file)
-        alignment_stdout = open("alignment_stdout.log", "w")
-        alignment_stderr = open("alignment_stderr.log", "w")
-        cluster_alignment_filename = cluster_file + "_alignment"
-        if not os.path.exists(os.path.join(CLUSTERS_ALIGNMENTS_DIR, cluster_alignment_filename)):
-            cluster_alignment_file = open(os.path.join(CLUSTERS_ALIGNMENTS_DIR, cluster_alignment_filename), 'w')
-            mafft_args = " ".join(["mafft", "--auto", os.path.join(CLUSTERS_NT_SEQS_DIR, cluster_file)])
-            mafft_return_code = run(mafft_args, shell=True, stdout=cluster_alignment_file, stderr=alignment_stderr).returncode
-            logger.info("Finished running MAFFT for %s with return code %d" % (cluster_file, mafft_return_code))
-            cluster_alignment_file.close()
-
-        logger.info("Running GBlocks for %s" % cluster_file)
-        gblocks_args = " ".join(["Gblocks", os.path.join(CLUSTERS_ALIGNMENTS_DIR, cluster_alignment_filename), "-t=d", "-b5=a", "-p=n"])
-        gblocks_return_code = run(gblocks_args, shell=True, stdout=alignment_stdout, stderr=alignment_stderr).returncode
-        logger.info(
-            "Finished running Gblocks for alignment %s with return code %d" % (cluster_alignment_filename, gblocks_return_code))
+    jobs = []
+    cache_keys = {}
+    for cluster_file in os.listdir(CLUSTERS_NT_SEQS_DIR):
+        cluster_file_path = os.path.join(CLUSTERS_NT_SEQS_DIR, cluster_file)
+        cluster_alignment_path, pruned_alignment_path = alignment_output_paths(cluster_file)
+        cache_key = cache.key(["mafft", "Gblocks"], MAFFT_OPTIONS + GBLOCKS_OPTIONS, [cluster_file_path])
+        if cache.fetch(cache_key, [cluster_alignment_path, pruned_alignment_path]):
+            continue
+        seqs_count, max_seq_length = fasta_seqs_shape(cluster_file_path)
+        cost = seqs_count * max_seq_length
+        commands = [ToolCommand("MAFFT", ["mafft"] + MAFFT_OPTIONS + [cluster_file_path], threads_option="--thread",
+                                stdout_path=cluster_alignment_path),
+                    # Gblocks exits with 1 even when it succeeds
+                    ToolCommand("Gblocks", ["Gblocks", cluster_alignment_path] + GBLOCKS_OPTIONS, ok_codes=(0, 1))]
+        max_threads = min(ALIGNMENT_MAX_THREADS, ceil(cost / ALIGNMENT_COST_PER_THREAD))
+        jobs.append(ToolJob(cluster_file, commands, cost, max_threads,
+                            os.path.join(ALIGNMENT_LOGS_DIR, cluster_file + ".log")))
+        cache_keys[cluster_file] = cache_key
+    return jobs, cache_keys
+
+
+def alignment_output_paths(cluster_file):
+    """Paths of the MAFFT alignment & Gblocks pruned alignment of a core cluster fasta file"""
+    cluster_alignment_path = os.path.join(CLUSTERS_ALIGNMENTS_DIR, cluster_file + "_alignment")
+    return cluster_alignment_path, cluster_alignment_path + "-gb"
+
+
+def fasta_seqs_shape(file_path):
+    """Get the seqs count & the max seq length of a fasta file"""
+    with open_fasta_buffer(file_path) as buffer:
+        records = list(iter_fasta_headers(buffer))
+        max_seq_length = 0
+        for i, (offset, _) in enumerate(records):
+            seq_start = buffer.find(b"\n", offset) + 1 or len(buffer)
+            seq_end = records[i + 1][0] if i + 1 < len(records) else len(buffer)
+            max_seq_length = max(max_seq_length, len(bytes(buffer[seq_start:seq_end]).translate(None, b" \t\r\n")))
+        return len(records), max_seq_length
 
 
 def prepare_alignments_for_tree(log_queue):
-    """Edit each alignment to remove invariant positions, pad missing strain seqs & concatenate all alignments"""
+    """
+    Edit the alignment of each current core cluster to remove invariant positions, pad missing strain seqs &
+    concatenate all alignments. Edited alignments are written to a fresh dir replacing ALIGNMENTS_FOR_TREE_DIR, so
+    alignments of clusters which are no longer core clusters are never concatenated
+    """
     logger = logging.getLogger(__name__)
     logger.info("Preparing core clusters alignments for tree")
-    if not os.path.exists(CLUSTERS_ALIGNMENTS_DIR):
-        logger.error("No alignments dir found, exiting")
+    if not os.path.exists(CLUSTERS_ALIGNMENTS_DIR) or not os.path.exists(CLUSTERS_NT_SEQS_DIR):
+        logger.error("No alignments or clusters dir found, exiting")
         exit(1)
-    if not os.path.exists(ALIGNMENTS_FOR_TREE_DIR):
-        os.makedirs(ALIGNMENTS_FOR_TREE_DIR)
-
-    job_queue = multiprocessing.Queue()
-    prepare_alignment_editing_jobs(job_queue)
-    workers = [
-        multiprocessing.Process(target=perform_alignment_editing, args=(i, job_queue, worker_configurer, log_queue))
-        for i in range(NUMBER_OF_PROCESSES)]
-    for w in workers:
-        w.start()
-    job_queue.put(None)
-    for w in workers:
-        w.join()
-    logger.info("Finished editing all alignments, concatenating")
-    edited_alignment_files = os.listdir(ALIGNMENTS_FOR_TREE_DIR)
-    concatenated_alignment = None
-    concatenated_alignment_file = os.path.join(DATA_DIR, "all_alignments")
-    for edited_alignment_file in edited_alignment_files:
-        logger.info("Concatenating alignment %s" % edited_alignment_file)
-        with open(os.path.join(ALIGNMENTS_FOR_TREE_DIR, edited_alignment_file), "r") as f:
-            edited_alignment = AlignIO.read(f, FASTA_FILE_TYPE)
-            if not concatenated_alignment:
-                concatenated_alignment = edited_alignment[:, :]
-            else:
-                concatenated_alignment += edited_alignment[:, :]
-    AlignIO.write(concatenated_alignment, open(concatenated_alignment_file, "w"), FASTA_FILE_TYPE)
-    logger.info("Finished concatenating all alignments, written to %s" % concatenated_alignment_file)
-
-
-def prepare_alignment_editing_jobs(job_queue):
-    """Put all downloaded strain dirs in job queue for workers"""
-    alignments = os.listdir(CLUSTERS_ALIGNMENTS_DIR)
-    for alignment_file in alignments:
-        if alignment_file.endswith("-gb"):
+
+    strains_count = load_strain_manifest().strains_rows()
+    alignment_files = get_core_clusters_alignment_files()
+    with building_dir(ALIGNMENTS_FOR_TREE_DIR) as edited_alignments_dir:
+        job_queue = multiprocessing.Queue()
+        for alignment_file in alignment_files:
             job_queue.put(alignment_file)
+        workers = [
+            multiprocessing.Process(target=perform_alignment_editing,
+                                    args=(i, job_queue, worker_configurer, log_queue, strains_count,
+                                          edited_alignments_dir))
+            for i in range(NUMBER_OF_PROCESSES)]
+        for w in workers:
+            w.start()
+        job_queue.put(None)
+        for w in workers:
+            w.join()
+        failed_workers = [w for w in workers if w.exitcode != 0]
+        if failed_workers:
+            raise RuntimeError("%d alignment editing workers failed" % len(failed_workers))
+    logger.info("Finished editing all alignments, concatenating")
+    strain_names_map = build_strain_names_map()
+    supermatrix = concatenate_alignments([os.path.join(ALIGNMENTS_FOR_TREE_DIR, f) for f in alignment_files],
+                                         [f.split("_alignment")[0] for f in alignment_files],
+                                         [(i, strain_names_map.get(i, "")) for i in range(strains_count)],
+                                         SUPERMATRIX_DIR)
+    supermatrix.write_fasta(CONCATENATED_ALIGNMENT_PATH)
+    supermatrix.write_partitions(CONCATENATED_ALIGNMENT_PARTITIONS_PATH)
+    partitions = supermatrix.partitions
+    logger.info("Finished concatenating %d alignments (%d positions), written to %s" %
+                (len(partitions), partitions[-1][2] if partitions else 0, CONCATENATED_ALIGNMENT_PATH))
 
 
-def perform_alignment_editing(worker_id, job_queue, configurer, log_queue):
+def get_core_clusters_alignment_files():
     """
-    Perform alignment editing
+    Get the Gblocks pruned alignment file names of the core clusters in CLUSTERS_NT_SEQS_DIR, in concatenation order,
+    skipping clusters whose alignment failed
+    """
+    logger = logging.getLogger(__name__)
+    alignment_files = []
+    for cluster_file in sorted(os.listdir(CLUSTERS_NT_SEQS_DIR), key=alignment_sort_key):
+        pruned_alignment_path = alignment_output_paths(cluster_file)[1]
+        if os.path.exists(pruned_alignment_path):
+            alignment_files.append(os.path.basename(pruned_alignment_path))
+        else:
+            logger.warning("No pruned alignment found for core cluster %s, skipping it" % cluster_file)
+    return alignment_files
+
+
+def perform_alignment_editing(worker_id, job_queue, configurer, log_queue, strains_count, edited_alignments_dir):
+    """
+    Perform alignment editing - remove invariant columns & pad the alignment with gap-only rows for missing strains,
+    so row i of every edited alignment is the seq of strain index i
     """
     configurer(log_queue)
     logger = logging.getLogger(__name__ + "_worker_" + str(worker_id))
@@ -150,56 +240,40 @@ def perform_alignment_editing(worker_id, job_queue, configurer, log_queue):
             job_queue.put(None)
             break
         logger.info("Editing alignment %s" % alignment_file)
-        alignment = AlignIO.read(open(os.path.join(CLUSTERS_ALIGNMENTS_DIR, alignment_file), "r"), FASTA_FILE_TYPE)
-        edited_alignment = None
-        for col_idx in range(alignment.get_alignment_length()):
-            col = alignment[:, col_idx:col_idx + 1]
-            col_str = alignment[:, col_idx]
-            if not all(c == col_str[0] for c in col_str):
-                if not edited_alignment:
-                    edited_alignment = col
-                else:
-                    edited_alignment += col
-        alignment_seq_len = edited_alignment.get_alignment_length()
-        logger.info("alignment_seq_len = %d" % alignment_seq_len)
-        strain_idx = 0
-        while strain_idx < STRAINS_COUNT:
-            logger.info("in while - strain_idx = %d" % strain_idx)
-            if len(edited_alignment) > strain_idx:
-                seq = edited_alignment[strain_idx]
-                seq_strain_idx = int(ALIGNMENT_STRAIN_PATTERN.match(seq.id).group(1))
-                logger.info("checking if strain idx %d < seq_strain_idx %d" % (strain_idx, seq_strain_idx))
-                if strain_idx < seq_strain_idx:
-                    for i in range(seq_strain_idx - strain_idx):
-                        logger.info("adding padded seq at idx %d" % (strain_idx + i))
-                        edited_alignment._records.insert(strain_idx + i, SeqRecord(Seq(alignment_seq_len * '-'), id="[%d] padding" % (strain_idx + i)))
-                    strain_idx += (seq_strain_idx - strain_idx + 1)
-                    continue
-                strain_idx += 1
-            else:
-                logger.info("adding padded seq at end of alignment list")
-                edited_alignment.append(SeqRecord(Seq(alignment_seq_len * '-'), id="[%d] padding" % strain_idx))
-                strain_idx += 1
-        alignment_file_edited = os.path.join(ALIGNMENTS_FOR_TREE_DIR, alignment_file)
-        logger.info("Finished padding alignment - writing to file %s" % alignment_file_edited)
-        AlignIO.write(edited_alignment, open(alignment_file_edited, "w"), FASTA_FILE_TYPE)
-
-
-def format_concatenated_alignment():
-    logger = logging.getLogger(__name__)
-    strain_names_map = build_strain_names_map()
-    tree_alignment = AlignIO.read(open(os.path.join(DATA_DIR, "all_alignments"), "r"), FASTA_FILE_TYPE)
-    tree_alignment_filtered = AlignIO.MultipleSeqAlignment([])
-    for id, strain in zip(range(STRAINS_COUNT), tree_alignment):
-        if all(c == '-' for c in strain.seq):
-            logger.info("skipping filtered strain %d" % id)
-        else:
-            logger.info("adding id to strain %d" % id)
-            strain.id = "[" + str(id) + "]" + strain_names_map[id]
-            strain.description = ''
-            tree_alignment_filtered.append(strain)
-    AlignIO.write(tree_alignment_filtered, open(os.path.join(DATA_DIR, "filtered_tree_alignment"), "w"), FASTA_FILE_TYPE)
-
-
+        alignment = read_fasta_alignment(os.path.join(CLUSTERS_ALIGNMENTS_DIR, alignment_file))
+        edited_alignment = alignment.select_columns(alignment.variable_columns())
+        strain_indices = [int(ALIGNMENT_STRAIN_PATTERN.match(title).group(1)) for title in edited_alignment.titles]
+        padded_alignment = edited_alignment.scatter_rows(strain_indices, strains_count)
+        alignment_file_edited = os.path.join(edited_alignments_dir, alignment_file)
+        logger.info("Finished editing alignment %s - %d variable positions, %d strains padded, writing to file %s"
+                    % (alignment_file, edited_alignment.get_alignment_length(), strains_count - len(edited_alignment),
+                       alignment_file_edited))
+        padded_alignment.write_fasta(alignment_file_edited)
 
 
+def format_concatenated_alignment(max_strain_missing=None, max_column_missing=None, partition_names=None,
+                                  output_format="fasta"):
+    """
+    Write a tree input variant of the concatenated alignment - without strains missing from all core clusters, and
+    optionally limited to some partitions and filtered by the fraction of missing data per strain and per column
+    """
+    logger = logging.getLogger(__name__)
+    supermatrix = load_supermatrix(SUPERMATRIX_DIR)
+    if partition_names is not None:
+        supermatrix = supermatrix.select_partitions(partition_names)
+    strains_count = len(supermatrix)
+    supermatrix = supermatrix.drop_empty_strains()
+    if max_strain_missing is not None:
+        supermatrix = supermatrix.filter_strains(max_strain_missing)
+    if max_column_missing is not None:
+        supermatrix = supermatrix.filter_columns(max_column_missing)
+    logger.info("Filtered %d of %d strains, %d positions in %d partitions left"
+                % (strains_count - len(supermatrix), strains_count, supermatrix.get_alignment_length(),
+                   len(supermatrix.partitions)))
+    if output_format == "phylip":
+        supermatrix.write_phylip(FILTERED_TREE_ALIGNMENT_PATH)
+    elif output_format == "fasta":
+        supermatrix.write_fasta(FILTERED_TREE_ALIGNMENT_PATH)
+    else:
+        raise ValueError("Unknown alignment output format %s" % output_format)
+    supermatrix.write_partitions(FILTERED_TREE_ALIGNMENT_PATH + ".partitions")
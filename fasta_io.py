@@ -0,0 +1,155 @@
+import gzip
+import mmap
+import os
+import re
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from constants import FASTA_WRITE_BUFFER_SIZE, FASTA_LINE_WIDTH, FASTA_MAX_OPEN_FILES
+
+HEADER_FIELD_PATTERN = re.compile(rb"\[([^=\]]+)=([^\]]*)\]")
+
+
+@contextmanager
+def open_fasta_buffer(file_path):
+    """
+    Open a fasta file as a read-only bytes buffer - memory-mapped when uncompressed, or decompressed in one shot
+    when gzipped
+    """
+    if file_path.endswith('gz'):
+        with open(file_path, 'rb') as f:
+            yield gzip.decompress(f.read())
+    else:
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    yield buffer
+
+
+def iter_fasta_headers(buffer):
+    """
+    Yield the (offset, header) of every record in a fasta buffer, where header is the raw header bytes without the
+    leading '>'. Scanning jumps between '>' markers at line starts, so sequence lines are never split or decoded
+    """
+    if buffer[:1] == b">":
+        offset = 0
+    else:
+        offset = buffer.find(b"\n>")
+        offset = offset + 1 if offset != -1 else -1
+    while offset != -1:
+        header_end = buffer.find(b"\n", offset)
+        if header_end == -1:
+            header_end = len(buffer)
+        yield offset, buffer[offset + 1:header_end].rstrip(b"\r")
+        offset = buffer.find(b"\n>", header_end)
+        offset = offset + 1 if offset != -1 else -1
+
+
+def parse_header_fields(header):
+    """Parse the [key=value] fields of an NCBI fasta header into a dict of decoded strings"""
+    return {key.decode(): value.decode() for key, value in HEADER_FIELD_PATTERN.findall(header)}
+
+
+def fasta_title(seq_id, description):
+    """Build a fasta header title from a record id & description the same way Bio.SeqIO does"""
+    seq_id = seq_id.replace("\n", " ").replace("\r", " ")
+    description = description.replace("\n", " ").replace("\r", " ")
+    if description and description.split(None, 1)[0] == seq_id:
+        return description
+    elif description:
+        return seq_id + " " + description
+    return seq_id
+
+
+def format_fasta_record(title, seq):
+    """Format a single fasta record with the sequence wrapped to FASTA_LINE_WIDTH characters per line"""
+    lines = [">" + title]
+    lines.extend(seq[i:i + FASTA_LINE_WIDTH] for i in range(0, len(seq), FASTA_LINE_WIDTH))
+    lines.append("")
+    return "\n".join(lines)
+
+
+class BufferedFastaWriter:
+    """
+    Fasta output sink which is opened once and writes formatted records to disk in large sequential blocks,
+    flushing whenever the buffered records exceed buffer_size bytes and when closed
+    """
+    def __init__(self, file_path, buffer_size=FASTA_WRITE_BUFFER_SIZE, mode='w'):
+        self.file_path = file_path
+        self.buffer_size = buffer_size
+        self.records_written = 0
+        self.bytes_written = 0
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._file = open(file_path, mode + 'b')
+
+    def write(self, title, seq):
+        record = format_fasta_record(title, seq).encode()
+        self._buffer.append(record)
+        self._buffered_bytes += len(record)
+        self.records_written += 1
+        if self._buffered_bytes >= self.buffer_size:
+            self.flush()
+
+    def write_record(self, seq_record):
+        self.write(fasta_title(seq_record.id, seq_record.description), str(seq_record.seq))
+
+    def flush(self):
+        if self._buffer:
+            self._file.write(b"".join(self._buffer))
+            self.bytes_written += self._buffered_bytes
+            self._buffer = []
+            self._buffered_bytes = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class FastaFileSet:
+    """
+    Fasta output sink over many files in a single dir, keyed by file name. Records are appended through a bounded
+    LRU of open file handles, so the number of files written is not limited by the number of open files allowed.
+    Files are created (truncated) on their first write
+    """
+    def __init__(self, dir_path, max_open_files=FASTA_MAX_OPEN_FILES):
+        self.dir_path = dir_path
+        self.max_open_files = max_open_files
+        self.records_written = 0
+        self._files = OrderedDict()
+        self._created = set()
+
+    def write(self, file_name, title, seq):
+        output_file = self._files.get(file_name)
+        if output_file is None:
+            if len(self._files) >= self.max_open_files:
+                self._files.popitem(last=False)[1].close()
+            output_file = open(os.path.join(self.dir_path, file_name), 'a' if file_name in self._created else 'w')
+            self._created.add(file_name)
+            self._files[file_name] = output_file
+        else:
+            self._files.move_to_end(file_name)
+        output_file.write(format_fasta_record(title, seq))
+        self.records_written += 1
+
+    def file_names(self):
+        return sorted(self._created)
+
+    def close(self):
+        while self._files:
+            self._files.popitem()[1].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,63 @@
+import errno
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+TMP_DIR_SUFFIX = ".tmp"
+
+
+@contextmanager
+def building_dir(target_dir, is_current=None):
+    """
+    Build a directory atomically - yields a fresh tmp dir private to the caller, next to target_dir, which replaces
+    target_dir once the block exits without an error and is removed otherwise. See publish_dir for is_current
+    """
+    parent_dir = os.path.dirname(target_dir) or "."
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(target_dir) + ".", suffix=TMP_DIR_SUFFIX, dir=parent_dir)
+    try:
+        yield tmp_dir
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    publish_dir(tmp_dir, target_dir, is_current)
+
+
+def publish_dir(tmp_dir, target_dir, is_current=None):
+    """
+    Replace target_dir with tmp_dir by renames, so readers never see a partially written directory. When
+    is_current(target_dir) accepts a target_dir published meanwhile by a concurrent builder, it is kept and tmp_dir
+    is discarded. Returns whether tmp_dir was published
+    """
+    old_dir = "%s.old%s" % (tmp_dir, TMP_DIR_SUFFIX)
+    while True:
+        if is_current is not None and is_current(target_dir):
+            shutil.rmtree(tmp_dir)
+            return False
+        try:
+            os.rename(target_dir, old_dir)
+        except FileNotFoundError:
+            pass
+        try:
+            os.rename(tmp_dir, target_dir)
+            return True
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+        finally:
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def read_json_file(path):
+    """Load a json file, or None if it is missing"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def is_tmp_dir(dir_name):
+    return dir_name.endswith(TMP_DIR_SUFFIX)
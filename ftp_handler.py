@@ -1,127 +1,170 @@
-import multiprocessing
+import asyncio
 import os
 import logging
-from ftplib import FTP, error_temp
-from io import StringIO
-from time import sleep
+import shutil
 
-from logging_config import worker_configurer
-from constants import NUMBER_OF_PROCESSES, STRAIN_INDEX_FILE, PROTEIN_FILE_PATTERN, FEATURE_TABLE_PATTERN, \
-    CDS_FROM_GENOMIC_PATTERN
+from download_engine import TransferEngine, TransferError
+from strain_manifest import load_strain_manifest
+from constants import PROTEIN_FILE_PATTERN, FEATURE_TABLE_PATTERN, CDS_FROM_GENOMIC_PATTERN, MD5_CHECKSUMS_FILE, \
+    GENOMIC_PATTERN, DOWNLOAD_CONCURRENCY
 
-NCBI_FTP_SITE = "ftp.ncbi.nlm.nih.gov"
+STRAIN_FILE_PATTERNS = [FEATURE_TABLE_PATTERN + ".gz", CDS_FROM_GENOMIC_PATTERN + ".gz", GENOMIC_PATTERN + ".gz",
+                        PROTEIN_FILE_PATTERN + ".gz"]
+
+NCBI_BASE_URL = "https://ftp.ncbi.nlm.nih.gov"
 PA_LATEST_REFSEQ_URL = "/genomes/refseq/bacteria/Pseudomonas_aeruginosa"
-ftp_handle = FTP(NCBI_FTP_SITE)
-#TODO add syncing for already downloaded strains
+ASSEMBLY_SUMMARY_FILE = "assembly_summary.txt"
+
+
+class StrainDownload:
+    def __init__(self, accession, strain_dir, remote_dir, assembly_level):
+        self.accession = accession
+        self.dir = strain_dir
+        self.remote_dir = remote_dir
+        self.assembly_level = assembly_level
 
+    def remote_file(self, file_pattern):
+        return self.remote_dir + "/" + self.dir + "_" + file_pattern
 
-def download_valid_strains(worker_id, job_queue, configurer, log_queue, download_dir, strains_downloaded_counter):
+
+def download_strain_files(download_dir, log_queue, sample_size=None, base_url=NCBI_BASE_URL,
+                          concurrency=DOWNLOAD_CONCURRENCY):
     """
-    Filter out any strain that does not have a features_table / cds_from_genomic
-    as well as all suppressed strains from the strain list
+    Download all latest PA strains from NCBI (or a mirror of its genomes tree at base_url) with at most concurrency
+    transfers in flight
     """
-    configurer(log_queue)
-    logger = logging.getLogger(__name__ + "_worker_" + str(worker_id))
-    ftp_con = FTP(NCBI_FTP_SITE)
-    ftp_con.login()
-    ftp_con.cwd(PA_LATEST_REFSEQ_URL)
-    line_reader = StringIO()
-    ftp_con.retrlines('RETR ' + "assembly_summary.txt", line_reader.write)
-    #TODO need to read each line from the tab delimited file and extract the accession number and ftp url
-
-    num_of_strains_downloaded = 0
-    while True:
-        strain_dir = job_queue.get()
-        if strain_dir is None:
-            job_queue.put(None)
-            break
-        try:
-            strain_dir_files_list = ftp_con.nlst(strain_dir)
-            feature_table = [file for file in strain_dir_files_list if FEATURE_TABLE_PATTERN in file][0]
-            cds_from_genomic = [file for file in strain_dir_files_list if CDS_FROM_GENOMIC_PATTERN in file][0]
-            genomic_sequences = [file for file in strain_dir_files_list if strain_dir + "_genomic.fna" in file][0]
-            protein_sequences = [file for file in strain_dir_files_list if PROTEIN_FILE_PATTERN in file][0]
-            if protein_sequences:
-                if feature_table or cds_from_genomic:
-                    status_file = [file for file in strain_dir_files_list if "assembly_status" in file]
-                    download_strain = True
-                    if status_file:
-                        line_reader = StringIO()
-                        ftp_con.retrlines('RETR ' + status_file[0], line_reader.write)
-                        if "suppressed" in line_reader.getvalue():
-                            logger.info("skipping suppressed strain %s" % strain_dir)
-                            download_strain = False
-                            line_reader.close()
-
-                    if download_strain:
-                        strain_download_dir = download_dir + os.sep + strain_dir + os.sep
-                        if not os.path.exists(strain_download_dir):
-                            os.mkdir(strain_download_dir)
-                        if feature_table:
-                            ftp_con.retrbinary("RETR " + feature_table,
-                                               open(strain_download_dir + feature_table[len(strain_dir) + 1:], 'wb').write)
-                        if cds_from_genomic:
-                            ftp_con.retrbinary("RETR " + cds_from_genomic,
-                                               open(strain_download_dir + cds_from_genomic[len(strain_dir) + 1:],
-                                                    'wb').write)
-                        if genomic_sequences:
-                            ftp_con.retrbinary("RETR " + genomic_sequences,
-                                               open(strain_download_dir + genomic_sequences[len(strain_dir) + 1:],
-                                                    'wb').write)
-                        if protein_sequences:
-                            ftp_con.retrbinary("RETR " + protein_sequences,
-                                               open(strain_download_dir + protein_sequences[len(strain_dir) + 1:],
-                                                    'wb').write)
-                        with strains_downloaded_counter.get_lock():
-                            strain_index = strains_downloaded_counter.value
-                            with open(os.path.join(strain_download_dir, STRAIN_INDEX_FILE), 'w') as index_file:
-                                index_file.write(str(strain_index))
-                            strains_downloaded_counter.value += 1
-                        num_of_strains_downloaded += 1
-
-                        logger.debug("Downloaded files for strain %s" % strain_dir)
-                else:
-                    logger.warn("No feature_table or cds_from_genomic files found for strain %s" % strain_dir)
-            else:
-                logger.warn("No protein sequences found for strain %s" % strain_dir)
-        except error_temp or TimeoutError:
-            job_queue.put(strain_dir)
-            sleep(2)
-    ftp_con.quit()
-    exit(0)
-
-
-def download_strain_files(download_dir, log_queue, sample_size=None):
+    asyncio.run(sync_strains(download_dir, sample_size, base_url, concurrency))
+
+
+async def sync_strains(download_dir, sample_size, base_url, concurrency):
     logger = logging.getLogger(__name__)
-    ftp_handle.login()
-    job_queue = multiprocessing.Queue()
-    get_strains_from_ftp(job_queue, sample_size)
-    logger.info("Starting download of strain files")
-    strains_downloaded_counter = multiprocessing.Value('L', 0)
-    workers = [multiprocessing.Process(target=download_valid_strains, args=(i, job_queue, worker_configurer, log_queue,
-                                                                            download_dir, strains_downloaded_counter))
-               for i in range(NUMBER_OF_PROCESSES)]
-    for w in workers:
-        w.start()
-    job_queue.put(None)
-    for w in workers:
-        w.join()
-    with strains_downloaded_counter.get_lock():
-        logger.info("Finished downloading strain files, %s strains downloaded" % strains_downloaded_counter.value)
-    job_queue.close()
-
-
-def get_strains_from_ftp(job_queue, sample_size):
+    strain_manifest = load_strain_manifest()
+    async with TransferEngine(concurrency=concurrency) as engine:
+        planned_strains = await plan_strain_downloads(engine, base_url, sample_size)
+        strains_to_sync = [strain for strain in planned_strains
+                           if not is_strain_synced(strain_manifest, download_dir, strain.dir)]
+        logger.info("Starting download of strain files, %d of %d planned strains already synced"
+                    % (len(planned_strains) - len(strains_to_sync), len(planned_strains)))
+        strains_synced = 0
+        for sync in asyncio.as_completed([sync_strain(engine, base_url, strain, download_dir)
+                                          for strain in strains_to_sync]):
+            result = await sync
+            if result is None:
+                continue
+            strain, strain_files = result
+            strain_manifest.update(strain.dir, strain.accession, strain_files)
+            strains_synced += 1
+        if not sample_size:
+            retire_unplanned_strains(strain_manifest, download_dir, planned_strains)
+        new_strains = strain_manifest.assign_new_indices()
+        strain_manifest.save()
+        logger.info("Finished downloading strain files, %d strains synced (%d new): %s"
+                    % (strains_synced, new_strains, engine.metrics.summary()))
+
+
+async def sync_strain(engine, base_url, strain, download_dir):
+    """
+    Sync the files of a planned strain download, skipping strains without protein sequences or without a
+    features_table / cds_from_genomic file according to the strain's md5 checksums listing.
+    Returns the strain and the synced files' size & md5
+    """
     logger = logging.getLogger(__name__)
-    logger.info("Listing latest PA strains for download")
-    ftp_handle.cwd(PA_LATEST_REFSEQ_URL)
-    #TODO add timeout and retry for this operation
-    strains_dir_listing = ftp_handle.nlst()
-    ftp_handle.quit()
+    try:
+        remote_checksums = parse_md5_checksums(await engine.fetch_text(base_url + strain.remote_dir + "/" +
+                                                                       MD5_CHECKSUMS_FILE))
+        strain_file_names = {pattern: strain.dir + "_" + pattern for pattern in STRAIN_FILE_PATTERNS
+                             if strain.dir + "_" + pattern in remote_checksums}
+        if PROTEIN_FILE_PATTERN + ".gz" not in strain_file_names:
+            logger.warning("No protein sequences found for strain %s" % strain.dir)
+            return None
+        if FEATURE_TABLE_PATTERN + ".gz" not in strain_file_names and \
+                CDS_FROM_GENOMIC_PATTERN + ".gz" not in strain_file_names:
+            logger.warning("No feature_table or cds_from_genomic files found for strain %s" % strain.dir)
+            return None
+        strain_download_dir = os.path.join(download_dir, strain.dir)
+        if not os.path.exists(strain_download_dir):
+            os.mkdir(strain_download_dir)
+        files_info = await asyncio.gather(*[engine.fetch_file(base_url + strain.remote_file(pattern),
+                                                              os.path.join(strain_download_dir, file_name),
+                                                              remote_checksums[file_name])
+                                            for pattern, file_name in strain_file_names.items()])
+    except (TransferError, FileNotFoundError) as e:
+        logger.error("Failed syncing strain %s (%s)" % (strain.dir, e))
+        return None
+    logger.debug("Synced files for strain %s" % strain.dir)
+    return strain, dict(zip(strain_file_names.values(), files_info))
+
+
+def retire_unplanned_strains(strain_manifest, download_dir, planned_strains):
+    """
+    Remove the strains which are no longer planned - replaced by a newer assembly version, or no longer latest - from
+    the manifest and delete their files, so they are not analysed alongside their replacements
+    """
+    logger = logging.getLogger(__name__)
+    if not planned_strains:
+        logger.warning("No strains planned, keeping all %d downloaded strains" % len(strain_manifest))
+        return 0
+    planned_accessions = {strain.accession for strain in planned_strains}
+    retired_strains = [strain for strain in strain_manifest if strain['accession'] not in planned_accessions]
+    for strain in retired_strains:
+        logger.info("Retiring strain %s index %d, its assembly is no longer latest" % (strain['dir'], strain['index']))
+        strain_manifest.remove(strain['dir'])
+        shutil.rmtree(os.path.join(download_dir, strain['dir']), ignore_errors=True)
+    return len(retired_strains)
+
+
+def parse_md5_checksums(text):
+    """Parse an NCBI md5checksums.txt into the md5 checksum of each file in the strain dir, keyed by file name"""
+    checksums = {}
+    for line in text.splitlines():
+        if line.strip():
+            md5, file_path = line.split(None, 1)
+            checksums[os.path.basename(file_path.strip())] = md5
+    return checksums
+
+
+async def plan_strain_downloads(engine, base_url, sample_size=None):
+    """
+    Fetch the PA assembly_summary.txt once and plan the download of every latest assembly, deriving each strain's
+    remote dir from the summary's ftp_path so no per-strain listing is needed
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("Planning latest PA strains downloads from %s" % ASSEMBLY_SUMMARY_FILE)
+    summary = await engine.fetch_text(base_url + PA_LATEST_REFSEQ_URL + "/" + ASSEMBLY_SUMMARY_FILE)
+    assemblies = parse_assembly_summary(summary.splitlines())
+    planned_strains = []
+    for assembly in assemblies:
+        if assembly['version_status'] != "latest" or assembly['ftp_path'] == "na":
+            logger.info("skipping %s strain %s" % (assembly['version_status'], assembly['assembly_accession']))
+            continue
+        remote_dir = "/" + assembly['ftp_path'].split("://", 1)[-1].split("/", 1)[1].rstrip("/")
+        planned_strains.append(StrainDownload(assembly['assembly_accession'], remote_dir.rsplit("/", 1)[1],
+                                              remote_dir, assembly['assembly_level']))
+    planned_strains.sort(key=lambda strain: strain.accession)
     if sample_size:
-        strains_dir_listing = strains_dir_listing[:sample_size]
-    for strain_dir in strains_dir_listing:
-        job_queue.put(strain_dir)
+        planned_strains = planned_strains[:sample_size]
+    return planned_strains
+
 
+def parse_assembly_summary(lines):
+    """Parse the tab delimited lines of an NCBI assembly_summary.txt into a dict per assembly keyed by column name"""
+    columns = None
+    assemblies = []
+    for line in lines:
+        if line.startswith("#"):
+            if "assembly_accession" in line:
+                columns = line.lstrip("#").strip().split("\t")
+            continue
+        if columns and line.strip():
+            assemblies.append(dict(zip(columns, line.rstrip("\n").split("\t"))))
+    return assemblies
 
 
+def is_strain_synced(strain_manifest, download_dir, strain_dir):
+    """Check if all files recorded for the strain in the manifest are fully downloaded"""
+    strain = strain_manifest.get(strain_dir)
+    if strain is None or not strain['files']:
+        return False
+    return all(os.path.exists(os.path.join(download_dir, strain_dir, file_name)) and
+               os.path.getsize(os.path.join(download_dir, strain_dir, file_name)) == file_info['size']
+               for file_name, file_info in strain['files'].items())
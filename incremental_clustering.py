@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import shutil
+
+from cd_hit_runner import run_cd_hit
+from cluster_store import load_cluster_store, iter_clusters_file, write_cluster
+from constants import CD_HIT_CLUSTER_REPS_OUTPUT_FILE, CD_HIT_CLUSTERS_OUTPUT_FILE, CLUSTERED_STRAINS_PATH, \
+    PROTEIN_FILE_PATTERN, CLUSTER_MEMBER_PATTERN, ALIGNMENT_STRAIN_PATTERN, CD_HIT_MEMORY_BUDGET
+from fasta_io import open_fasta_buffer, iter_fasta_headers
+from strain_manifest import load_strain_manifest, strain_file_path
+
+logger = logging.getLogger(__name__)
+
+CLUSTERED_STRAINS_VERSION = 1
+
+
+def clustered_strain_signatures(manifest):
+    """Strain dir -> (index, protein file size & md5) of every manifest strain with a protein file"""
+    signatures = {}
+    for strain in manifest:
+        protein_file_path = strain_file_path(strain, PROTEIN_FILE_PATTERN)
+        if protein_file_path:
+            signatures[strain['dir']] = [strain['index'], strain['files'][os.path.basename(protein_file_path)]]
+    return signatures
+
+
+def save_clustered_strains(options, clustered_strains_path=CLUSTERED_STRAINS_PATH):
+    """Record the strains (by their current protein files) & CD-HIT options the protein clusters were built from"""
+    with open(clustered_strains_path + ".tmp", 'w') as f:
+        json.dump({'version': CLUSTERED_STRAINS_VERSION, 'options': options,
+                   'strains': clustered_strain_signatures(load_strain_manifest())}, f, indent=1, sort_keys=True)
+    os.replace(clustered_strains_path + ".tmp", clustered_strains_path)
+
+
+def get_new_strain_indices(options, clustered_strains_path=CLUSTERED_STRAINS_PATH):
+    """
+    Get the indices of the strains added since the protein clusters were built, or None when the clusters cannot be
+    updated incrementally - there are no recorded clusters, they were built with other options, or strains were
+    removed or their protein files changed since
+    """
+    if not all(os.path.exists(path) for path in
+               (clustered_strains_path, CD_HIT_CLUSTER_REPS_OUTPUT_FILE, CD_HIT_CLUSTERS_OUTPUT_FILE)):
+        return None
+    with open(clustered_strains_path) as f:
+        clustered_strains = json.load(f)
+    if clustered_strains.get('version') != CLUSTERED_STRAINS_VERSION or clustered_strains['options'] != options:
+        return None
+    signatures = clustered_strain_signatures(load_strain_manifest())
+    if any(signatures.get(strain_dir) != signature for strain_dir, signature in clustered_strains['strains'].items()):
+        return None
+    return {signature[0] for strain_dir, signature in signatures.items()
+            if strain_dir not in clustered_strains['strains']}
+
+
+def cluster_proteins_incrementally(combined_proteins_file_path, new_strain_indices, options, work_dir,
+                                   memory_budget=CD_HIT_MEMORY_BUDGET):
+    """
+    Add the proteins of new strains to the existing protein clusters. cd-hit-2d assigns the new proteins similar to
+    existing representatives to their clusters, cd-hit clusters only the remaining proteins, and the merged clusters
+    file keeps the ids of all existing clusters, numbering new clusters after them
+    """
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    new_proteins_path = os.path.join(work_dir, "new_proteins.fasta")
+    new_proteins_count = extract_strains_records(combined_proteins_file_path, new_strain_indices, new_proteins_path)
+    logger.info("Clustering %d proteins of %d new strains against existing clusters" %
+                (new_proteins_count, len(new_strain_indices)))
+    if not new_proteins_count:
+        shutil.rmtree(work_dir)
+        return 0
+
+    unmatched_path = os.path.join(work_dir, "unmatched_proteins.fasta")
+    return_code = run_cd_hit("cd-hit-2d", ["-i", CD_HIT_CLUSTER_REPS_OUTPUT_FILE, "-i2", new_proteins_path,
+                                           "-o", unmatched_path], options,
+                             [CD_HIT_CLUSTER_REPS_OUTPUT_FILE, new_proteins_path], memory_budget)
+    if return_code != 0:
+        logger.error("cd-hit-2d failed with return code %d" % return_code)
+        return return_code
+    matched_members = get_matched_members(unmatched_path + ".clstr", new_strain_indices)
+
+    new_clusters_path = os.path.join(work_dir, "new_clusters.fasta")
+    with open(unmatched_path) as f:
+        has_unmatched = any(line.startswith(">") for line in f)
+    if has_unmatched:
+        return_code = run_cd_hit("cd-hit", ["-i", unmatched_path, "-o", new_clusters_path], options, [unmatched_path],
+                                 memory_budget)
+        if return_code != 0:
+            logger.error("cd-hit failed on unmatched proteins with return code %d" % return_code)
+            return return_code
+    else:
+        open(new_clusters_path, 'w').close()
+        open(new_clusters_path + ".clstr", 'w').close()
+
+    clusters_count = merge_clusters_files(CD_HIT_CLUSTERS_OUTPUT_FILE, matched_members, new_clusters_path + ".clstr",
+                                          CD_HIT_CLUSTERS_OUTPUT_FILE + ".tmp")
+    with open(CD_HIT_CLUSTER_REPS_OUTPUT_FILE + ".tmp", 'wb') as reps_file:
+        for reps_path in (CD_HIT_CLUSTER_REPS_OUTPUT_FILE, new_clusters_path):
+            with open(reps_path, 'rb') as f:
+                shutil.copyfileobj(f, reps_file)
+    os.replace(CD_HIT_CLUSTER_REPS_OUTPUT_FILE + ".tmp", CD_HIT_CLUSTER_REPS_OUTPUT_FILE)
+    os.replace(CD_HIT_CLUSTERS_OUTPUT_FILE + ".tmp", CD_HIT_CLUSTERS_OUTPUT_FILE)
+    logger.info("Added %d proteins to existing clusters and %d new clusters" %
+                (sum(len(members) for members in matched_members.values()), clusters_count[1]))
+    shutil.rmtree(work_dir)
+    return 0
+
+
+def extract_strains_records(fasta_file_path, strain_indices, output_path):
+    """Copy the [strain][seq] indexed records of the given strains from a fasta file, returning their count"""
+    records_count = 0
+    with open_fasta_buffer(fasta_file_path) as buffer, open(output_path, 'wb') as output_file:
+        records = list(iter_fasta_headers(buffer))
+        for i, (offset, header) in enumerate(records):
+            strain_match = ALIGNMENT_STRAIN_PATTERN.search(header.decode())
+            if strain_match and int(strain_match.group(1)) in strain_indices:
+                record_end = records[i + 1][0] if i + 1 < len(records) else len(buffer)
+                output_file.write(buffer[offset:record_end])
+                records_count += 1
+    return records_count
+
+
+def get_matched_members(clusters_2d_file, new_strain_indices):
+    """
+    Map existing cluster id -> the member lines (without member numbers) of new strain proteins which cd-hit-2d
+    assigned to the cluster's representative
+    """
+    rep_clusters = get_representative_clusters()
+    matched_members = {}
+    for _, members in iter_clusters_file(clusters_2d_file):
+        cluster_id = None
+        new_members = []
+        for member in members:
+            member_match = CLUSTER_MEMBER_PATTERN.match("0\t" + member)
+            if not member_match:
+                raise ValueError("line in clusters file %s does not match cluster member pattern %s" %
+                                 (member, CLUSTER_MEMBER_PATTERN.pattern))
+            member_key = (int(member_match.group(2)), int(member_match.group(3)))
+            if member_key[0] in new_strain_indices:
+                new_members.append(member.rstrip().rstrip("*").rstrip() + "\n")
+            elif member_key in rep_clusters:
+                cluster_id = rep_clusters[member_key]
+        if new_members and cluster_id is None:
+            raise ValueError("cd-hit-2d cluster of %s has no existing cluster representative" % new_members[0].rstrip())
+        if new_members:
+            matched_members.setdefault(cluster_id, []).extend(new_members)
+    return matched_members
+
+
+def get_representative_clusters():
+    """Map the (strain index, seq index) of each existing cluster representative to its cluster id"""
+    store = load_cluster_store(CD_HIT_CLUSTERS_OUTPUT_FILE)
+    reps = store.is_representative
+    return {(strain_index, seq_index): cluster_id for strain_index, seq_index, cluster_id in
+            zip(store.strain_index[reps].tolist(), store.seq_index[reps].tolist(), store.cluster_id[reps].tolist())}
+
+
+def merge_clusters_files(clusters_file, matched_members, new_clusters_file, output_file):
+    """
+    Write the existing clusters with their matched new members appended, followed by the new clusters numbered after
+    the last existing cluster. Returns the numbers of existing & new clusters
+    """
+    existing_clusters_count = 0
+    new_clusters_count = 0
+    with open(output_file, 'w') as output:
+        for cluster_id, members in iter_clusters_file(clusters_file):
+            write_cluster(output, cluster_id, members + matched_members.get(cluster_id, []))
+            existing_clusters_count = cluster_id + 1
+        for cluster_id, members in iter_clusters_file(new_clusters_file):
+            write_cluster(output, existing_clusters_count + cluster_id, members)
+            new_clusters_count += 1
+    return existing_clusters_count, new_clusters_count
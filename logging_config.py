@@ -16,9 +16,9 @@ def listener_configurer():
 
 
 def worker_configurer(queue):
-    q_handler = QueueHandler(queue)
     root = logging.getLogger()
-    root.addHandler(q_handler)
+    if not any(isinstance(h, QueueHandler) and h.queue is queue for h in root.handlers):
+        root.addHandler(QueueHandler(queue))
     root.setLevel(logging.DEBUG)
 
 
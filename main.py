@@ -7,19 +7,29 @@ import pandas
 
 from data_visualization import create_1st_stage_charts, create_2nd_stage_charts
 from external_tools import perform_clustering_on_proteins, perform_clustering_on_cds, \
-    perform_alignment_on_core_clusters, prepare_alignments_for_tree
+    perform_alignment_on_core_clusters, prepare_alignments_for_tree, format_concatenated_alignment
 from nucleotide_preprocessor import create_representatives_and_pseudogenes_file
-from constants import STRAINS_DIR, COMBINED_PROTEINS_FILE_PATH, \
+from constants import STRAINS_DIR, PICKLES_DIR, COMBINED_PROTEINS_FILE_PATH, CD_HIT_CLUSTER_REPS_OUTPUT_FILE, \
     CD_HIT_CLUSTERS_OUTPUT_FILE, CD_HIT_EST_CLUSTER_REPS_OUTPUT_FILE, COMBINED_CDS_FILE_PATH, \
     FIRST_STAGE_STATS_PKL, SECOND_STAGE_STRAIN_STATS_PKL, SECOND_STAGE_CLUSTER_STATS_PKL, FIRST_STAGE_STATS_CSV, \
-    CD_HIT_EST_CLUSTERS_OUTPUT_FILE, SECOND_STAGE_AGGREGATED_CLUSTER_STATS_PKL, SECOND_STAGE_STATS_CSV
+    CD_HIT_EST_CLUSTERS_OUTPUT_FILE, SECOND_STAGE_AGGREGATED_CLUSTER_STATS_PKL, SECOND_STAGE_STATS_CSV, \
+    FIRST_STAGE_GRAPHS_DIR, SECOND_STAGE_GRAPHS_DIR, CD_HIT_EST_MULTIPLE_PROTEIN_CLUSTERS_OUTPUT_FILE, \
+    COMBINED_STRAIN_REPS_CDS_PATH, COMBINED_STRAIN_PSEUDOGENES_PATH, BLAST_RESULTS_FILE, \
+    COMBINED_PSEUDOGENES_WITHOUT_BLAST_HIT_PATH, CLUSTERS_NT_SEQS_DIR, CLUSTERS_ALIGNMENTS_DIR, \
+    ALIGNMENTS_FOR_TREE_DIR, CONCATENATED_ALIGNMENT_PATH, PIPELINE_MANIFEST_PATH, DOWNLOAD_CONCURRENCY, \
+    STRAIN_MANIFEST_PATH, SEQUENCE_STORES_DIR, CONCATENATED_ALIGNMENT_PARTITIONS_PATH, SUPERMATRIX_DIR, \
+    FILTERED_TREE_ALIGNMENT_PATH, COMBINED_UNIQUE_PROTEINS_FILE_PATH, COMBINED_UNIQUE_CDS_FILE_PATH, \
+    DUPLICATES_FILE_SUFFIX, PROTEIN_CLUSTERING_IDENTITY, CDS_CLUSTERING_IDENTITY, CD_HIT_MEMORY_BUDGET
 from data_analysis import get_1st_stage_stats_per_strain, get_2nd_stage_stats_per_strain, \
     get_2nd_stage_stats_per_cluster, filter_2nd_stage_clusters_with_multiple_proteins, \
     split_2nd_stage_combined_fasta_to_reps_pseudogenes, get_pseudogenes_without_blast_hits_fasta, get_core_clusters, \
     export_protein_clusters_to_nucleotide_fasta_files, get_strains_mlst_genes
-from ftp_handler import download_strain_files
+from ftp_handler import download_strain_files, NCBI_BASE_URL
 from logging_config import listener_process, listener_configurer, worker_configurer
+from pipeline import Pipeline, Stage
 from protein_preprocessor import create_all_strains_file_with_indices
+from sequence_store import ingest_strains_sequences
+from strain_manifest import migrate_strain_manifest
 
 
 def main():
@@ -35,111 +45,163 @@ def main():
     worker_configurer(log_queue)
     logger = logging.getLogger()
 
-    if not os.path.exists(STRAINS_DIR):
-        os.makedirs(STRAINS_DIR)
+    for required_dir in (STRAINS_DIR, PICKLES_DIR):
+        if not os.path.exists(required_dir):
+            os.makedirs(required_dir)
+    if not os.path.exists(STRAIN_MANIFEST_PATH):
+        migrate_strain_manifest()
 
     try:
-        stats_df = strains_df = clusters_df = None
         logger.info("Starting work")
-        if args.download:
-            download_strain_files(STRAINS_DIR, log_queue, sample_size=args.sample_size)
-        if args.preprocess_proteins:
-            if os.listdir(STRAINS_DIR):
-                create_all_strains_file_with_indices(log_queue)
-            else:
-                logger.error("Cannot preprocess strain proteins without downloaded strains")
-        if args.preprocess_cds:
-            if os.listdir(STRAINS_DIR) and os.path.exists(CD_HIT_CLUSTERS_OUTPUT_FILE):
-                create_representatives_and_pseudogenes_file(log_queue)
-        if args.cluster_proteins:
-            if os.path.exists(COMBINED_PROTEINS_FILE_PATH):
-                perform_clustering_on_proteins(COMBINED_PROTEINS_FILE_PATH)
-            else:
-                logger.error("Cannot run clustering without pre-processed proteins file")
-        if args.cluster_cds:
-            input_file = args.input if args.input else COMBINED_CDS_FILE_PATH
-            output_file = args.output if args.output else CD_HIT_EST_CLUSTER_REPS_OUTPUT_FILE
-            if os.path.exists(input_file):
-                perform_clustering_on_cds(input_file, output_file)
-            else:
-                logger.error("Cannot run clustering without pre-processed cds file")
-        if args.protein_stats:
-            logger.info("Gathering genomic and 1st stage clusters statistics per strain")
-            if os.path.exists(CD_HIT_CLUSTERS_OUTPUT_FILE):
-                stats_df = get_1st_stage_stats_per_strain()
-                stats_df.to_pickle(FIRST_STAGE_STATS_PKL)
-            else:
-                logger.error("Cannot perform analysis without clusters file")
-        if args.nucleotide_stats:
-            logger.info("Gathering 2nd stage clusters statistics per strain")
-            if stats_df is None:
-                logger.info("retrieving 1st stage stats from pkl file")
-                stats_df = pandas.read_pickle(FIRST_STAGE_STATS_PKL)
-            strains_df, clusters_df = get_2nd_stage_stats_per_strain(stats_df)
-            strains_df.to_pickle(SECOND_STAGE_STRAIN_STATS_PKL)
-            clusters_df.to_pickle(SECOND_STAGE_CLUSTER_STATS_PKL)
-        if args.graph_1st_stage:
-            logger.info("Plotting charts from 1st stage statistics")
-            if stats_df is None:
-                logger.info("retrieving 1st stage stats from pkl file")
-                stats_df = pandas.read_pickle(FIRST_STAGE_STATS_PKL)
-            create_1st_stage_charts(stats_df)
-        if args.graph_2nd_stage:
-            logger.info("Plotting charts from 2nd stage statistics")
-            if strains_df is None:
-                logger.info("retrieving 1st stage stats from pkl file")
-                strains_df = pandas.read_pickle(SECOND_STAGE_STRAIN_STATS_PKL)
-            if clusters_df is None:
-                logger.info("retrieving 1st stage stats from pkl file")
-                clusters_df = pandas.read_pickle(SECOND_STAGE_CLUSTER_STATS_PKL)
-            create_2nd_stage_charts(strains_df, clusters_df)
-        if args.get_1st_stage_stats_csv:
-            logger.info("Gathering genomic and protein clusters statistics per strain as CSV file")
-            if os.path.exists(CD_HIT_CLUSTERS_OUTPUT_FILE):
-                stats_df = get_1st_stage_stats_per_strain()
-                stats_df.to_pickle(FIRST_STAGE_STATS_PKL)
-            else:
-                logger.error("Cannot perform analysis without clusters file")
-            stats_df.to_csv(FIRST_STAGE_STATS_CSV)
-        if args.get_2nd_stage_stats_csv:
-            logger.info("Gathering 2nd stage clusters statistics per cluster as CSV file")
-            if os.path.exists(CD_HIT_EST_CLUSTERS_OUTPUT_FILE):
-                cluster_stats = get_2nd_stage_stats_per_cluster()
-                cluster_stats.to_pickle(SECOND_STAGE_AGGREGATED_CLUSTER_STATS_PKL)
-            else:
-                logger.error("Cannot perform analysis without clusters file")
-            cluster_stats.to_csv(SECOND_STAGE_STATS_CSV)
-        if args.filter_clusters:
-            filter_2nd_stage_clusters_with_multiple_proteins()
-        if args.split_2nd_stage_fasta:
-            split_2nd_stage_combined_fasta_to_reps_pseudogenes()
-        if args.get_pseudogenes_no_hits_fasta:
-            get_pseudogenes_without_blast_hits_fasta()
-        if args.get_core_clusters_nums:
-            core_clusters, core_clusters_with_multiple_strain_seqs = get_core_clusters()
-            logger.info("Core clusters without multiple strain appearances: %d" % len(core_clusters))
-            logger.info("Core clusters with multiple strain appearances: %d" % len(core_clusters_with_multiple_strain_seqs))
-        if args.export_protein_core_clusters:
-            export_protein_clusters_to_nucleotide_fasta_files()
-        if args.perform_alignment_on_clusters:
-            perform_alignment_on_core_clusters(log_queue)
-        if args.prepare_alignments_for_tree:
-            prepare_alignments_for_tree(log_queue)
-
+        stages = build_pipeline_stages(args, log_queue)
+        targets = [stage.name for stage in stages if getattr(args, stage.name)]
+        failed_stages = Pipeline(stages, PIPELINE_MANIFEST_PATH, log_queue).run(targets, force=args.force)
+        if failed_stages:
+            logger.error("Failed stages: %s" % ", ".join(sorted(failed_stages)))
         logger.info("Finished work, exiting")
     finally:
         log_queue.put_nowait(None)
         listener.join()
 
 
+def build_pipeline_stages(args, log_queue):
+    """
+    Declare the pipeline stages by the inputs they consume & the outputs they produce.
+    Stage names match the command line flags selecting them as targets
+    """
+    cds_clusters_input = args.input if args.input else COMBINED_UNIQUE_CDS_FILE_PATH
+    cds_clusters_inputs = [cds_clusters_input] if args.input else \
+        [COMBINED_UNIQUE_CDS_FILE_PATH, COMBINED_UNIQUE_CDS_FILE_PATH + DUPLICATES_FILE_SUFFIX]
+    cds_clusters_output = args.output if args.output else CD_HIT_EST_CLUSTER_REPS_OUTPUT_FILE
+    return [
+        Stage('download', download_strain_files,
+              args=(STRAINS_DIR, log_queue, args.sample_size, args.download_url, args.download_concurrency),
+              outputs=[STRAINS_DIR, STRAIN_MANIFEST_PATH], params={'sample_size': args.sample_size, 'download_url': args.download_url},
+              always_run=True),
+        Stage('ingest_sequences', ingest_strains_sequences,
+              inputs=[STRAINS_DIR, STRAIN_MANIFEST_PATH], outputs=[SEQUENCE_STORES_DIR]),
+        Stage('preprocess_proteins', create_all_strains_file_with_indices, args=(log_queue,),
+              inputs=[STRAINS_DIR, STRAIN_MANIFEST_PATH, SEQUENCE_STORES_DIR],
+              outputs=[COMBINED_PROTEINS_FILE_PATH, COMBINED_UNIQUE_PROTEINS_FILE_PATH,
+                       COMBINED_UNIQUE_PROTEINS_FILE_PATH + DUPLICATES_FILE_SUFFIX]),
+        Stage('cluster_proteins', perform_clustering_on_proteins,
+              args=(COMBINED_UNIQUE_PROTEINS_FILE_PATH, not args.full_clustering, args.protein_identity,
+                    args.protein_word_size, args.cd_hit_memory),
+              inputs=[COMBINED_UNIQUE_PROTEINS_FILE_PATH, COMBINED_UNIQUE_PROTEINS_FILE_PATH + DUPLICATES_FILE_SUFFIX],
+              outputs=[CD_HIT_CLUSTER_REPS_OUTPUT_FILE, CD_HIT_CLUSTERS_OUTPUT_FILE],
+              params={'identity': args.protein_identity, 'word_size': args.protein_word_size}),
+        Stage('preprocess_cds', create_representatives_and_pseudogenes_file, args=(log_queue,),
+              inputs=[STRAINS_DIR, STRAIN_MANIFEST_PATH, SEQUENCE_STORES_DIR, CD_HIT_CLUSTERS_OUTPUT_FILE],
+              outputs=[COMBINED_CDS_FILE_PATH, COMBINED_UNIQUE_CDS_FILE_PATH,
+                       COMBINED_UNIQUE_CDS_FILE_PATH + DUPLICATES_FILE_SUFFIX]),
+        Stage('cluster_cds', perform_clustering_on_cds,
+              args=(cds_clusters_input, cds_clusters_output, args.cds_identity, args.cds_word_size, args.cd_hit_memory),
+              inputs=cds_clusters_inputs, outputs=[cds_clusters_output, cds_clusters_output + ".clstr"],
+              params={'identity': args.cds_identity, 'word_size': args.cds_word_size}),
+        Stage('protein_stats', save_1st_stage_stats,
+              inputs=[STRAINS_DIR, STRAIN_MANIFEST_PATH, SEQUENCE_STORES_DIR, CD_HIT_CLUSTERS_OUTPUT_FILE], outputs=[FIRST_STAGE_STATS_PKL]),
+        Stage('get_1st_stage_stats_csv', export_stats_pkl_to_csv, args=(FIRST_STAGE_STATS_PKL, FIRST_STAGE_STATS_CSV),
+              inputs=[FIRST_STAGE_STATS_PKL], outputs=[FIRST_STAGE_STATS_CSV]),
+        Stage('nucleotide_stats', save_2nd_stage_stats,
+              inputs=[FIRST_STAGE_STATS_PKL, CD_HIT_CLUSTERS_OUTPUT_FILE, CD_HIT_EST_CLUSTERS_OUTPUT_FILE],
+              outputs=[SECOND_STAGE_STRAIN_STATS_PKL, SECOND_STAGE_CLUSTER_STATS_PKL]),
+        Stage('get_2nd_stage_stats_csv', save_2nd_stage_cluster_stats,
+              inputs=[CD_HIT_CLUSTERS_OUTPUT_FILE, CD_HIT_EST_CLUSTERS_OUTPUT_FILE],
+              outputs=[SECOND_STAGE_AGGREGATED_CLUSTER_STATS_PKL, SECOND_STAGE_STATS_CSV]),
+        Stage('graph_1st_stage', plot_1st_stage_charts,
+              inputs=[FIRST_STAGE_STATS_PKL, CD_HIT_CLUSTERS_OUTPUT_FILE], outputs=[FIRST_STAGE_GRAPHS_DIR]),
+        Stage('graph_2nd_stage', plot_2nd_stage_charts,
+              inputs=[SECOND_STAGE_STRAIN_STATS_PKL, SECOND_STAGE_CLUSTER_STATS_PKL], outputs=[SECOND_STAGE_GRAPHS_DIR]),
+        Stage('filter_clusters', filter_2nd_stage_clusters_with_multiple_proteins,
+              inputs=[CD_HIT_EST_CLUSTERS_OUTPUT_FILE], outputs=[CD_HIT_EST_MULTIPLE_PROTEIN_CLUSTERS_OUTPUT_FILE]),
+        Stage('split_2nd_stage_fasta', split_2nd_stage_combined_fasta_to_reps_pseudogenes,
+              inputs=[COMBINED_CDS_FILE_PATH], outputs=[COMBINED_STRAIN_REPS_CDS_PATH, COMBINED_STRAIN_PSEUDOGENES_PATH]),
+        Stage('get_pseudogenes_no_hits_fasta', get_pseudogenes_without_blast_hits_fasta,
+              inputs=[BLAST_RESULTS_FILE, COMBINED_STRAIN_PSEUDOGENES_PATH],
+              outputs=[COMBINED_PSEUDOGENES_WITHOUT_BLAST_HIT_PATH]),
+        Stage('get_core_clusters_nums', log_core_clusters_nums, inputs=[CD_HIT_CLUSTERS_OUTPUT_FILE]),
+        Stage('export_protein_core_clusters', export_protein_clusters_to_nucleotide_fasta_files,
+              inputs=[STRAINS_DIR, STRAIN_MANIFEST_PATH, SEQUENCE_STORES_DIR, CD_HIT_CLUSTERS_OUTPUT_FILE], outputs=[CLUSTERS_NT_SEQS_DIR]),
+        Stage('perform_alignment_on_clusters', perform_alignment_on_core_clusters,
+              inputs=[CLUSTERS_NT_SEQS_DIR], outputs=[CLUSTERS_ALIGNMENTS_DIR]),
+        Stage('prepare_alignments_for_tree', prepare_alignments_for_tree, args=(log_queue,),
+              inputs=[CLUSTERS_NT_SEQS_DIR, CLUSTERS_ALIGNMENTS_DIR], outputs=[ALIGNMENTS_FOR_TREE_DIR, SUPERMATRIX_DIR, CONCATENATED_ALIGNMENT_PATH,
+                                                          CONCATENATED_ALIGNMENT_PARTITIONS_PATH]),
+        Stage('format_tree_alignment', format_concatenated_alignment,
+              args=(args.max_strain_missing, args.max_column_missing, args.tree_partitions, args.tree_alignment_format),
+              inputs=[SUPERMATRIX_DIR], outputs=[FILTERED_TREE_ALIGNMENT_PATH],
+              params={'max_strain_missing': args.max_strain_missing, 'max_column_missing': args.max_column_missing,
+                      'tree_partitions': args.tree_partitions, 'tree_alignment_format': args.tree_alignment_format}),
+    ]
+
+
+def save_1st_stage_stats():
+    logging.getLogger(__name__).info("Gathering genomic and 1st stage clusters statistics per strain")
+    get_1st_stage_stats_per_strain().to_pickle(FIRST_STAGE_STATS_PKL)
+
+
+def save_2nd_stage_stats():
+    logging.getLogger(__name__).info("Gathering 2nd stage clusters statistics per strain")
+    strains_df, clusters_df = get_2nd_stage_stats_per_strain(pandas.read_pickle(FIRST_STAGE_STATS_PKL))
+    strains_df.to_pickle(SECOND_STAGE_STRAIN_STATS_PKL)
+    clusters_df.to_pickle(SECOND_STAGE_CLUSTER_STATS_PKL)
+
+
+def save_2nd_stage_cluster_stats():
+    logging.getLogger(__name__).info("Gathering 2nd stage clusters statistics per cluster as CSV file")
+    cluster_stats = get_2nd_stage_stats_per_cluster()
+    cluster_stats.to_pickle(SECOND_STAGE_AGGREGATED_CLUSTER_STATS_PKL)
+    cluster_stats.to_csv(SECOND_STAGE_STATS_CSV)
+
+
+def export_stats_pkl_to_csv(stats_pkl, stats_csv):
+    pandas.read_pickle(stats_pkl).to_csv(stats_csv)
+
+
+def plot_1st_stage_charts():
+    logging.getLogger(__name__).info("Plotting charts from 1st stage statistics")
+    create_1st_stage_charts(pandas.read_pickle(FIRST_STAGE_STATS_PKL))
+
+
+def plot_2nd_stage_charts():
+    logging.getLogger(__name__).info("Plotting charts from 2nd stage statistics")
+    create_2nd_stage_charts(pandas.read_pickle(SECOND_STAGE_STRAIN_STATS_PKL),
+                            pandas.read_pickle(SECOND_STAGE_CLUSTER_STATS_PKL))
+
+
+def log_core_clusters_nums():
+    logger = logging.getLogger(__name__)
+    core_clusters, core_clusters_with_multiple_strain_seqs = get_core_clusters()
+    logger.info("Core clusters without multiple strain appearances: %d" % len(core_clusters))
+    logger.info("Core clusters with multiple strain appearances: %d" % len(core_clusters_with_multiple_strain_seqs))
+
+
 def init_args_parser():
     parser = argparse.ArgumentParser(description='Data processing pipeline for pseudogene search '
                                                  'in Pseudomonas Areguinosa strains')
     parser.add_argument('-dl', '--download', action="store_true", help='Download all valid PA strains from the refseq ftp for analysis')
     parser.add_argument('--sample', type=int, dest='sample_size', default=None,
                         help='Specify a sample size to limit the amount of strains downloaded')
+    parser.add_argument('--download_url', default=NCBI_BASE_URL,
+                        help='Base ftp:// or https:// url of the NCBI genomes tree (or a mirror of it) to download from')
+    parser.add_argument('--download_concurrency', type=int, default=DOWNLOAD_CONCURRENCY,
+                        help='Maximal number of concurrent downloads')
+    parser.add_argument('-is', '--ingest_sequences', action="store_true",
+                        help='Parse downloaded PA strains cds into sequence stores used by all later stages')
     parser.add_argument('-p', '--preprocess_proteins', action="store_true", help='Preprocess downloaded PA strains proteins')
     parser.add_argument('-c', '--cluster_proteins', action="store_true", help='Run CD-HIT clustering on preprocessed PA strains proteins')
+    parser.add_argument('--full_clustering', action="store_true",
+                        help='Recluster all strains proteins instead of clustering only the proteins of new strains')
+    parser.add_argument('--protein_identity', type=float, default=PROTEIN_CLUSTERING_IDENTITY,
+                        help='CD-HIT sequence identity threshold for clustering proteins')
+    parser.add_argument('--protein_word_size', type=int, default=None,
+                        help='CD-HIT word size for clustering proteins, by default the largest valid for the threshold')
+    parser.add_argument('--cds_identity', type=float, default=CDS_CLUSTERING_IDENTITY,
+                        help='CD-HIT-EST sequence identity threshold for clustering cds')
+    parser.add_argument('--cds_word_size', type=int, default=None,
+                        help='CD-HIT-EST word size for clustering cds, by default the largest valid for the threshold')
+    parser.add_argument('--cd_hit_memory', type=int, default=CD_HIT_MEMORY_BUDGET,
+                        help='CD-HIT memory budget in MB, by default most of the available memory')
     parser.add_argument('-s1', '--protein_stats', action="store_true", help='Get stats from CD-HIT clustering output')
     parser.add_argument('-s1csv', '--get_1st_stage_stats_csv', action="store_true", help='Get stage 1 stats in csv')
     parser.add_argument('-s2', '--nucleotide_stats', action="store_true", help='Get stats from CD-HIT-EST clustering output')
@@ -164,6 +226,18 @@ def init_args_parser():
                         help='Perform MAFFT alignment & Gblocks pruning on core clusters fasta files')
     parser.add_argument('-paft', '--prepare_alignments_for_tree', action="store_true",
                         help='Edit, pad and concat all alignments for creating a phylogenetic tree')
+    parser.add_argument('-fta', '--format_tree_alignment', action="store_true",
+                        help='Write the concatenated alignment without missing strains as the tree input alignment')
+    parser.add_argument('--max_strain_missing', type=float, default=None,
+                        help='Drop strains with a larger fraction of gaps & unknown characters from the tree alignment')
+    parser.add_argument('--max_column_missing', type=float, default=None,
+                        help='Drop positions with a larger fraction of gaps & unknown characters from the tree alignment')
+    parser.add_argument('--tree_partitions', nargs='+', default=None,
+                        help='Limit the tree alignment to these core clusters (e.g. cluster_12)')
+    parser.add_argument('--tree_alignment_format', choices=['fasta', 'phylip'], default='fasta',
+                        help='Format of the tree alignment')
+    parser.add_argument('--force', action="store_true",
+                        help='Rerun the selected stages even if their inputs & outputs are unchanged')
     parser.add_argument('-in', '--input', help='Get input file')
     parser.add_argument('-out', '--output', help='Get output file')
     return parser
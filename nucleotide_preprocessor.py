@@ -1,43 +1,33 @@
-import gzip
 import logging
 import multiprocessing
 import os
 import shutil
 
-from Bio import SeqIO
+import numpy
 
+from fasta_io import BufferedFastaWriter, fasta_title
 from logging_config import worker_configurer
-from constants import DATA_DIR, STRAINS_DIR, NUMBER_OF_PROCESSES, FASTA_FILE_TYPE, CDS_FROM_GENOMIC_PATTERN, \
-    STRAIN_INDEX_FILE, CLUSTER_STRAIN_PATTERN, COMBINED_STRAIN_CDS_PREFIX, WORKER_CDS_FILE_PREFIX, \
-    COMBINED_CDS_FILE_PATH, CD_HIT_CLUSTERS_OUTPUT_FILE
-
-
-class Representative:
-    def __init__(self, position, cluster_index):
-        self.position = position
-        self.cluster_index = cluster_index
-
-
-class StrainData:
-    def __init__(self, index, reps, strain_dir):
-        self.index = index
-        self.representatives = reps
-        self.dir = strain_dir
+from sequence_dedup import collapse_duplicate_sequences
+from sequence_store import load_sequence_store
+from strain_manifest import load_strain_manifest
+from constants import DATA_DIR, NUMBER_OF_PROCESSES, CLUSTER_STRAIN_PATTERN, COMBINED_STRAIN_CDS_PREFIX, \
+    WORKER_CDS_FILE_PREFIX, COMBINED_CDS_FILE_PATH, CD_HIT_CLUSTERS_OUTPUT_FILE, PICKLES_DIR, CLUSTER_REPRESENTATIVES_NPY, \
+    COMBINED_UNIQUE_CDS_FILE_PATH, DUPLICATES_FILE_SUFFIX
 
 
 def create_representatives_and_pseudogenes_file(log_queue):
     """
     Preprocess all strains representative and pseudogene nucleutide sequences in parallel and combine all worker output
-    files into single fasta file for clustering
+    files into single fasta file, collapsing identical cds into a unique cds fasta file for clustering
     """
     logger = logging.getLogger(__name__)
     logger.info("Preprocessing cds sequences for cluster representative proteins and pseudogenes")
-    representatives = get_clusters_representatives(CD_HIT_CLUSTERS_OUTPUT_FILE)
+    save_clusters_representatives(CD_HIT_CLUSTERS_OUTPUT_FILE, CLUSTER_REPRESENTATIVES_NPY)
     for file in os.listdir(DATA_DIR):
         if COMBINED_STRAIN_CDS_PREFIX in file:
             os.remove(os.path.join(DATA_DIR, file))
     job_queue = multiprocessing.Queue()
-    prepare_preprocessing_jobs(job_queue, representatives)
+    prepare_preprocessing_jobs(job_queue)
     workers = [multiprocessing.Process(target=preprocess_strain_cds, args=(i, job_queue, worker_configurer, log_queue))
                for i in range(NUMBER_OF_PROCESSES)]
     for w in workers:
@@ -50,10 +40,16 @@ def create_representatives_and_pseudogenes_file(log_queue):
         for worker_file in worker_combined_cds_files:
             with open(os.path.join(DATA_DIR, worker_file), 'r') as srcd:
                 shutil.copyfileobj(srcd, dstd)
+    collapse_duplicate_sequences(COMBINED_CDS_FILE_PATH, COMBINED_UNIQUE_CDS_FILE_PATH,
+                                 COMBINED_UNIQUE_CDS_FILE_PATH + DUPLICATES_FILE_SUFFIX)
 
 
-def get_clusters_representatives(clusters_file):
-    representatives = {}
+def save_clusters_representatives(clusters_file, representatives_file):
+    """
+    Save the (strain index, position in genome, cluster index) of all 1st stage cluster representatives as an array
+    sorted by strain index & position, to be memory-mapped by the preprocessing workers
+    """
+    representatives = []
     with open(clusters_file, 'r') as clusters_db:
         for line in clusters_db:
             if line.startswith(">Cluster"):
@@ -61,26 +57,23 @@ def get_clusters_representatives(clusters_file):
             else:
                 if "*" in line:
                     match = CLUSTER_STRAIN_PATTERN.match(line)
-                    strain_index = int(match.group(1))
-                    strain_reps = representatives[strain_index] if strain_index in representatives.keys() else []
-                    strain_reps.append(Representative(int(match.group(2)), cluster_index))
-                    representatives[strain_index] = strain_reps
-    return representatives
+                    representatives.append((int(match.group(1)), int(match.group(2)), cluster_index))
+    representatives_table = numpy.array(sorted(representatives), dtype=numpy.int64).reshape(-1, 3)
+    if not os.path.exists(PICKLES_DIR):
+        os.makedirs(PICKLES_DIR)
+    numpy.save(representatives_file, representatives_table)
 
 
-def prepare_preprocessing_jobs(job_queue, representatives):
-    """Put all downloaded strain data in job queue for workers"""
-    downloaded_strains = os.listdir(STRAINS_DIR)
-    for strain_dir in downloaded_strains:
-        strain_index = get_strain_index(strain_dir)
-        strain_reps = representatives[strain_index] if strain_index in representatives.keys() else []
-        strain_data = StrainData(strain_index, strain_reps, strain_dir)
-        job_queue.put(strain_data)
+def get_strain_representatives(representatives_table, strain_index):
+    """Get a position in genome -> cluster index lookup of a strain's representatives from the sorted table"""
+    start, end = numpy.searchsorted(representatives_table[:, 0], [strain_index, strain_index + 1])
+    return dict(zip(representatives_table[start:end, 1].tolist(), representatives_table[start:end, 2].tolist()))
 
 
-def get_strain_index(strain_dir):
-    with open(os.path.join(STRAINS_DIR, strain_dir, STRAIN_INDEX_FILE)) as f:
-        return int(f.readline())
+def prepare_preprocessing_jobs(job_queue):
+    """Put the dirs of all downloaded strains from the strain manifest in job queue for workers"""
+    for strain in load_strain_manifest():
+        job_queue.put(strain['dir'])
 
 
 def preprocess_strain_cds(worker_id, job_queue, configurer, log_queue):
@@ -91,36 +84,28 @@ def preprocess_strain_cds(worker_id, job_queue, configurer, log_queue):
     configurer(log_queue)
     logger = logging.getLogger(__name__ + "_worker_" + str(worker_id))
     worker_combined_cds_file_path = os.path.join(DATA_DIR, WORKER_CDS_FILE_PREFIX + str(worker_id))
-    while True:
-        strain_data = job_queue.get()
-        if strain_data is None:
-            job_queue.put(None)
-            break
-        strain_dir = strain_data.dir
-        strain_dir_files = os.listdir(os.path.join(STRAINS_DIR, strain_dir))
-        cds_file_name = [f for f in strain_dir_files if CDS_FROM_GENOMIC_PATTERN in f][0]
-        cds_file = worker_combined_cds_file = None
-        try:
-            if cds_file_name.endswith('gz'):
-                cds_file = gzip.open(os.path.join(STRAINS_DIR, strain_dir, cds_file_name), 'rt')
-            else:
-                cds_file = open(os.path.join(STRAINS_DIR, strain_dir, cds_file_name))
-            strain_cds_seq_iter = SeqIO.parse(cds_file, FASTA_FILE_TYPE)
-            for strain_cds_seq in strain_cds_seq_iter:
-                seq_position_in_genome = int(strain_cds_seq.id[strain_cds_seq.id.rfind("_") + 1:])
-                rep = [r for r in strain_data.representatives if seq_position_in_genome == r.position]
-                pseudo = "pseudo=true" in strain_cds_seq.description
-                if rep or pseudo:
-                    strain_cds_seq.id = ""
-                    strain_cds_seq.description = "[" + str(strain_data.index) + "]" + "[" + str(seq_position_in_genome) + "]"\
-                                                 + "{info}".format(info="[cluster_" + str(rep[0].cluster_index) + "]" if rep else "[pseudo]")\
-                                                 + strain_cds_seq.description
-                    worker_combined_cds_file = open(worker_combined_cds_file_path, 'a+')
-                    SeqIO.write(strain_cds_seq, worker_combined_cds_file, FASTA_FILE_TYPE)
+    representatives_table = numpy.load(CLUSTER_REPRESENTATIVES_NPY, mmap_mode='r')
+    strain_manifest = load_strain_manifest()
+    with BufferedFastaWriter(worker_combined_cds_file_path) as worker_combined_cds_file:
+        while True:
+            strain_dir = job_queue.get()
+            if strain_dir is None:
+                job_queue.put(None)
+                break
+            strain = strain_manifest.get(strain_dir)
+            strain_index = strain['index']
+            strain_representatives = get_strain_representatives(representatives_table, strain_index)
+            strain_sequence_store = load_sequence_store(strain)
+            selected_rows = numpy.flatnonzero(numpy.isin(strain_sequence_store.position, list(strain_representatives))
+                                              | strain_sequence_store.pseudo)
+            for row, header, seq in strain_sequence_store.records(selected_rows.tolist()):
+                seq_position_in_genome = int(strain_sequence_store.position[row])
+                rep_cluster_index = strain_representatives.get(seq_position_in_genome)
+                description = "[" + str(strain_index) + "]" + "[" + str(seq_position_in_genome) + "]"\
+                              + "{info}".format(info="[cluster_" + str(rep_cluster_index) + "]" if rep_cluster_index is not None else "[pseudo]")\
+                              + header
+                worker_combined_cds_file.write(fasta_title("", description), seq)
             logger.info(
                 "Strain %s reps and pseudogenes were indexed and written to file" % strain_dir[strain_dir.rfind(']') + 1:])
-        finally:
-            if cds_file is not None:
-                cds_file.close()
-            if worker_combined_cds_file is not None:
-                worker_combined_cds_file.close()
+    logger.info("Worker %d wrote %d cds (%d bytes)" % (worker_id, worker_combined_cds_file.records_written,
+                                                      worker_combined_cds_file.bytes_written))
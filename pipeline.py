@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+from multiprocessing.connection import wait
+
+from logging_config import worker_configurer
+
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class Stage:
+    """
+    A pipeline stage which produces its output paths from its input paths by calling run(*args).
+    Stages depend on the stages producing their inputs, and stages without outputs are actions which always run.
+    always_run stages depend on state outside the local files (e.g. a remote server), so they run whenever they are
+    targets, and as dependencies of other targets only when their outputs are stale
+    """
+    def __init__(self, name, run, args=(), inputs=(), outputs=(), params=None, always_run=False):
+        self.name = name
+        self.run = run
+        self.args = args
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = json.loads(json.dumps(params or {}))
+        self.always_run = always_run
+
+
+class Pipeline:
+    """
+    Runs the stale stages needed for a set of target stages in dependency order, running independent stages
+    concurrently in separate processes. A manifest records the content hashes of each stage's inputs & outputs and
+    its parameters when it last succeeded, so a stage is stale only if these changed or its outputs are missing.
+    Existing outputs of a stage without a record (e.g. on a data dir from before the manifest) are adopted as they are,
+    unless a dependency of the stage ran
+    """
+    def __init__(self, stages, manifest_path, log_queue):
+        self.stages = {stage.name: stage for stage in stages}
+        self.manifest_path = manifest_path
+        self.log_queue = log_queue
+        self.producers = {output: stage.name for stage in stages for output in stage.outputs}
+        self.manifest = {'stages': {}, 'files': {}}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def get_dependencies(self, stage_name):
+        stage = self.stages[stage_name]
+        return {self.producers[path] for path in stage.inputs if path in self.producers} - {stage_name}
+
+    def resolve(self, targets):
+        """Get the targets and all their transitive dependencies in dependency order"""
+        ordered = []
+        visiting = set()
+
+        def visit(stage_name):
+            if stage_name in ordered:
+                return
+            if stage_name in visiting:
+                raise ValueError("Dependency cycle found at stage %s" % stage_name)
+            visiting.add(stage_name)
+            for dependency in sorted(self.get_dependencies(stage_name)):
+                visit(dependency)
+            visiting.remove(stage_name)
+            ordered.append(stage_name)
+
+        for target in targets:
+            visit(target)
+        return ordered
+
+    def is_stale(self, stage, dependencies_ran=False, is_target=False):
+        if not stage.outputs or (stage.always_run and is_target):
+            return True
+        if not all(path_exists(path) for path in stage.outputs):
+            return True
+        record = self.manifest['stages'].get(stage.name)
+        if record is None:
+            return dependencies_ran
+        return record['params'] != stage.params or record['inputs'] != self.get_digests(stage.inputs) or \
+            record['outputs'] != self.get_digests(stage.outputs)
+
+    def run(self, targets, force=False):
+        """Run the stale stages among the targets & their dependencies, returning the names of failed stages"""
+        pending = self.resolve(targets)
+        finished = set()
+        ran = set()
+        failed = set()
+        running = {}
+        while pending or running:
+            for stage_name in [s for s in pending if self.get_dependencies(s) <= finished | failed]:
+                pending.remove(stage_name)
+                stage = self.stages[stage_name]
+                failed_dependencies = self.get_dependencies(stage_name) & failed
+                missing_inputs = [path for path in stage.inputs if path not in self.producers and not path_exists(path)]
+                if failed_dependencies or missing_inputs:
+                    logger.error("Cannot run stage %s, failed dependencies: %s, missing inputs: %s"
+                                 % (stage_name, sorted(failed_dependencies), missing_inputs))
+                    failed.add(stage_name)
+                elif (force and stage_name in targets) or \
+                        self.is_stale(stage, bool(self.get_dependencies(stage_name) & ran), stage_name in targets):
+                    logger.info("Running stage %s" % stage_name)
+                    process = multiprocessing.Process(target=run_stage, args=(stage, worker_configurer, self.log_queue))
+                    process.start()
+                    running[process.sentinel] = (stage, process)
+                else:
+                    if stage.outputs and stage_name not in self.manifest['stages']:
+                        logger.info("Adopting existing outputs of stage %s" % stage_name)
+                        self.record(stage)
+                    else:
+                        logger.info("Stage %s is up to date, skipping" % stage_name)
+                    finished.add(stage_name)
+            if not running:
+                continue
+            for sentinel in wait(list(running.keys())):
+                stage, process = running.pop(sentinel)
+                process.join()
+                if process.exitcode == 0:
+                    logger.info("Finished stage %s" % stage.name)
+                    self.record(stage)
+                    finished.add(stage.name)
+                    ran.add(stage.name)
+                else:
+                    logger.error("Stage %s failed with exit code %d" % (stage.name, process.exitcode))
+                    self.manifest['stages'].pop(stage.name, None)
+                    self.save_manifest()
+                    failed.add(stage.name)
+        return failed
+
+    def record(self, stage):
+        if stage.outputs:
+            self.manifest['stages'][stage.name] = {'params': stage.params,
+                                                   'inputs': self.get_digests(stage.inputs),
+                                                   'outputs': self.get_digests(stage.outputs)}
+        self.save_manifest()
+
+    def save_manifest(self):
+        manifest_dir = os.path.dirname(self.manifest_path)
+        if not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+        with open(self.manifest_path + ".tmp", 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def get_digests(self, paths):
+        return {path: self.get_digest(path) for path in paths}
+
+    def get_digest(self, path):
+        """Content hash of a file, or of a directory's relative file paths & file hashes"""
+        if not path_exists(path):
+            return None
+        if os.path.isfile(path):
+            return self.get_file_digest(path)
+        dir_hash = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                dir_hash.update(os.path.relpath(file_path, path).encode())
+                dir_hash.update(self.get_file_digest(file_path).encode())
+        return dir_hash.hexdigest()
+
+    def get_file_digest(self, path):
+        """Content hash of a file, reusing the hash recorded in the manifest while the file's size & mtime are unchanged"""
+        stat = os.stat(path)
+        cached = self.manifest['files'].get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                file_hash.update(block)
+        self.manifest['files'][path] = [stat.st_size, stat.st_mtime_ns, file_hash.hexdigest()]
+        return file_hash.hexdigest()
+
+
+def path_exists(path):
+    return os.path.isfile(path) or (os.path.isdir(path) and len(os.listdir(path)) > 0)
+
+
+def run_stage(stage, configurer, log_queue):
+    configurer(log_queue)
+    result = stage.run(*stage.args)
+    exit(1 if isinstance(result, int) and not isinstance(result, bool) and result != 0 else 0)
@@ -6,15 +6,20 @@ import shutil
 
 from Bio import SeqIO
 
+from fasta_io import BufferedFastaWriter
 from logging_config import worker_configurer
-from constants import DATA_DIR, STRAINS_DIR, NUMBER_OF_PROCESSES, FASTA_FILE_TYPE, PROTEIN_FILE_PATTERN, \
-    CDS_FROM_GENOMIC_PATTERN, STRAIN_INDEX_FILE, COMBINED_STRAIN_PROTEINS_PREFIX, WORKER_PROTEIN_FILE_PREFIX, \
-    COMBINED_PROTEINS_FILE_PATH
+from sequence_dedup import collapse_duplicate_sequences
+from sequence_store import load_sequence_store
+from strain_manifest import load_strain_manifest, strain_file_path
+from constants import DATA_DIR, NUMBER_OF_PROCESSES, FASTA_FILE_TYPE, PROTEIN_FILE_PATTERN, \
+    CDS_FROM_GENOMIC_PATTERN, COMBINED_STRAIN_PROTEINS_PREFIX, WORKER_PROTEIN_FILE_PREFIX, \
+    COMBINED_PROTEINS_FILE_PATH, COMBINED_UNIQUE_PROTEINS_FILE_PATH, DUPLICATES_FILE_SUFFIX
 
 
 def create_all_strains_file_with_indices(log_queue):
     """
-    Preprocess all strains proteins in parallel and combine all worker output files into single fasta file for clustering
+    Preprocess all strains proteins in parallel and combine all worker output files into single fasta file, collapsing
+    identical proteins into a unique proteins fasta file for clustering
     """
     logger = logging.getLogger(__name__)
     logger.info("Indexing proteins by their strain index & protein index in strain gene")
@@ -35,13 +40,14 @@ def create_all_strains_file_with_indices(log_queue):
         for worker_file in worker_combined_protein_files:
             with open(os.path.join(DATA_DIR, worker_file), 'r') as srcd:
                 shutil.copyfileobj(srcd, dstd)
+    collapse_duplicate_sequences(COMBINED_PROTEINS_FILE_PATH, COMBINED_UNIQUE_PROTEINS_FILE_PATH,
+                                 COMBINED_UNIQUE_PROTEINS_FILE_PATH + DUPLICATES_FILE_SUFFIX)
 
 
 def prepare_preprocessing_jobs(job_queue):
-    """Put all downloaded strain dirs in job queue for workers"""
-    downloaded_strains = os.listdir(STRAINS_DIR)
-    for strain_dir in downloaded_strains:
-        job_queue.put(strain_dir)
+    """Put all downloaded strains from the strain manifest in job queue for workers"""
+    for strain in load_strain_manifest():
+        job_queue.put(strain)
 
 
 def preprocess_strain_proteins(worker_id, job_queue, configurer, log_queue):
@@ -52,50 +58,54 @@ def preprocess_strain_proteins(worker_id, job_queue, configurer, log_queue):
     configurer(log_queue)
     logger = logging.getLogger(__name__ + "_worker_" + str(worker_id))
     worker_combined_proteins_file_path = os.path.join(DATA_DIR, WORKER_PROTEIN_FILE_PREFIX + str(worker_id))
-    while True:
-        strain_dir = job_queue.get()
-        if strain_dir is None:
-            job_queue.put(None)
-            break
-        strain_dir_files = os.listdir(os.path.join(STRAINS_DIR, strain_dir))
-        protein_file_name = [f for f in strain_dir_files if PROTEIN_FILE_PATTERN in f][0]
-        cds_file_name = [f for f in strain_dir_files if CDS_FROM_GENOMIC_PATTERN in f][0]
-        if not protein_file_name or not cds_file_name:
-            logger.warning(
-                "Could not find protein file or cds_from_genomic file for strain %s, skipping" % strain_dir)
-            continue
-        protein_file = cds_file = strain_index_file = worker_combined_proteins_file = None
-        try:
-            strain_index_file = open(os.path.join(STRAINS_DIR, strain_dir, STRAIN_INDEX_FILE))
-            strain_index = '[' + strain_index_file.readline() + ']'
-            if protein_file_name.endswith('gz'):
-                protein_file = gzip.open(os.path.join(STRAINS_DIR, strain_dir, protein_file_name), 'rt')
-            else:
-                protein_file = open(os.path.join(STRAINS_DIR, strain_dir, protein_file_name))
-            if cds_file_name.endswith('gz'):
-                cds_file = gzip.open(os.path.join(STRAINS_DIR, strain_dir, cds_file_name), 'rt')
-            else:
-                cds_file = open(os.path.join(STRAINS_DIR, strain_dir, cds_file_name))
+    with BufferedFastaWriter(worker_combined_proteins_file_path) as worker_combined_proteins_file:
+        while True:
+            strain = job_queue.get()
+            if strain is None:
+                job_queue.put(None)
+                break
+            strain_dir = strain['dir']
+            protein_file_path = strain_file_path(strain, PROTEIN_FILE_PATTERN)
+            if not protein_file_path or not strain_file_path(strain, CDS_FROM_GENOMIC_PATTERN):
+                logger.warning(
+                    "Could not find protein file or cds_from_genomic file for strain %s, skipping" % strain_dir)
+                continue
+            protein_file = None
+            try:
+                strain_index = '[' + str(strain['index']) + ']'
+                if protein_file_path.endswith('gz'):
+                    protein_file = gzip.open(protein_file_path, 'rt')
+                else:
+                    protein_file = open(protein_file_path)
 
-            strain_cds_seq_dict = SeqIO.to_dict(SeqIO.parse(cds_file, FASTA_FILE_TYPE))
-            strain_cds_seq_headers = list(strain_cds_seq_dict.keys())
-            strain_protein_seq_iter = SeqIO.parse(protein_file, FASTA_FILE_TYPE)
-            for strain_protein_seq in strain_protein_seq_iter:
-                protein_id = strain_protein_seq.id
-                cds_protein_header = [h for h in strain_cds_seq_headers if protein_id in h][0]
-                protein_index_in_gene = '[' + cds_protein_header[cds_protein_header.rfind('_') + 1:] + ']'
-                strain_protein_seq.description = strain_index + protein_index_in_gene + strain_protein_seq.description
-                strain_protein_seq.id = ""
-                worker_combined_proteins_file = open(worker_combined_proteins_file_path, 'a+')
-                SeqIO.write(strain_protein_seq, worker_combined_proteins_file, FASTA_FILE_TYPE)
-            logger.info(
-                "Strain %s proteins were indexed and written to file" % strain_dir[strain_dir.rfind(']') + 1:])
-        finally:
-            if protein_file is not None:
-                protein_file.close()
-            if cds_file is not None:
-                cds_file.close()
-            if worker_combined_proteins_file is not None:
-                worker_combined_proteins_file.close()
-            if strain_index_file is not None:
-                strain_index_file.close()
+                cds_protein_positions = build_cds_protein_index(load_sequence_store(strain))
+                strain_protein_seq_iter = SeqIO.parse(protein_file, FASTA_FILE_TYPE)
+                for strain_protein_seq in strain_protein_seq_iter:
+                    protein_id = strain_protein_seq.id
+                    cds_protein_position = cds_protein_positions.get(protein_id)
+                    if cds_protein_position is None:
+                        logger.warning("Could not find cds for protein %s in strain %s, skipping" % (protein_id, strain_dir))
+                        continue
+                    protein_index_in_gene = '[' + cds_protein_position + ']'
+                    strain_protein_seq.description = strain_index + protein_index_in_gene + strain_protein_seq.description
+                    strain_protein_seq.id = ""
+                    worker_combined_proteins_file.write_record(strain_protein_seq)
+                logger.info(
+                    "Strain %s proteins were indexed and written to file" % strain_dir[strain_dir.rfind(']') + 1:])
+            finally:
+                if protein_file is not None:
+                    protein_file.close()
+    logger.info("Worker %d wrote %d proteins (%d bytes)" % (worker_id, worker_combined_proteins_file.records_written,
+                                                           worker_combined_proteins_file.bytes_written))
+
+
+def build_cds_protein_index(strain_sequence_store):
+    """
+    Map each protein_id in a strain's cds sequence store to the position of its cds in the strain genome.
+    The first cds of a protein wins, as proteins may be shared by several cds.
+    """
+    cds_protein_positions = {}
+    for protein_id, position in zip(strain_sequence_store.protein_id.tolist(), strain_sequence_store.position.tolist()):
+        if protein_id:
+            cds_protein_positions.setdefault(protein_id.decode(), str(position))
+    return cds_protein_positions
@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import mmap
+import os
+import re
+
+import numpy
+
+from cluster_store import iter_clusters_file, write_cluster
+from constants import ALIGNMENT_STRAIN_PATTERN, DUPLICATE_TITLE_MAX_LENGTH
+from fasta_io import open_fasta_buffer, iter_fasta_headers
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_MEMBER_LINE_PATTERN = re.compile("^(\d+(aa|nt)), >(.*?)(\.\.\.)? (\*|at .*)$")
+
+
+def collapse_duplicate_sequences(fasta_file_path, unique_file_path, duplicates_file_path):
+    """
+    Write the records of a [strain][seq] indexed fasta file to unique_file_path, keeping only the record with the
+    lowest (strain index, seq index) of each set of identical sequences. Each collapsed set is written as a line of
+    the duplicates file - the sequence hash, the kept record's title and the titles of its duplicates, tab separated.
+    As strains are indexed in the order they are added, duplicates are always kept in existing strains' records
+    """
+    with open_fasta_buffer(fasta_file_path) as buffer:
+        offsets = []
+        keys = []
+        digests = bytearray()
+        previous_offset = None
+        for offset, header in iter_fasta_headers(buffer):
+            if previous_offset is not None:
+                digests += sequence_digest(buffer, previous_offset, offset)
+            strain_match = ALIGNMENT_STRAIN_PATTERN.search(header.decode())
+            if not strain_match:
+                raise ValueError("Record %s in %s has no [strain][seq] index" % (header.decode(), fasta_file_path))
+            offsets.append(offset)
+            keys.append((int(strain_match.group(1)), int(strain_match.group(2))))
+            previous_offset = offset
+        if previous_offset is not None:
+            digests += sequence_digest(buffer, previous_offset, len(buffer))
+        offsets.append(len(buffer))
+
+        digests = numpy.frombuffer(bytes(digests), dtype=numpy.uint64).reshape(-1, 2)
+        keys = numpy.array(keys, dtype=numpy.int64).reshape(-1, 2)
+        order = numpy.lexsort((keys[:, 1], keys[:, 0], digests[:, 1], digests[:, 0]))
+        sorted_digests = digests[order]
+        group_starts = numpy.flatnonzero(numpy.concatenate(
+            ([True], (sorted_digests[1:] != sorted_digests[:-1]).any(axis=1)))) if len(order) else order
+        is_kept = numpy.zeros(len(order), dtype=bool)
+        is_kept[order[group_starts]] = True
+
+        with open(unique_file_path, 'wb') as unique_file:
+            for record in numpy.flatnonzero(is_kept).tolist():
+                unique_file.write(buffer[offsets[record]:offsets[record + 1]])
+        with open(duplicates_file_path, 'w') as duplicates_file:
+            group_ends = numpy.concatenate((group_starts[1:], [len(order)])).astype(numpy.int64)
+            for start, end in zip(group_starts.tolist(), group_ends.tolist()):
+                if end - start > 1:
+                    titles = [record_title(buffer, offsets[record]) for record in order[start:end].tolist()]
+                    duplicates_file.write("%016x%016x\t%s\n" % (int(sorted_digests[start, 0]),
+                                                               int(sorted_digests[start, 1]), "\t".join(titles)))
+    unique_count = int(is_kept.sum())
+    logger.info("Collapsed %d sequences of %s into %d unique sequences" % (len(is_kept), fasta_file_path, unique_count))
+    return len(is_kept), unique_count
+
+
+def sequence_digest(buffer, offset, end):
+    seq_start = buffer.find(b"\n", offset, end) + 1 or end
+    return hashlib.blake2b(bytes(buffer[seq_start:end]).translate(None, b" \t\r\n"), digest_size=16).digest()
+
+
+def record_title(buffer, offset):
+    """Title of the record at offset, as CD-HIT would read it, cut to DUPLICATE_TITLE_MAX_LENGTH"""
+    header_end = buffer.find(b"\n", offset)
+    header = bytes(buffer[offset + 1:header_end if header_end != -1 else len(buffer)])
+    return header.decode().strip().replace("\t", " ")[:DUPLICATE_TITLE_MAX_LENGTH]
+
+
+def expand_duplicate_members(clusters_file, duplicates_file_path):
+    """
+    Add the collapsed duplicates of the members of a CD-HIT .clstr file of unique sequences right after them in their
+    clusters, as 100% identity members, so the clusters file lists every [strain][seq] record. Duplicates already in
+    the clusters file are skipped, so expanding is idempotent
+    """
+    if not os.path.exists(duplicates_file_path) or os.path.getsize(duplicates_file_path) == 0:
+        return 0
+    present_keys = set()
+    for _, members in iter_clusters_file(clusters_file):
+        present_keys.update(member_key(member) for member in members)
+    added_members = 0
+    with open(duplicates_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as duplicates:
+        kept_offsets = index_duplicates(duplicates)
+        with open(clusters_file + ".tmp", 'w') as output:
+            for cluster_id, members in iter_clusters_file(clusters_file):
+                expanded_members = []
+                for member in members:
+                    expanded_members.append(member)
+                    duplicates_offset = kept_offsets.get(member_key(member))
+                    if duplicates_offset is None:
+                        continue
+                    line_end = duplicates.find(b"\n", duplicates_offset)
+                    titles = duplicates[duplicates_offset:line_end].decode().split("\t")[2:]
+                    for title in titles:
+                        if title_key(title) not in present_keys:
+                            expanded_members.append(duplicate_member(member, title))
+                            added_members += 1
+                write_cluster(output, cluster_id, expanded_members)
+    os.replace(clusters_file + ".tmp", clusters_file)
+    logger.info("Expanded %d duplicate members into %s" % (added_members, clusters_file))
+    return added_members
+
+
+def index_duplicates(duplicates):
+    """Map the [strain][seq] key of each kept record to the offset of its line in the duplicates file"""
+    kept_offsets = {}
+    offset = 0
+    while offset < len(duplicates):
+        line_end = duplicates.find(b"\n", offset)
+        if line_end == -1:
+            line_end = len(duplicates)
+        kept_title_start = duplicates.find(b"\t", offset, line_end) + 1
+        kept_title_end = duplicates.find(b"\t", kept_title_start, line_end)
+        kept_offsets[title_key(duplicates[kept_title_start:kept_title_end].decode())] = offset
+        offset = line_end + 1
+    return kept_offsets
+
+
+def title_key(title):
+    strain_match = ALIGNMENT_STRAIN_PATTERN.search(title)
+    return int(strain_match.group(1)), int(strain_match.group(2))
+
+
+def member_key(member):
+    return title_key(member.split(">", 1)[1])
+
+
+def duplicate_member(member, title):
+    """
+    Build the .clstr member line of a duplicate of member, named as CD-HIT names members and with the identity of
+    member to its representative, or 100% if member is the representative
+    """
+    member_match = CLUSTER_MEMBER_LINE_PATTERN.match(member.rstrip("\n"))
+    if not member_match:
+        raise ValueError("Cluster member %s is not in CD-HIT .clstr format" % member.rstrip())
+    length, unit, name, ellipsis, identity = member_match.groups()
+    if ellipsis:
+        title = title[:len(name)] + "..."
+    if identity == "*":
+        identity = "at +/100.00%" if unit == "nt" else "at 100.00%"
+    return "%s, >%s %s\n" % (length, title, identity)
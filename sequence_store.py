@@ -0,0 +1,137 @@
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+
+import numpy
+
+from constants import SEQUENCE_STORES_DIR, CDS_FROM_GENOMIC_PATTERN, CDS_ID_PROTEIN_ID_PATTERN, NUMBER_OF_PROCESSES
+from fasta_io import open_fasta_buffer, iter_fasta_headers, parse_header_fields
+from fs_utils import building_dir, is_tmp_dir, read_json_file
+from strain_manifest import load_strain_manifest, strain_file_path
+
+logger = logging.getLogger(__name__)
+
+SEQUENCE_STORE_VERSION = 1
+SEQUENCE_STORE_META_FILE = "meta.json"
+SEQUENCE_STORE_HEADER_COLUMNS = ['locus_tag', 'protein_id', 'gene']
+SEQUENCE_STORE_ARRAYS = ['seqs', 'seq_offsets', 'headers', 'header_offsets', 'position', 'pseudo'] + \
+    SEQUENCE_STORE_HEADER_COLUMNS
+
+
+class SequenceStore:
+    """
+    Packed cds sequences of a single strain parsed from its cds_from_genomic file - uncompressed sequence & header
+    bytes blobs with offset arrays, and per-sequence header columns (position in genome, pseudo flag, locus_tag,
+    protein_id & gene). All arrays are memory-mapped .npy files indexed by the sequence's row in the cds file
+    """
+    def __init__(self, store_dir):
+        for array in SEQUENCE_STORE_ARRAYS:
+            setattr(self, array, numpy.load(os.path.join(store_dir, array + ".npy"), mmap_mode='r'))
+        self._rows_by_position = None
+
+    def __len__(self):
+        return len(self.position)
+
+    def seq(self, row):
+        return self.seqs[self.seq_offsets[row]:self.seq_offsets[row + 1]].tobytes().decode()
+
+    def header(self, row):
+        return self.headers[self.header_offsets[row]:self.header_offsets[row + 1]].tobytes().decode()
+
+    def row(self, position):
+        """Get the row of the sequence at a position (the 1st stage seq index) in the strain genome"""
+        if self._rows_by_position is None:
+            self._rows_by_position = {p: r for r, p in enumerate(self.position.tolist())}
+        return self._rows_by_position[position]
+
+    def records(self, rows=None):
+        """Iterate over the (row, header, seq) of the given rows, or of all sequences in file order"""
+        for row in range(len(self)) if rows is None else rows:
+            yield row, self.header(row), self.seq(row)
+
+
+def load_sequence_store(strain):
+    """
+    Load the sequence store of a strain manifest entry, (re)building it first if it is missing or the strain's
+    cds_from_genomic file changed since it was built
+    """
+    cds_file_path = strain_file_path(strain, CDS_FROM_GENOMIC_PATTERN)
+    if cds_file_path is None:
+        raise RuntimeError("Failed to find a cds file for strain %s" % strain['dir'])
+    store_dir = os.path.join(SEQUENCE_STORES_DIR, strain['dir'])
+    source_stat = os.stat(cds_file_path)
+    source_signature = {'version': SEQUENCE_STORE_VERSION, 'file': os.path.basename(cds_file_path),
+                        'size': source_stat.st_size, 'mtime_ns': source_stat.st_mtime_ns}
+    if read_store_meta(store_dir) == source_signature:
+        return SequenceStore(store_dir)
+    build_sequence_store(cds_file_path, store_dir, source_signature)
+    return SequenceStore(store_dir)
+
+
+def build_sequence_store(cds_file_path, store_dir, source_signature):
+    """Parse a cds_from_genomic fasta file once into packed sequence & header arrays persisted as .npy files"""
+    seqs = []
+    headers = []
+    columns = {column: [] for column in ['position', 'pseudo'] + SEQUENCE_STORE_HEADER_COLUMNS}
+    with open_fasta_buffer(cds_file_path) as buffer:
+        records = list(iter_fasta_headers(buffer))
+        for i, (offset, header) in enumerate(records):
+            header = header.rstrip()
+            seq_start = buffer.find(b"\n", offset) + 1 or len(buffer)
+            seq_end = records[i + 1][0] if i + 1 < len(records) else len(buffer)
+            seqs.append(bytes(buffer[seq_start:seq_end]).translate(None, b" \t\r\n"))
+            headers.append(header)
+            cds_id = header.split(None, 1)[0].decode() if header else ""
+            fields = parse_header_fields(header)
+            if 'protein_id' not in fields:
+                protein_id_match = CDS_ID_PROTEIN_ID_PATTERN.search(cds_id)
+                if protein_id_match:
+                    fields['protein_id'] = protein_id_match.group(1)
+            columns['position'].append(int(cds_id[cds_id.rfind('_') + 1:]))
+            columns['pseudo'].append(fields.get('pseudo') == "true")
+            for column in SEQUENCE_STORE_HEADER_COLUMNS:
+                columns[column].append(fields.get(column, "").encode())
+    arrays = {'seqs': numpy.frombuffer(b"".join(seqs), dtype=numpy.uint8),
+              'seq_offsets': numpy.concatenate(([0], numpy.cumsum([len(s) for s in seqs], dtype=numpy.int64))),
+              'headers': numpy.frombuffer(b"".join(headers), dtype=numpy.uint8),
+              'header_offsets': numpy.concatenate(([0], numpy.cumsum([len(h) for h in headers], dtype=numpy.int64))),
+              'position': numpy.array(columns['position'], dtype=numpy.int32),
+              'pseudo': numpy.array(columns['pseudo'], dtype=numpy.bool_)}
+    for column in SEQUENCE_STORE_HEADER_COLUMNS:
+        arrays[column] = numpy.array(columns[column], dtype=bytes)
+    with building_dir(store_dir, lambda d: read_store_meta(d) == source_signature) as tmp_store_dir:
+        for array in SEQUENCE_STORE_ARRAYS:
+            numpy.save(os.path.join(tmp_store_dir, array + ".npy"), arrays[array])
+        with open(os.path.join(tmp_store_dir, SEQUENCE_STORE_META_FILE), 'w') as f:
+            json.dump(source_signature, f)
+
+
+def read_store_meta(store_dir):
+    return read_json_file(os.path.join(store_dir, SEQUENCE_STORE_META_FILE))
+
+
+def iterate_strains_sequence_stores():
+    """Iterate over the strain manifest entry & sequence store of each downloaded strain in strain index order"""
+    for strain in load_strain_manifest():
+        yield strain, load_sequence_store(strain)
+
+
+def ingest_strains_sequences():
+    """Build the sequence stores of all downloaded strains in parallel, skipping stores which are up to date"""
+    strains = list(load_strain_manifest())
+    logger.info("Ingesting cds sequences of %d strains into sequence stores" % len(strains))
+    if not os.path.exists(SEQUENCE_STORES_DIR):
+        os.makedirs(SEQUENCE_STORES_DIR)
+    with multiprocessing.Pool(NUMBER_OF_PROCESSES) as pool:
+        for strain_dir, seqs_count in pool.imap_unordered(ingest_strain_sequences, strains):
+            logger.debug("Strain %s sequence store has %d sequences" % (strain_dir, seqs_count))
+    stale_stores = {store_dir for store_dir in os.listdir(SEQUENCE_STORES_DIR) if not is_tmp_dir(store_dir)} - \
+        {strain['dir'] for strain in strains}
+    for store_dir in stale_stores:
+        shutil.rmtree(os.path.join(SEQUENCE_STORES_DIR, store_dir))
+
+
+def ingest_strain_sequences(strain):
+    return strain['dir'], len(load_sequence_store(strain))
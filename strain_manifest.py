@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+
+from constants import STRAINS_DIR, STRAIN_MANIFEST_PATH, STRAIN_INDEX_FILE, LEGACY_DOWNLOAD_MANIFEST_PATH
+
+logger = logging.getLogger(__name__)
+
+STRAIN_MANIFEST_VERSION = 1
+
+_manifests_cache = {}
+
+
+class StrainManifest:
+    """
+    Metadata of every downloaded strain - its index, assembly accession, dir name under STRAINS_DIR and the size & md5
+    of each of its files. Strains keep their index once assigned, and new strains are indexed after all existing
+    strains in accession order, so indices do not depend on download order
+    """
+    def __init__(self, strains=()):
+        self._strains = {}
+        for strain in strains:
+            self._strains[strain['dir']] = strain
+
+    def __iter__(self):
+        """Iterate over the indexed strains in index order"""
+        return iter(sorted((s for s in self._strains.values() if s['index'] is not None), key=lambda s: s['index']))
+
+    def __len__(self):
+        return sum(1 for s in self._strains.values() if s['index'] is not None)
+
+    def __contains__(self, strain_dir):
+        return strain_dir in self._strains
+
+    def get(self, strain_dir):
+        return self._strains.get(strain_dir)
+
+    def names_map(self):
+        """Strain index -> strain dir name"""
+        return {strain['index']: strain['dir'] for strain in self}
+
+    def strains_rows(self):
+        """Number of rows needed to index per-strain arrays by strain index"""
+        return max((s['index'] for s in self), default=-1) + 1
+
+    def remove(self, strain_dir):
+        return self._strains.pop(strain_dir, None)
+
+    def update(self, strain_dir, accession, files):
+        """Record the synced files of a strain, keeping its index if it is already indexed"""
+        strain = self._strains.setdefault(strain_dir, {'index': None, 'dir': strain_dir})
+        strain['accession'] = accession
+        strain['files'] = files
+
+    def assign_new_indices(self):
+        """Index the strains added since the last call after all indexed strains, in accession order"""
+        next_index = self.strains_rows()
+        new_strains = sorted((s for s in self._strains.values() if s['index'] is None),
+                             key=lambda s: (s['accession'], s['dir']))
+        for strain in new_strains:
+            strain['index'] = next_index
+            next_index += 1
+        return len(new_strains)
+
+    def save(self, manifest_path=STRAIN_MANIFEST_PATH):
+        with open(manifest_path + ".tmp", 'w') as f:
+            json.dump({'version': STRAIN_MANIFEST_VERSION,
+                       'strains': sorted(self._strains.values(), key=lambda s: (s['index'] is None, s['index'] or 0))},
+                      f, indent=1, sort_keys=True)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        _manifests_cache.pop(manifest_path, None)
+
+
+def strain_file_path(strain, file_pattern):
+    """Path of the strain's file named by file_pattern (e.g. CDS_FROM_GENOMIC_PATTERN), or None if it has none"""
+    for file_name in (strain['dir'] + "_" + file_pattern + ".gz", strain['dir'] + "_" + file_pattern):
+        if file_name in strain['files']:
+            return os.path.join(STRAINS_DIR, strain['dir'], file_name)
+    return None
+
+
+def load_strain_manifest(manifest_path=STRAIN_MANIFEST_PATH):
+    """
+    Load the strain manifest, once per process while it is unchanged on disk. A missing manifest is migrated from the
+    strain_index files of previously downloaded strains
+    """
+    if not os.path.exists(manifest_path):
+        migrate_strain_manifest(manifest_path)
+    mtime_ns = os.stat(manifest_path).st_mtime_ns
+    cached = _manifests_cache.get(manifest_path)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+    with open(manifest_path) as f:
+        manifest_data = json.load(f)
+    if manifest_data.get('version') != STRAIN_MANIFEST_VERSION:
+        raise ValueError("Unsupported strain manifest version %s in %s" % (manifest_data.get('version'), manifest_path))
+    manifest = StrainManifest(manifest_data['strains'])
+    _manifests_cache[manifest_path] = (mtime_ns, manifest)
+    return manifest
+
+
+def migrate_strain_manifest(manifest_path=STRAIN_MANIFEST_PATH):
+    """Build the strain manifest from the strain_index files & download manifest of an existing strains dir"""
+    download_manifest = {}
+    if os.path.exists(LEGACY_DOWNLOAD_MANIFEST_PATH):
+        with open(LEGACY_DOWNLOAD_MANIFEST_PATH) as f:
+            download_manifest = json.load(f)
+    strains = []
+    strain_dirs = os.listdir(STRAINS_DIR) if os.path.exists(STRAINS_DIR) else []
+    for strain_dir in strain_dirs:
+        strain_index_file_path = os.path.join(STRAINS_DIR, strain_dir, STRAIN_INDEX_FILE)
+        if not os.path.exists(strain_index_file_path):
+            continue
+        with open(strain_index_file_path) as f:
+            strain_index = int(f.readline())
+        downloaded_files = download_manifest.get(strain_dir, {}).get('files', {})
+        files = {}
+        for file_name in os.listdir(os.path.join(STRAINS_DIR, strain_dir)):
+            if file_name != STRAIN_INDEX_FILE:
+                files[file_name] = downloaded_files.get(file_name) or \
+                    {'size': os.path.getsize(os.path.join(STRAINS_DIR, strain_dir, file_name)), 'md5': None}
+        strains.append({'index': strain_index, 'accession': "_".join(strain_dir.split("_")[:2]), 'dir': strain_dir,
+                        'files': files})
+    if strains:
+        logger.info("Migrated %d strains from strain_index files to the strain manifest" % len(strains))
+    StrainManifest(strains).save(manifest_path)
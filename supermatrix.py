@@ -0,0 +1,118 @@
+import json
+import os
+
+import numpy
+
+from alignment_matrix import AlignmentMatrix, build_supermatrix, write_partitions_file
+from constants import SUPERMATRIX_MISSING_CHARACTERS
+from fs_utils import building_dir
+
+SUPERMATRIX_VERSION = 1
+SUPERMATRIX_MATRIX_FILE = "matrix.npy"
+SUPERMATRIX_META_FILE = "meta.json"
+
+
+class Supermatrix:
+    """
+    Concatenated alignment of all core clusters - a strains x positions uint8 character matrix, the (index, name)
+    of the strain of every row and the (name, start, end) column range of every partition (cluster alignment).
+    Filters return new supermatrices, and only the final variant has to be exported to fasta or phylip
+    """
+    def __init__(self, matrix, strains, partitions):
+        self.matrix = matrix
+        self.strains = [tuple(strain) for strain in strains]
+        self.partitions = [tuple(partition) for partition in partitions]
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def get_alignment_length(self):
+        return self.matrix.shape[1]
+
+    def missing(self):
+        """Mask of the gap & unknown characters in the matrix"""
+        return numpy.isin(self.matrix, numpy.frombuffer(SUPERMATRIX_MISSING_CHARACTERS, dtype=numpy.uint8))
+
+    def strains_missing_fraction(self):
+        return self.missing().mean(axis=1) if self.get_alignment_length() else numpy.ones(len(self))
+
+    def columns_missing_fraction(self):
+        return self.missing().mean(axis=0) if len(self) else numpy.ones(self.get_alignment_length())
+
+    def select_strains(self, rows_mask):
+        rows = numpy.flatnonzero(rows_mask)
+        return Supermatrix(self.matrix[rows], [self.strains[row] for row in rows.tolist()], self.partitions)
+
+    def drop_empty_strains(self):
+        """Drop strains whose row has only '-' gaps, i.e. the padding rows of strains missing from all partitions"""
+        return self.select_strains((self.matrix != ord("-")).any(axis=1))
+
+    def filter_strains(self, max_missing):
+        """Keep only strains with at most max_missing fraction of gap & unknown characters"""
+        return self.select_strains(self.strains_missing_fraction() <= max_missing)
+
+    def select_columns(self, columns_mask):
+        """Keep only the masked columns, shrinking the partitions accordingly and dropping emptied partitions"""
+        columns_mask = numpy.asarray(columns_mask, dtype=bool)
+        kept_before = numpy.concatenate(([0], numpy.cumsum(columns_mask)))
+        partitions = [(name, int(kept_before[start]), int(kept_before[end])) for name, start, end in self.partitions
+                      if kept_before[end] > kept_before[start]]
+        return Supermatrix(self.matrix[:, columns_mask], self.strains, partitions)
+
+    def filter_columns(self, max_missing):
+        """Keep only columns with at most max_missing fraction of gap & unknown characters"""
+        return self.select_columns(self.columns_missing_fraction() <= max_missing)
+
+    def select_partitions(self, partition_names):
+        """Keep only the columns of the named partitions, in their order in the supermatrix"""
+        partition_names = set(partition_names)
+        columns_mask = numpy.zeros(self.get_alignment_length(), dtype=bool)
+        for name, start, end in self.partitions:
+            if name in partition_names:
+                columns_mask[start:end] = True
+        return self.select_columns(columns_mask)
+
+    def row_names(self):
+        return ["[%d]%s" % (index, name) for index, name in self.strains]
+
+    def write_fasta(self, file_path):
+        AlignmentMatrix(self.row_names(), self.matrix).write_fasta(file_path)
+
+    def write_phylip(self, file_path):
+        """Write the supermatrix in relaxed sequential phylip format"""
+        with open(file_path, 'w') as f:
+            f.write("%d %d\n" % (len(self), self.get_alignment_length()))
+            for row, row_name in enumerate(self.row_names()):
+                f.write(row_name + " " + self.matrix[row].tobytes().decode() + "\n")
+
+    def write_partitions(self, file_path):
+        write_partitions_file(self.partitions, file_path)
+
+
+def load_supermatrix(supermatrix_dir):
+    """Load a saved supermatrix with its matrix memory-mapped"""
+    with open(os.path.join(supermatrix_dir, SUPERMATRIX_META_FILE)) as f:
+        meta = json.load(f)
+    if meta['version'] != SUPERMATRIX_VERSION:
+        raise ValueError("Unsupported supermatrix version %s in %s" % (meta['version'], supermatrix_dir))
+    matrix = numpy.load(os.path.join(supermatrix_dir, SUPERMATRIX_MATRIX_FILE), mmap_mode='r')
+    return Supermatrix(matrix, meta['strains'], meta['partitions'])
+
+
+def concatenate_alignments(alignment_paths, partition_names, strains, supermatrix_dir):
+    """
+    Build & save the supermatrix of alignments whose rows are the given (index, name) strains, naming each
+    alignment's partition by partition_names
+    """
+    with building_dir(supermatrix_dir) as tmp_supermatrix_dir:
+        partitions = build_supermatrix(alignment_paths, len(strains),
+                                       os.path.join(tmp_supermatrix_dir, SUPERMATRIX_MATRIX_FILE))
+        save_supermatrix_meta(tmp_supermatrix_dir, strains, [(name, start, end) for name, (_, start, end)
+                                                             in zip(partition_names, partitions)])
+    return load_supermatrix(supermatrix_dir)
+
+
+def save_supermatrix_meta(supermatrix_dir, strains, partitions):
+    with open(os.path.join(supermatrix_dir, SUPERMATRIX_META_FILE), 'w') as f:
+        json.dump({'version': SUPERMATRIX_VERSION, 'strains': [list(strain) for strain in strains],
+                   'partitions': [list(partition) for partition in partitions]}, f)
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from download_engine import TransferEngine, HTTPConnection, ChecksumMismatchError, download_to_file
+
+CONTENT = bytes(range(256)) * 4096
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    """Local stand-in for the NCBI server serving CONTENT, optionally cutting responses short or ignoring Range"""
+    def __init__(self, truncated_responses=0, support_range=True):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.truncated_responses = truncated_responses
+        self.support_range = support_range
+        self.range_requests = []
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/file":
+            self.send_error(404)
+            return
+        range_header = self.headers.get('Range')
+        self.server.range_requests.append(range_header)
+        offset = int(range_header[len("bytes="):-1]) if range_header and self.server.support_range else 0
+        if offset >= len(CONTENT) and offset:
+            self.send_response(416)
+            self.send_header('Content-Length', "0")
+            self.end_headers()
+            return
+        body = CONTENT[offset:]
+        self.send_response(206 if offset else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.server.truncated_responses:
+            self.server.truncated_responses -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.local_file_path = os.path.join(self.tmp_dir, "file")
+        self.md5 = hashlib.md5(CONTENT).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def start_server(self, **kwargs):
+        server = StandInServer(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def write_local_file(self, data):
+        with open(self.local_file_path, 'wb') as f:
+            f.write(data)
+
+    def download(self, server, expected_md5=None):
+        connection = HTTPConnection("http", "127.0.0.1", server.server_port, 5)
+        try:
+            return download_to_file(connection, "/file", self.local_file_path, expected_md5)
+        finally:
+            connection.close()
+
+    def fetch_file(self, server, expected_md5):
+        async def fetch():
+            async with TransferEngine(concurrency=2, host_rate=0, max_attempts=3, backoff_base=0.01,
+                                      backoff_max=0.01) as engine:
+                return await engine.fetch_file("http://127.0.0.1:%d/file" % server.server_port,
+                                               self.local_file_path, expected_md5), engine.metrics
+        return asyncio.run(fetch())
+
+    def assert_local_file_complete(self):
+        with open(self.local_file_path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_resumes_truncated_file(self):
+        server = self.start_server()
+        self.write_local_file(CONTENT[:1000])
+        file_info = self.download(server, self.md5)
+        self.assertEqual(server.range_requests, ["bytes=1000-"])
+        self.assertEqual(file_info, {'size': len(CONTENT), 'md5': self.md5, 'transferred': len(CONTENT) - 1000})
+        self.assert_local_file_complete()
+
+    def test_skips_complete_file(self):
+        server = self.start_server()
+        self.write_local_file(CONTENT)
+        file_info = self.download(server, self.md5)
+        self.assertEqual(server.range_requests, [])
+        self.assertEqual(file_info['transferred'], 0)
+
+    def test_restarts_when_range_is_refused(self):
+        server = self.start_server(support_range=False)
+        self.write_local_file(CONTENT[:1000])
+        file_info = self.download(server, self.md5)
+        self.assertEqual(file_info['transferred'], len(CONTENT))
+        self.assert_local_file_complete()
+
+    def test_restarts_when_range_is_not_satisfiable(self):
+        server = self.start_server()
+        self.write_local_file(CONTENT + b"extra")
+        file_info = self.download(server)
+        self.assertEqual(server.range_requests, ["bytes=%d-" % (len(CONTENT) + 5), None])
+        self.assertEqual(file_info['md5'], self.md5)
+        self.assert_local_file_complete()
+
+    def test_checksum_mismatch_removes_file(self):
+        server = self.start_server()
+        self.write_local_file(b"x" * 1000)
+        with self.assertRaises(ChecksumMismatchError):
+            self.download(server, self.md5)
+        self.assertFalse(os.path.exists(self.local_file_path))
+
+    def test_retries_truncated_transfer_and_resumes(self):
+        server = self.start_server(truncated_responses=1)
+        file_info, metrics = self.fetch_file(server, self.md5)
+        self.assertEqual(server.range_requests, [None, "bytes=%d-" % (len(CONTENT) // 2)])
+        self.assertEqual(file_info, {'size': len(CONTENT), 'md5': self.md5})
+        self.assertEqual((metrics.retries, metrics.failures), (1, 0))
+        self.assert_local_file_complete()
+
+    def test_retries_checksum_mismatch_from_scratch(self):
+        server = self.start_server()
+        self.write_local_file(b"x" * 1000)
+        file_info, metrics = self.fetch_file(server, self.md5)
+        self.assertEqual(server.range_requests, ["bytes=1000-", None])
+        self.assertEqual(file_info['md5'], self.md5)
+        self.assertEqual(metrics.retries, 1)
+        self.assert_local_file_complete()
+
+    def test_missing_file_is_not_retried(self):
+        server = self.start_server()
+
+        async def fetch():
+            async with TransferEngine(max_attempts=3, backoff_base=0.01, backoff_max=0.01) as engine:
+                await engine.fetch_file("http://127.0.0.1:%d/missing" % server.server_port, self.local_file_path)
+        with self.assertRaises(FileNotFoundError):
+            asyncio.run(fetch())
+
+
+if __name__ == '__main__':
+    unittest.main()
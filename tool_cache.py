@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from constants import TOOL_CACHE_DIR, TOOL_CACHE_MAX_SIZE
+from fs_utils import building_dir, is_tmp_dir
+
+logger = logging.getLogger(__name__)
+
+TOOL_CACHE_VERSION = 1
+TOOL_CACHE_META_FILE = "meta.json"
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+_tool_versions = {}
+
+
+class ToolCache:
+    """
+    Content-addressed store of external tool outputs. Entries are keyed by the hash of the tools' executables, their
+    arguments and the contents of their input files, so that a result is reused whenever the same inputs are
+    processed the same way, whatever their paths, and never after they change. The least recently used entries are
+    evicted once the store grows beyond max_size bytes
+    """
+    def __init__(self, cache_dir=TOOL_CACHE_DIR, max_size=TOOL_CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, tools, args, input_paths):
+        """
+        Cache key of running tools (executable names) with args on input files. Args must not include the paths of
+        the inputs & outputs, only the options affecting the outputs
+        """
+        key_hash = hashlib.sha256()
+        key_hash.update(json.dumps({'version': TOOL_CACHE_VERSION, 'tools': [tool_version(tool) for tool in tools],
+                                    'args': [str(arg) for arg in args]}).encode())
+        for input_path in input_paths:
+            key_hash.update(file_digest(input_path).encode())
+        return key_hash.hexdigest()
+
+    def fetch(self, key, output_paths):
+        """Copy the cached outputs of key to output_paths, returning whether they were found in the cache"""
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry_dir, TOOL_CACHE_META_FILE)) as f:
+                outputs_count = json.load(f)['outputs']
+            if outputs_count != len(output_paths):
+                raise ValueError("Cache entry %s has %d outputs, expected %d" % (key, outputs_count, len(output_paths)))
+            for i, output_path in enumerate(output_paths):
+                shutil.copyfile(os.path.join(entry_dir, str(i)), output_path + ".tmp")
+            for output_path in output_paths:
+                os.replace(output_path + ".tmp", output_path)
+            os.utime(os.path.join(entry_dir, TOOL_CACHE_META_FILE))
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning("Failed to fetch tool cache entry %s: %s" % (key, e))
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def store(self, key, output_paths):
+        """Add the outputs of key to the cache, then evict least recently used entries beyond the size bound"""
+        with building_dir(os.path.join(self.cache_dir, key)) as tmp_entry_dir:
+            for i, output_path in enumerate(output_paths):
+                shutil.copyfile(output_path, os.path.join(tmp_entry_dir, str(i)))
+            with open(os.path.join(tmp_entry_dir, TOOL_CACHE_META_FILE), 'w') as f:
+                json.dump({'outputs': len(output_paths), 'created': time.time()}, f)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for entry in os.listdir(self.cache_dir):
+            if is_tmp_dir(entry):
+                continue
+            entry_dir = os.path.join(self.cache_dir, entry)
+            try:
+                last_used = os.stat(os.path.join(entry_dir, TOOL_CACHE_META_FILE)).st_mtime
+                entry_size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+            except OSError:
+                continue
+            entries.append((last_used, entry_size, entry_dir))
+            total_size += entry_size
+        for last_used, entry_size, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.debug("Evicting tool cache entry %s" % os.path.basename(entry_dir))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= entry_size
+
+    def summary(self):
+        return "tool cache: %d hits, %d misses" % (self.hits, self.misses)
+
+
+def tool_version(tool):
+    """Identify a tool by the hash of its executable (or wrapper script), found on the PATH"""
+    tool_path = shutil.which(tool)
+    if tool_path is None:
+        return tool
+    stat = os.stat(tool_path)
+    cached = _tool_versions.get(tool_path)
+    if cached is None or cached[0] != (stat.st_size, stat.st_mtime_ns):
+        cached = ((stat.st_size, stat.st_mtime_ns), "%s:%s" % (tool, file_digest(tool_path)))
+        _tool_versions[tool_path] = cached
+    return cached[1]
+
+
+def file_digest(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import os
+import time
+
+from constants import NUMBER_OF_PROCESSES
+
+logger = logging.getLogger(__name__)
+
+
+class ToolCommand:
+    """
+    A single external tool invocation. When threads_option (e.g. MAFFT's --thread) is given, it is passed to
+    the tool with the threads allocated to its job. stdout is written to stdout_path, only replacing it once the tool exits
+    with one of ok_codes, or to the job's log file
+    """
+    def __init__(self, name, args, threads_option=None, stdout_path=None, ok_codes=(0,)):
+        self.name = name
+        self.args = list(args)
+        self.threads_option = threads_option
+        self.stdout_path = stdout_path
+        self.ok_codes = ok_codes
+
+    def build_args(self, threads):
+        if self.threads_option is None:
+            return self.args
+        return self.args[:1] + [self.threads_option, str(threads)] + self.args[1:]
+
+
+class ToolJob:
+    """
+    Commands run one after the other on the same allocated cores, logging to log_path, and stop at the first failed
+    command. Jobs are dispatched by descending cost, and are allocated up to max_threads cores
+    """
+    def __init__(self, name, commands, cost, max_threads=1, log_path=None):
+        self.name = name
+        self.commands = commands
+        self.cost = cost
+        self.max_threads = max(1, max_threads)
+        self.log_path = log_path
+        self.threads = None
+        self.exit_codes = {}
+        self.elapsed = None
+
+    def succeeded(self):
+        return all(self.exit_codes.get(command.name) in command.ok_codes for command in self.commands)
+
+
+class ToolScheduler:
+    """
+    Run tool jobs as asyncio subprocesses within a budget of cores. Jobs start longest first, each allocated
+    min(max_threads, free cores) cores, so that big jobs start early with several threads and small jobs fill the
+    remaining cores without running more threads than cores
+    """
+    def __init__(self, cores=NUMBER_OF_PROCESSES):
+        self.cores = max(1, cores)
+
+    def run(self, jobs):
+        return asyncio.run(self.run_jobs(jobs))
+
+    async def run_jobs(self, jobs):
+        pending = sorted(jobs, key=lambda j: j.cost, reverse=True)
+        running = set()
+        free_cores = self.cores
+        start_time = time.monotonic()
+        while pending or running:
+            while pending and free_cores:
+                job = pending.pop(0)
+                job.threads = min(job.max_threads, free_cores)
+                free_cores -= job.threads
+                running.add(asyncio.ensure_future(self.run_job(job)))
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                job = task.result()
+                free_cores += job.threads
+        failed_jobs = [job for job in jobs if not job.succeeded()]
+        logger.info("Finished %d tool jobs on %d cores in %.1f seconds, %d failed" %
+                    (len(jobs), self.cores, time.monotonic() - start_time, len(failed_jobs)))
+        return jobs
+
+    async def run_job(self, job):
+        start_time = time.monotonic()
+        logger.info("Running %s with %d threads" % (job.name, job.threads))
+        log_file = open(job.log_path, 'w') if job.log_path else None
+        try:
+            for command in job.commands:
+                job.exit_codes[command.name] = await self.run_command(command, job.threads, log_file)
+                if job.exit_codes[command.name] not in command.ok_codes:
+                    logger.error("%s of %s failed with return code %d" %
+                                 (command.name, job.name, job.exit_codes[command.name]))
+                    break
+        finally:
+            if log_file:
+                log_file.close()
+        job.elapsed = time.monotonic() - start_time
+        logger.info("Finished %s in %.1f seconds with return codes %s" % (job.name, job.elapsed, job.exit_codes))
+        return job
+
+    async def run_command(self, command, threads, log_file):
+        args = command.build_args(threads)
+        if log_file:
+            log_file.write("$ %s\n" % " ".join(args))
+            log_file.flush()
+        stdout_file = open(command.stdout_path + ".tmp", 'w') if command.stdout_path else None
+        return_code = 127
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *args, stdin=asyncio.subprocess.DEVNULL, stdout=stdout_file or log_file or asyncio.subprocess.DEVNULL,
+                stderr=log_file or asyncio.subprocess.DEVNULL)
+            return_code = await process.wait()
+        except OSError as e:
+            if log_file:
+                log_file.write("Failed to start %s: %s\n" % (args[0], e))
+        finally:
+            if stdout_file:
+                stdout_file.close()
+                if return_code in command.ok_codes:
+                    os.replace(command.stdout_path + ".tmp", command.stdout_path)
+                else:
+                    os.remove(command.stdout_path + ".tmp")
+        return return_code